@@ -0,0 +1,5 @@
+# python3 -m app - a script is compiled on every run, an imported module comes from its cached .pyc, so the entry
+# point stays this small and app/main.py is imported
+from app.main import main
+
+main()
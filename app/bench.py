@@ -0,0 +1,337 @@
+import sys
+import os
+import io
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+from types import SimpleNamespace
+
+from app.main import Git, PackStream, DeltaBaseCache
+
+# Benchmarks for the hot paths of app/main.py - run from the repo root:
+#   python3 -m app.bench --output before.json
+#   python3 -m app.bench --output after.json --baseline before.json
+# every fixture is generated from a seed (no network, nothing to download), and every benchmark runs in a forked
+# child of its own, so the peak RSS reported is that benchmark's and nothing it did is left behind for the next
+
+
+# -------- FIXTURES --------
+
+WORDS = (b"def class return import self None True False for while if else elif try except with as lambda yield "
+         b"value index buffer offset header object commit tree blob delta base chain pack stream window cache "
+         b"size count path name mode hash sha data content result error length start end print").split()
+
+# one big source-looking text to cut files out of - lines of random words, so it compresses and deltas like code
+def make_corpus(rng: random.Random, size: int) -> bytes:
+    lines = []
+    total = 0
+    while total < size:
+        line = b' ' * (4 * rng.randrange(4)) + b' '.join(rng.choice(WORDS) for _ in range(rng.randrange(3, 12))) + b'\n'
+        lines.append(line)
+        total += len(line)
+    return b''.join(lines)
+
+# a file's content: a window of the corpus behind a unique first line, so no two files share a blob
+def make_content(rng: random.Random, corpus: bytes, size: int, tag: str) -> bytes:
+    start = rng.randrange(max(1, len(corpus) - size))
+    return f"# {tag}\n".encode('ascii') + corpus[start:start + size]
+
+# `files` files of about `file_size` bytes (+-50%), spread `depth` directories deep with `fanout` per level
+# their mtimes are pushed into the past, so a second write-tree sees a clean (not racily clean) index
+def make_work_tree(root: str, rng: random.Random, corpus: bytes, files: int, depth: int, fanout: int, file_size: int):
+    per_leaf = max(1, files // fanout ** depth)
+    past = time.time() - 60
+    paths = []
+    total = 0
+    for i in range(files):
+        leaf = i // per_leaf
+        parts = [f"d{leaf // fanout ** level % fanout}" for level in reversed(range(depth))]
+        directory = os.path.join(root, *parts)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"file{i}.txt")
+        content = make_content(rng, corpus, rng.randrange(file_size // 2, file_size * 3 // 2 + 1), path)
+        with open(path, 'wb') as f:
+            f.write(content)
+        os.utime(path, (past, past))
+        paths.append(path)
+        total += len(content)
+    return paths, total
+
+# a pack of `objects` blobs made of version chains - each version a few edits away from the one before and a little
+# shorter, so the packer's size order keeps them in sequence and each one deltas against its predecessor, chains
+# capped at `chain_depth`. Returns (pack path, shas) - the pack sits alone in the object store of `repo_dir`
+def make_pack(root: str, repo_dir: str, rng: random.Random, corpus: bytes, objects: int, chain_depth: int, file_size: int):
+    scratch = Git(os.path.join(root, 'pack-source.git'))
+    with contextlib.redirect_stdout(io.StringIO()):
+        scratch.init(None)
+
+    entries = []
+    versions = chain_depth + 1
+    for chain in range((objects + versions - 1) // versions):
+        content = bytearray(make_content(rng, corpus, file_size + versions * 16, f"chain {chain}"))
+        for version in range(min(versions, objects - len(entries))):
+            sha = scratch._write_object(b'blob ' + str(len(content)).encode('ascii') + b'\x00' + bytes(content))
+            entries.append((sha, f"chain{chain}.txt"))
+            for _ in range(3): # a few small edits, then drop 16 bytes
+                at = rng.randrange(len(content) - 8)
+                content[at:at + 8] = rng.choice(WORDS)[:8].ljust(8)
+            cut = rng.randrange(len(content) - 16)
+            del content[cut:cut + 16]
+
+    pack_dir = os.path.join(repo_dir, Git.OBJECTS_DIR, Git.PACK_DIR)
+    os.makedirs(pack_dir)
+    pack_sha, _ = scratch._pack_objects(entries, os.path.join(pack_dir, 'pack'), window=10, depth=chain_depth)
+    shutil.rmtree(scratch.git_dir)
+    return os.path.join(pack_dir, f"pack-{pack_sha}.pack"), [sha for sha, _ in entries]
+
+def make_fixtures(root: str, args):
+    rng = random.Random(args.seed)
+    corpus = make_corpus(rng, max(1 << 20, args.file_size * 64))
+    fixtures = SimpleNamespace(root=root)
+
+    fixtures.tree = os.path.join(root, 'tree')
+    fixtures.paths, fixtures.tree_bytes = make_work_tree(fixtures.tree, rng, corpus, args.files, args.depth,
+                                                         args.fanout, args.file_size)
+
+    # the work tree's objects, loose - what checkout reads
+    fixtures.source_git = os.path.join(root, 'source.git')
+    source = Git(fixtures.source_git)
+    with contextlib.redirect_stdout(io.StringIO()):
+        source.init(None)
+    fixtures.tree_sha = source.write_tree(SimpleNamespace(threads=None), fixtures.tree)
+
+    fixtures.pack_git = os.path.join(root, 'pack.git')
+    fixtures.pack_path, fixtures.pack_shas = make_pack(root, fixtures.pack_git, rng, corpus, args.objects,
+                                                       args.chain_depth, args.file_size)
+    return fixtures
+
+
+# -------- BENCHMARKS --------
+# each one sets up (untimed) and returns (seconds, objects, bytes) for its timed part
+
+def fresh_git(fixtures, name: str) -> Git:
+    git = Git(os.path.join(tempfile.mkdtemp(dir=fixtures.root, prefix=name + '-'), '.git'))
+    with contextlib.redirect_stdout(io.StringIO()):
+        git.init(None)
+    return git
+
+def bench_write_tree_cold(fixtures):
+    git = fresh_git(fixtures, 'write-tree')
+    started = time.perf_counter()
+    git.write_tree(SimpleNamespace(threads=None), fixtures.tree)
+    return time.perf_counter() - started, len(fixtures.paths), fixtures.tree_bytes
+
+def bench_write_tree_warm(fixtures): # every file is in the index already - only stat calls and cached tree shas
+    git = fresh_git(fixtures, 'write-tree')
+    git.write_tree(SimpleNamespace(threads=None), fixtures.tree)
+    git = Git(git.git_dir)
+    started = time.perf_counter()
+    git.write_tree(SimpleNamespace(threads=None), fixtures.tree)
+    return time.perf_counter() - started, len(fixtures.paths), fixtures.tree_bytes
+
+def bench_hash_object(fixtures):
+    git = fresh_git(fixtures, 'hash-object')
+    started = time.perf_counter()
+    for path in fixtures.paths:
+        git._write_blob(path, True)
+    return time.perf_counter() - started, len(fixtures.paths), fixtures.tree_bytes
+
+def bench_cat_file(fixtures): # every object of the delta chain pack, in sha order - deltas hit and miss the caches
+    git = Git(fixtures.pack_git)
+    shas = sorted(fixtures.pack_shas)
+    total = 0
+    started = time.perf_counter()
+    for sha in shas:
+        total += len(git._read_object(sha))
+    return time.perf_counter() - started, len(shas), total
+
+def bench_index_pack(fixtures): # streaming parse, delta resolution, .idx - what clone does with the pack
+    git = fresh_git(fixtures, 'index-pack')
+    started = time.perf_counter()
+    with open(fixtures.pack_path, 'rb') as f:
+        git._receive_pack(PackStream(f))
+    return time.perf_counter() - started, len(fixtures.pack_shas), os.path.getsize(fixtures.pack_path)
+
+def bench_apply_delta(fixtures): # _apply_delta alone, on every (base, delta) pair of the pack
+    git = Git(fixtures.pack_git)
+    pack_index = git._pack_indexes()[0]
+    pack_data = pack_index.pack_data()
+    cache = DeltaBaseCache()
+    pairs = []
+    for i in range(pack_index.count):
+        offset = pack_index.offset_at(i)
+        obj_type, base_offset, base_sha, delta = git._read_pack_entry(pack_data, offset)
+        if obj_type in (Git.OBJ_OFS_DELTA, Git.OBJ_REF_DELTA):
+            if base_offset is None:
+                base_offset = pack_index.find(base_sha)
+            pairs.append((git._unpack_object(pack_data, base_offset, cache, pack_index.find)[1], delta))
+
+    total = 0
+    started = time.perf_counter()
+    for base, delta in pairs:
+        total += len(git._apply_delta(base, delta))
+    return time.perf_counter() - started, len(pairs), total
+
+def bench_checkout(fixtures): # the whole work tree out of loose objects, into an empty directory
+    target = tempfile.mkdtemp(dir=fixtures.root, prefix='checkout-')
+    git_dir = os.path.join(target, '.git')
+    os.makedirs(git_dir)
+    os.symlink(os.path.abspath(os.path.join(fixtures.source_git, Git.OBJECTS_DIR)), os.path.join(git_dir, Git.OBJECTS_DIR))
+    git = Git(git_dir)
+    started = time.perf_counter()
+    git._checkout_tree(fixtures.tree_sha, target)
+    return time.perf_counter() - started, len(fixtures.paths), fixtures.tree_bytes
+
+def bench_baseline(fixtures): # nothing - the RSS every forked child starts with
+    return 0.0, 0, 0
+
+BENCHMARKS = {
+    'write-tree-cold': bench_write_tree_cold,
+    'write-tree-warm': bench_write_tree_warm,
+    'hash-object': bench_hash_object,
+    'cat-file': bench_cat_file,
+    'index-pack': bench_index_pack,
+    'apply-delta': bench_apply_delta,
+    'checkout': bench_checkout,
+}
+
+
+# -------- RUNNER --------
+
+# runs bench(fixtures) in a forked child - returns its result plus the child's peak RSS in bytes
+def run_isolated(bench, fixtures):
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                payload = {'result': bench(fixtures)}
+        except BaseException as e:
+            payload = {'error': f"{type(e).__name__}: {e}"}
+        with os.fdopen(write_fd, 'w') as f:
+            json.dump(payload, f)
+        os._exit(0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        payload = json.loads(f.read() or '{"error": "benchmark process died"}')
+    _, _, usage = os.wait4(pid, 0)
+    peak_rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024) # bytes on macOS, KiB elsewhere
+    if 'error' in payload:
+        raise RuntimeError(payload['error'])
+    return payload['result'], peak_rss
+
+# best of `repeat` runs - the least disturbed one
+def run_benchmark(name, bench, fixtures, repeat: int):
+    runs = []
+    peak_rss = 0
+    for _ in range(repeat):
+        (seconds, objects, nbytes), rss = run_isolated(bench, fixtures)
+        runs.append(seconds)
+        peak_rss = max(peak_rss, rss)
+    best = min(runs)
+    return {
+        'name': name,
+        'wall_seconds': round(best, 6),
+        'runs': [round(seconds, 6) for seconds in runs],
+        'objects': objects,
+        'bytes': nbytes,
+        'objects_per_second': round(objects / best, 1) if best else None,
+        'mb_per_second': round(nbytes / best / 1e6, 3) if best else None,
+        'peak_rss_mb': round(peak_rss / 1e6, 1),
+    }
+
+# commit of the code being measured, read with this very implementation (None outside a git checkout)
+def current_commit():
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        with contextlib.redirect_stderr(io.StringIO()):
+            return Git(os.path.join(repo_root, '.git'))._resolve_rev('HEAD')
+    except (SystemExit, Exception):
+        return None
+
+def report(results, baseline, out=sys.stderr):
+    before = {result['name']: result for result in (baseline or {}).get('results', [])}
+    out.write(f"{'benchmark':<18}{'wall s':>10}{'objects/s':>12}{'MB/s':>9}{'peak MB':>9}" + ('  vs baseline' if before else '') + '\n')
+    for result in results:
+        line = (f"{result['name']:<18}{result['wall_seconds']:>10.4f}{result['objects_per_second'] or 0:>12.0f}"
+                f"{result['mb_per_second'] or 0:>9.1f}{result['peak_rss_mb']:>9.1f}")
+        old = before.get(result['name'])
+        if old and result['wall_seconds']:
+            line += f"  {old['wall_seconds'] / result['wall_seconds']:.2f}x"
+        out.write(line + '\n')
+
+
+# -------- MAIN ---------
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the git implementation in app/main.py")
+    parser.add_argument('--files', type=int, default=2000, help="Files in the synthetic work tree (default 2000)")
+    parser.add_argument('--depth', type=int, default=3, help="Directory levels above the files (default 3)")
+    parser.add_argument('--fanout', type=int, default=4, help="Subdirectories per directory level (default 4)")
+    parser.add_argument('--file-size', dest='file_size', type=int, default=4096, help="Average file size in bytes (default 4096)")
+    parser.add_argument('--objects', type=int, default=2000, help="Blobs in the generated pack (default 2000)")
+    parser.add_argument('--chain-depth', dest='chain_depth', type=int, default=20, help="Longest delta chain in the pack (default 20)")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per benchmark, the fastest is reported (default 3)")
+    parser.add_argument('--seed', type=int, default=1, help="Seed of the generated fixtures")
+    parser.add_argument('--only', type=str, help=f"Comma separated subset of: {', '.join(BENCHMARKS)}")
+    parser.add_argument('--output', type=str, help="Write the results as JSON here (default: stdout)")
+    parser.add_argument('--baseline', type=str, help="Earlier --output file to compare against")
+    parser.add_argument('--workdir', type=str, help="Where fixtures are generated (default: a temporary directory)")
+    parser.add_argument('--keep', action='store_true', help="Keep the generated fixtures")
+    args = parser.parse_args()
+
+    names = args.only.split(',') if args.only else list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(unknown)}")
+
+    root = tempfile.mkdtemp(prefix='git-bench-', dir=args.workdir)
+    try:
+        started = time.perf_counter()
+        fixtures = make_fixtures(root, args)
+        print(f"fixtures ready in {time.perf_counter() - started:.1f}s under {root}", file=sys.stderr)
+
+        (_, _, _), baseline_rss = run_isolated(bench_baseline, fixtures)
+        results = []
+        for name in names:
+            results.append(run_benchmark(name, BENCHMARKS[name], fixtures, max(1, args.repeat)))
+            print(f"  {name}: {results[-1]['wall_seconds']:.4f}s", file=sys.stderr)
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    output = {
+        'commit': current_commit(),
+        'timestamp': int(time.time()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'parameters': {key: getattr(args, key) for key in ('files', 'depth', 'fanout', 'file_size', 'objects', 'chain_depth', 'repeat', 'seed')},
+        'baseline_rss_mb': round(baseline_rss / 1e6, 1), # peak RSS of a child that does nothing - included in every peak_rss_mb
+        'results': results,
+    }
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+            f.write('\n')
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == "__main__":
+    main()
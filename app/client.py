@@ -0,0 +1,44 @@
+# Thin client of the command daemon (python3 -m app daemon) - run from the repo root:
+#   python3 -m app.client cat-file -t <sha>
+# sends the arguments, its cwd and its own stdin/stdout/stderr over the daemon's Unix socket, then exits with the
+# command's status. It imports nothing but socket and struct, so it starts about as fast as a bare python3.
+# Without a daemon listening, the command runs right here instead.
+
+import os
+import socket
+import struct
+import sys
+
+SOCKET_ENV = 'GIT_DAEMON_SOCKET'
+DEFAULT_SOCKET = os.path.join('.git', 'daemon.sock') # CommandDaemon.SOCKET_FILE, under .git
+HEADER = struct.Struct('>i') # request length / exit status, as CommandDaemon.HEADER
+
+
+def main(argv):
+    request = '\0'.join([os.getcwd()] + argv).encode('utf-8', 'surrogateescape')
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(os.environ.get(SOCKET_ENV, DEFAULT_SOCKET))
+    except OSError: # no daemon - same command, in this process
+        client.close()
+        from app.main import main as run_here
+        run_here()
+        return 0
+
+    with client:
+        message = HEADER.pack(len(request)) + request
+        sent = socket.send_fds(client, [message], [sys.stdin.fileno(), sys.stdout.fileno(), sys.stderr.fileno()])
+        if sent < len(message):
+            client.sendall(message[sent:])
+        reply = b''
+        while len(reply) < HEADER.size:
+            chunk = client.recv(HEADER.size - len(reply))
+            if not chunk:
+                print("fatal: the daemon closed the connection", file=sys.stderr)
+                return 128
+            reply += chunk
+    return HEADER.unpack(reply)[0]
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,274 @@
+import sys
+import os
+import re
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from types import SimpleNamespace
+
+# End-to-end checks of clone and fetch against the local smart HTTP server - run from the repo root:
+#   python3 -m app.e2e
+# a source repository is built with real git and served by `serve`; this implementation then clones it (full,
+# --depth 1 and --filter=blob:none, over protocol v2 and v0), fetches a new commit and checks it out, and real git
+# clones it too. Every result goes through `git fsck`, and our write-tree has to give back the commit's own tree -
+# a clone is only right if it round-trips. Needs git on the PATH, no network
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP = [sys.executable, '-m', 'app']
+SERVER_START_TIMEOUT = 10 # seconds
+
+
+class CheckFailed(Exception):
+    pass
+
+
+# -------- HELPERS --------
+
+# runs a command, returns its stdout - a non-zero exit raises CheckFailed with the command's stderr
+def run(cmd, cwd, env, check=True) -> str:
+    result = subprocess.run(cmd, cwd=cwd, env=env, stdin=subprocess.DEVNULL, capture_output=True)
+    if check and result.returncode != 0:
+        stderr = result.stderr.decode('utf-8', 'replace').strip()
+        raise CheckFailed(f"`{' '.join(cmd[2:] if cmd[:2] == APP[:2] else cmd)}` exited {result.returncode}\n{stderr}")
+    return result.stdout.decode('utf-8', 'replace')
+
+def git(ctx, *args, cwd=None) -> str:
+    return run(['git', *args], cwd or ctx.root, ctx.env).strip()
+
+def app(ctx, *args, cwd=None) -> str:
+    return run([*APP, *args], cwd or ctx.root, ctx.env)
+
+def expect(what, got, wanted):
+    if got != wanted:
+        raise CheckFailed(f"{what}: got {got!r:.200}, expected {wanted!r:.200}")
+
+# an isolated environment - no user or system git config, fixed identities and dates, this checkout on the path
+def make_env(root: str):
+    env = {key: value for key, value in os.environ.items() if not key.startswith('GIT_')}
+    env.update({
+        'HOME': root, 'GIT_CONFIG_NOSYSTEM': '1', 'GIT_TERMINAL_PROMPT': '0', 'PYTHONPATH': REPO_ROOT,
+        'GIT_AUTHOR_NAME': 'e2e', 'GIT_AUTHOR_EMAIL': 'e2e@example.com',
+        'GIT_COMMITTER_NAME': 'e2e', 'GIT_COMMITTER_EMAIL': 'e2e@example.com',
+    })
+    return env
+
+
+# -------- FIXTURES --------
+
+# writes {path: content} into the work tree - bytes for a file, ('exec', bytes) for an executable one,
+# ('link', target) for a symlink, None deletes
+def write_files(work_tree: str, files):
+    for path, content in files.items():
+        full_path = os.path.join(work_tree, path)
+        if os.path.lexists(full_path):
+            os.remove(full_path)
+        if content is None:
+            continue
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        kind, data = content if isinstance(content, tuple) else ('file', content)
+        if kind == 'link':
+            os.symlink(data, full_path)
+            continue
+        with open(full_path, 'wb') as f:
+            f.write(data)
+        os.chmod(full_path, 0o755 if kind == 'exec' else 0o644)
+
+def commit(ctx, files, message: str):
+    write_files(ctx.source, files)
+    git(ctx, 'add', '-A', cwd=ctx.source)
+    ctx.commits += 1
+    date = f"{1700000000 + ctx.commits * 60} +0000"
+    run(['git', 'commit', '-q', '-m', message], ctx.source, dict(ctx.env, GIT_AUTHOR_DATE=date, GIT_COMMITTER_DATE=date))
+
+# the served repository: a few commits of nested files with edits between them (deltas), an executable, symlinks
+# (one to a file, one to a parent directory, one dangling), a file over the streaming size, a side branch and
+# annotated tags - gc'd, so refs are packed and most objects are in a pack, with one more commit loose on top
+def make_source(ctx):
+    git(ctx, 'init', '-q', '-b', 'main', ctx.source)
+    lines = [f"line {i} of the shared text\n".encode('ascii') for i in range(400)]
+    big = b''.join(b'%08d big file row\n' % i for i in range(80000)) # ~1.5 MB
+
+    commit(ctx, {
+        'README': b'e2e source\n',
+        'src/main.py': b''.join(lines),
+        'src/util/helpers.py': b''.join(lines[::2]),
+        'docs/guide.txt': b''.join(lines[::3]),
+        'bin/run.sh': ('exec', b'#!/bin/sh\necho run\n'),
+        'big.dat': big,
+        'link': ('link', 'src/main.py'),
+        'src/up': ('link', '..'),
+        'dangling': ('link', 'does/not/exist'),
+    }, 'first')
+
+    for version in range(1, 4):
+        lines[version * 50] = f"edited in version {version}\n".encode('ascii')
+        commit(ctx, {
+            'src/main.py': b''.join(lines),
+            'docs/guide.txt': b''.join(lines[::3]) + b'v%d\n' % version,
+            f'notes/v{version}.txt': b'notes for version %d\n' % version,
+        }, f"version {version}")
+    git(ctx, 'tag', '-a', 'v1.0', '-m', 'release', cwd=ctx.source)
+
+    git(ctx, 'checkout', '-q', '-b', 'side', 'HEAD~2', cwd=ctx.source)
+    commit(ctx, {'side.txt': b'side branch\n'}, 'side work')
+    git(ctx, 'checkout', '-q', 'main', cwd=ctx.source)
+    git(ctx, 'gc', '-q', cwd=ctx.source)
+
+    commit(ctx, {'src/main.py': b''.join(lines) + b'tail\n', 'link': ('link', 'docs/guide.txt')}, 'after gc')
+
+# starts `serve` on a free port over the fixture directory - returns (process, base url)
+def start_server(ctx):
+    log_path = os.path.join(ctx.root, 'serve.log')
+    log = open(log_path, 'wb')
+    process = subprocess.Popen([*APP, 'serve', '--port', '0', ctx.served], cwd=ctx.root, env=ctx.env,
+                               stdin=subprocess.DEVNULL, stdout=log, stderr=log)
+    log.close()
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        with open(log_path, 'rb') as f:
+            match = re.search(rb'on (http://\S+?)/?\n', f.read())
+        if match:
+            return process, match.group(1).decode('ascii')
+        if process.poll() is not None:
+            break
+        time.sleep(0.05)
+    process.kill()
+    with open(log_path, 'rb') as f:
+        raise CheckFailed(f"serve did not start:\n{f.read().decode('utf-8', 'replace')}")
+
+
+# -------- CHECKS --------
+
+# git fsck of a clone - dangling objects are fine, anything it calls an error or missing is not
+def check_fsck(ctx, clone_dir: str):
+    result = subprocess.run(['git', 'fsck', '--full', '--no-dangling'], cwd=clone_dir, env=ctx.env, capture_output=True)
+    if result.returncode != 0:
+        raise CheckFailed(f"git fsck failed\n{result.stderr.decode('utf-8', 'replace').strip()}")
+
+# the work tree is exactly the commit: our write-tree gives its tree back, and git sees nothing changed
+def check_round_trip(ctx, clone_dir: str, commit_sha: str):
+    expect('HEAD', git(ctx, 'rev-parse', 'HEAD', cwd=clone_dir), commit_sha)
+    expect('write-tree', app(ctx, 'write-tree', cwd=clone_dir).strip(), git(ctx, 'rev-parse', f'{commit_sha}^{{tree}}', cwd=clone_dir))
+    expect('git status', git(ctx, 'status', '--porcelain', cwd=clone_dir), '')
+
+def clone(ctx, name: str, *options):
+    clone_dir = os.path.join(ctx.root, name)
+    app(ctx, 'clone', *options, f"{ctx.url}/source", clone_dir)
+    return clone_dir
+
+def head(ctx) -> str:
+    return git(ctx, 'rev-parse', 'HEAD', cwd=ctx.source)
+
+def check_clone(ctx, protocol: str):
+    clone_dir = clone(ctx, f"full-v{protocol}", '--protocol', protocol)
+    check_fsck(ctx, clone_dir)
+    check_round_trip(ctx, clone_dir, head(ctx))
+    ctx.clones[protocol] = clone_dir
+
+def check_shallow_clone(ctx, protocol: str):
+    clone_dir = clone(ctx, f"shallow-v{protocol}", '--protocol', protocol, '--depth', '1')
+    check_fsck(ctx, clone_dir)
+    check_round_trip(ctx, clone_dir, head(ctx))
+    expect('.git/shallow', git(ctx, 'rev-parse', '--is-shallow-repository', cwd=clone_dir), 'true')
+    expect('commits', git(ctx, 'rev-list', '--count', 'HEAD', cwd=clone_dir), '1')
+
+# blob:none - only HEAD's blobs come with the checkout; an older one is fetched lazily the first time it is read
+def check_blobless_clone(ctx, protocol: str):
+    clone_dir = clone(ctx, f"blobless-v{protocol}", '--protocol', protocol, '--filter=blob:none')
+    check_fsck(ctx, clone_dir)
+    check_round_trip(ctx, clone_dir, head(ctx))
+    old_blob = git(ctx, 'rev-parse', 'HEAD~2:src/main.py', cwd=ctx.source)
+    expect('lazy cat-file', app(ctx, 'cat-file', '-p', old_blob, cwd=clone_dir), run(['git', 'cat-file', '-p', old_blob], ctx.source, ctx.env))
+
+# a new commit on the server - fetch brings it (thin pack against what the clone has), checkout moves the work tree
+def check_fetch(ctx, protocol: str):
+    clone_dir = ctx.clones.get(protocol)
+    if clone_dir is None:
+        raise CheckFailed("no full clone to fetch into")
+    commit(ctx, {
+        f'src/fetched-v{protocol}.txt': b'new in the fetched commit\n',
+        'docs/guide.txt': None,
+        'link': ('link', 'README'),
+        'src/main.py': b'rewritten for the fetch over v%s\n' % protocol.encode('ascii'),
+    }, f"fetch over v{protocol}")
+    app(ctx, 'fetch', '--protocol', protocol, cwd=clone_dir)
+    expect('origin/main', git(ctx, 'rev-parse', 'refs/remotes/origin/main', cwd=clone_dir), head(ctx))
+    check_fsck(ctx, clone_dir)
+    app(ctx, 'checkout', head(ctx), cwd=clone_dir)
+    check_round_trip(ctx, clone_dir, head(ctx))
+
+# the server against the real client - every branch and tag, and the same history as the source
+def check_git_clone(ctx, protocol: str):
+    clone_dir = os.path.join(ctx.root, f"git-v{protocol}")
+    git(ctx, '-c', f'protocol.version={protocol}', 'clone', '-q', f"{ctx.url}/source", clone_dir)
+    check_fsck(ctx, clone_dir)
+    expect('HEAD', git(ctx, 'rev-parse', 'HEAD', cwd=clone_dir), head(ctx))
+    expect('side', git(ctx, 'rev-parse', 'origin/side', cwd=clone_dir), git(ctx, 'rev-parse', 'side', cwd=ctx.source))
+    expect('tag', git(ctx, 'rev-parse', 'v1.0', cwd=clone_dir), git(ctx, 'rev-parse', 'v1.0', cwd=ctx.source))
+
+CHECKS = {
+    'clone': check_clone,
+    'shallow-clone': check_shallow_clone,
+    'blobless-clone': check_blobless_clone,
+    'fetch': check_fetch,
+    'git-clone': check_git_clone,
+}
+
+
+# -------- MAIN ---------
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end clone and fetch checks against the local smart HTTP server")
+    parser.add_argument('--protocol', choices=['0', '2'], action='append', help="Wire protocol(s) to check (default: 2 and 0)")
+    parser.add_argument('--only', type=str, help=f"Comma separated subset of: {', '.join(CHECKS)}")
+    parser.add_argument('--workdir', type=str, help="Where the repositories are created (default: a temporary directory)")
+    parser.add_argument('--keep', action='store_true', help="Keep the repositories (and serve.log) afterwards")
+    args = parser.parse_args()
+
+    names = args.only.split(',') if args.only else list(CHECKS)
+    unknown = [name for name in names if name not in CHECKS]
+    if unknown:
+        parser.error(f"unknown check(s): {', '.join(unknown)}")
+    if shutil.which('git') is None:
+        print("fatal: the end-to-end checks need git on the PATH", file=sys.stderr)
+        sys.exit(2)
+
+    root = tempfile.mkdtemp(prefix='git-e2e-', dir=args.workdir)
+    served = os.path.join(root, 'served')
+    ctx = SimpleNamespace(root=root, served=served, source=os.path.join(served, 'source'), env=make_env(root),
+                          commits=0, clones={}, url=None)
+    failures = 0
+    server = None
+    try:
+        make_source(ctx)
+        server, ctx.url = start_server(ctx)
+        for protocol in args.protocol or ['2', '0']:
+            for name in names:
+                started = time.perf_counter()
+                try:
+                    CHECKS[name](ctx, protocol)
+                except CheckFailed as e:
+                    failures += 1
+                    print(f"FAIL {name} (v{protocol}): {e}", file=sys.stderr)
+                else:
+                    print(f"ok   {name} (v{protocol}) {time.perf_counter() - started:.2f}s", file=sys.stderr)
+    except CheckFailed as e: # the fixture or the server itself
+        failures += 1
+        print(f"FAIL setup: {e}", file=sys.stderr)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        if args.keep:
+            print(f"repositories kept under {root}", file=sys.stderr)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    print(f"{failures} failed" if failures else "all checks passed", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,8 +6,1064 @@ import zlib
 import hashlib
 import time
 import argparse
-import urllib.request
 import struct
+import tempfile
+import mmap
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import heapq
+import queue
+import contextlib
+import io
+import json
+# the network stack (http.client, urllib.parse) and the process pool (multiprocessing) are imported where they are
+# used - together they are most of the import time, and local commands like cat-file never need them
+
+
+# -------- PACK STREAM --------
+
+# Reads a PACK byte stream incrementally from any file-like source (an http response, an open file).
+# Only a small window of the pack is ever buffered - consumed bytes are dropped as we go, so parsing is linear
+# and memory does not grow with the pack size. Every consumed byte is also handed to the sinks (hashers, files).
+class PackStream:
+    CHUNK_SIZE = 64 * 1024     # how much we pull from the source at a time
+    INFLATE_WINDOW = 16 * 1024 # how much compressed input we feed zlib at a time
+
+    def __init__(self, source, sinks=()):
+        self.source = source
+        self.sinks = list(sinks)
+        self.buf = bytearray()
+        self.pos = 0      # read position inside buf
+        self.offset = 0   # absolute offset (in the pack) of buf[pos]
+        self.crc32 = 0    # running CRC32 of consumed bytes - reset per object for the .idx
+
+    # pull more bytes from the source until at least n unread bytes are buffered (or the source runs dry)
+    def _fill(self, n):
+        while len(self.buf) - self.pos < n:
+            chunk = self.source.read(self.CHUNK_SIZE)
+            if not chunk:
+                return False
+            if self.pos >= self.CHUNK_SIZE: # dropping consumed bytes before growing the buffer
+                del self.buf[:self.pos]
+                self.pos = 0
+            self.buf += chunk
+        return True
+
+    # marking n buffered bytes as consumed and passing them on to the sinks
+    def _consume(self, n):
+        with memoryview(self.buf)[self.pos:self.pos + n] as data:
+            self.crc32 = zlib.crc32(data, self.crc32)
+            for sink in self.sinks:
+                sink(data)
+        self.pos += n
+        self.offset += n
+
+    # looking at up to n bytes without consuming them - fewer only at the end of the stream
+    def peek(self, n):
+        self._fill(n)
+        return bytes(self.buf[self.pos:self.pos + n])
+
+    def skip(self, n):
+        self._consume(n)
+
+    def read(self, n):
+        if not self._fill(n):
+            raise EOFError("pack stream ended early")
+        data = bytes(self.buf[self.pos:self.pos + n])
+        self._consume(n)
+        return data
+
+    # inflating one zlib stream starting at the current position, consuming exactly its compressed bytes
+    def inflate(self):
+        decompressor = zlib.decompressobj()
+        out = []
+        while not decompressor.eof:
+            if self.pos >= len(self.buf) and not self._fill(1):
+                raise EOFError("pack stream ended inside a compressed object")
+            end = min(len(self.buf), self.pos + self.INFLATE_WINDOW)
+            with memoryview(self.buf)[self.pos:end] as window: # no copy of the buffer, zlib reads it in place
+                out.append(decompressor.decompress(window))
+                used = len(window) - len(decompressor.unused_data)
+            self._consume(used)
+        return b''.join(out)
+
+
+# -------- DELTA BASE CACHE --------
+
+# LRU cache of inflated objects (keyed by pack offset) used as delta bases, bounded by a byte budget.
+# With child_counts (offset -> number of deltas built on it, from a pre-scan of the pack) only real bases are kept,
+# and each one is dropped as soon as its last delta is resolved. An evicted base is simply re-inflated from the pack.
+class DeltaBaseCache:
+    DEFAULT_LIMIT = 96 * 1024 * 1024 # same default as git's core.deltaBaseCacheLimit
+
+    def __init__(self, limit=DEFAULT_LIMIT, child_counts=None):
+        self.limit = limit
+        self.child_counts = child_counts
+        self.entries = OrderedDict() # offset -> (type, content), oldest first
+        self.size = 0
+        self.lock = threading.Lock() # checkout reads packs from several threads
+
+    def get(self, offset):
+        with self.lock:
+            entry = self.entries.get(offset)
+            if entry is not None:
+                self.entries.move_to_end(offset)
+            return entry
+
+    def put(self, offset, obj_type, content):
+        with self.lock:
+            if self.child_counts is not None and not self.child_counts.get(offset):
+                return # nobody deltas against it (any more) - not worth a byte
+            if offset in self.entries or len(content) > self.limit:
+                return
+            self.entries[offset] = (obj_type, content)
+            self.size += len(content)
+            while self.size > self.limit: # evicting least recently used bases
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    # one more delta built on this base is resolved - forgetting the base after its last one
+    def release(self, offset):
+        with self.lock:
+            self.child_counts[offset] -= 1
+            if self.child_counts[offset] == 0:
+                del self.child_counts[offset]
+                entry = self.entries.pop(offset, None)
+                if entry is not None:
+                    self.size -= len(entry[1])
+
+
+# -------- PACK INDEX --------
+
+# A version 2 .idx file sitting next to its .pack - layout:
+#   magic + version | fanout[256] | sorted 20 byte SHAs | CRC32s | 4 byte offsets | 8 byte offsets (only for huge packs) | pack sha | idx sha
+# fanout[b] = number of objects whose SHA's first byte is <= b, so it narrows the binary search to one bucket
+# Both files are mmap'd read-only: a lookup touches only the fanout entry and the few SHA pages the binary search
+# visits, reading an object only the pages of its entry - opening a pack is instant whatever its size, and one
+# mapping serves every thread (no file position to fight over)
+class PackIndex:
+    IDX_MAGIC = b'\xfftOc'
+    IDX_VERSION = 2
+
+    def __init__(self, idx_path: str):
+        self.idx_path = idx_path
+        self.pack_path = idx_path[:-len('.idx')] + '.pack'
+
+        self.data = self.map_file(idx_path)
+
+        if self.data[:4] != self.IDX_MAGIC or struct.unpack('>I', self.data[4:8])[0] != self.IDX_VERSION:
+            raise ValueError(f"{idx_path}: not a version 2 pack index")
+
+        self.fanout = struct.unpack('>256I', self.data[8:8 + 1024])
+        self.count = self.fanout[255]
+        self.sha_start = 8 + 1024
+        self.crc_start = self.sha_start + 20 * self.count
+        self.offset_start = self.crc_start + 4 * self.count
+        self.large_offset_start = self.offset_start + 4 * self.count
+        self.pack_view = None # memoryview of the mapped .pack, mapped on first read
+        self.pack_lock = threading.Lock()
+        self.base_cache = DeltaBaseCache() # recently read objects of this pack, for delta chains
+
+    # read-only memoryview of a whole file - slicing it copies nothing, pages are read in as they are touched
+    @staticmethod
+    def map_file(path: str) -> memoryview:
+        with open(path, 'rb') as f:
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def sha_at(self, i: int) -> bytes:
+        start = self.sha_start + 20 * i
+        return bytes(self.data[start:start + 20]) # a copy - memoryviews don't order
+
+    def crc_at(self, i: int) -> int:
+        return struct.unpack_from('>I', self.data, self.crc_start + 4 * i)[0]
+
+    def offset_at(self, i: int) -> int:
+        offset = struct.unpack_from('>I', self.data, self.offset_start + 4 * i)[0]
+        if offset & 0x80000000: # msb set -> the rest is an index into the 8 byte offset table
+            offset = struct.unpack_from('>Q', self.data, self.large_offset_start + 8 * (offset & 0x7FFFFFFF))[0]
+        return offset
+
+    # binary search inside the fanout bucket of the first SHA byte - returns the pack offset or None
+    def find(self, sha: bytes):
+        first = sha[0]
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_sha = self.sha_at(mid)
+            if mid_sha < sha:
+                lo = mid + 1
+            elif mid_sha > sha:
+                hi = mid
+            else:
+                return self.offset_at(mid)
+        return None
+
+    def pack_data(self) -> memoryview:
+        if self.pack_view is None:
+            with self.pack_lock:
+                if self.pack_view is None:
+                    self.pack_view = PackIndex.map_file(self.pack_path)
+        return self.pack_view
+
+
+# A pack that is still being indexed (pipelined clone) - offsets become known as objects are hashed and their deltas
+# resolved. Looks like a PackIndex to readers, except that find() waits for a sha which is not resolved yet, until
+# indexing is over. The indexing thread itself never waits (it is the one that would have to resolve it).
+class PendingPack:
+    def __init__(self, pack_path: str):
+        self.pack_path = pack_path
+        self.offsets = {} # sha bytes -> offset
+        self.complete = False
+        self.condition = threading.Condition()
+        self.owner = threading.get_ident()
+        self.pack_view = None # mapped once the pack is complete on disk - nobody reads it before
+        self.pack_lock = threading.Lock()
+        self.base_cache = DeltaBaseCache()
+
+    def add(self, pairs):
+        with self.condition:
+            self.offsets.update(pairs)
+            self.condition.notify_all()
+
+    def finish(self):
+        with self.condition:
+            self.complete = True
+            self.condition.notify_all()
+
+    def find(self, sha: bytes):
+        with self.condition:
+            while True:
+                offset = self.offsets.get(sha)
+                if offset is not None or self.complete or threading.get_ident() == self.owner:
+                    return offset
+                self.condition.wait()
+
+    pack_data = PackIndex.pack_data
+
+
+# -------- COMMIT GRAPH --------
+
+# Reader of .git/objects/info/commit-graph (git's format, version 1) - a sorted sha table plus one fixed width record
+# per commit: tree sha, the positions of its first two parents, its generation number and commit time. Ancestry
+# walks answer from here without inflating a single commit. Generation = 1 + the highest generation of the parents,
+# so a commit can never reach one with a bigger generation - that is what lets the walks stop early.
+class CommitGraph:
+    SIGNATURE = b'CGPH'
+    VERSION = 1
+    CHUNK_FANOUT = b'OIDF'
+    CHUNK_OIDS = b'OIDL'
+    CHUNK_DATA = b'CDAT'
+    CHUNK_EDGES = b'EDGE'
+    RECORD_SIZE = 36            # tree sha + parent 1 + parent 2 + generation/time
+    PARENT_NONE = 0x70000000
+    EXTRA_EDGES = 0x80000000    # parent 2 field of an octopus merge: index into EDGE, the last one has this bit set
+    MAX_GENERATION = 0x3FFFFFFF # 30 bits, the top 2 bits of the word belong to the commit time
+
+    def __init__(self, path: str):
+        self.data = PackIndex.map_file(path)
+        if self.data[:4] != self.SIGNATURE or self.data[4] != self.VERSION:
+            raise ValueError(f"{path}: not a version 1 commit graph")
+
+        self.chunks = {}
+        chunk_count = self.data[6]
+        for i in range(chunk_count):
+            chunk_id, start = struct.unpack_from('>4sQ', self.data, 8 + 12 * i)
+            self.chunks[chunk_id] = start
+
+        self.fanout = struct.unpack_from('>256I', self.data, self.chunks[self.CHUNK_FANOUT])
+        self.count = self.fanout[255]
+        self.sha_start = self.chunks[self.CHUNK_OIDS]
+        self.data_start = self.chunks[self.CHUNK_DATA]
+        self.edge_start = self.chunks.get(self.CHUNK_EDGES)
+
+    def sha_at(self, i: int) -> bytes:
+        start = self.sha_start + 20 * i
+        return bytes(self.data[start:start + 20])
+
+    # same fanout + binary search as PackIndex.find - returns the position or None
+    def find(self, sha: bytes):
+        first = sha[0]
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_sha = self.sha_at(mid)
+            if mid_sha < sha:
+                lo = mid + 1
+            elif mid_sha > sha:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    # (tree sha, parent positions, generation, commit time) of the commit at position i
+    def commit_at(self, i: int):
+        start = self.data_start + self.RECORD_SIZE * i
+        tree = bytes(self.data[start:start + 20])
+        parent1, parent2, generation, time_low = struct.unpack_from('>IIII', self.data, start + 20)
+
+        parents = []
+        if parent1 != self.PARENT_NONE:
+            parents.append(parent1)
+        if parent2 & self.EXTRA_EDGES and parent2 != self.PARENT_NONE:
+            edge = self.edge_start + 4 * (parent2 & ~self.EXTRA_EDGES)
+            while True:
+                parent = struct.unpack_from('>I', self.data, edge)[0]
+                parents.append(parent & ~self.EXTRA_EDGES)
+                if parent & self.EXTRA_EDGES:
+                    break
+                edge += 4
+        elif parent2 != self.PARENT_NONE:
+            parents.append(parent2)
+
+        return tree, parents, generation >> 2, ((generation & 0x3) << 32) | time_low
+
+
+# -------- DELTA ENCODER --------
+
+# The other direction of _apply_delta: builds copy/insert instructions turning a base into a target.
+# The base is indexed once (its 16 byte blocks at 16 byte steps -> first offset) and reused for every target tried
+# against it. The target is scanned byte by byte - a block found in the base is extended forwards (and backwards
+# into the pending literal bytes) as far as both agree and becomes a copy, everything else is inserted literally.
+class DeltaIndex:
+    BLOCK = 16
+    MAX_COPY = 0x10000    # largest copy per instruction (encoded as size 0)
+    MAX_INSERT = 0x7F     # largest literal run per instruction
+    SAMPLES = 32          # target stretches sampled to estimate the delta size before a full scan
+    ESTIMATE_MIN = 4096   # smaller targets are scanned right away, the estimate would be too coarse
+
+    def __init__(self, base: bytes):
+        self.base = base
+        block = self.BLOCK
+        # built backwards so the first offset of a repeated block wins
+        self.blocks = {base[offset:offset + block]: offset for offset in range((len(base) - block) // block * block, -1, -block)}
+
+    @staticmethod
+    def _varint(value: int) -> bytes:
+        out = bytearray()
+        while value >= 0x80:
+            out.append((value & 0x7F) | 0x80)
+            value >>= 7
+        out.append(value)
+        return bytes(out)
+
+    # how far base[base_offset:] and target[target_offset:] agree - the first BLOCK bytes are known to.
+    # galloping: doubling strides while equal, then halving back down - bytes slices, they compare with memcmp
+    # (memoryview == goes element by element)
+    def _match_length(self, base_offset, target, target_offset, limit):
+        base = self.base
+        length = self.BLOCK
+        step = 64
+        while length + step <= limit and base[base_offset + length:base_offset + length + step] == target[target_offset + length:target_offset + length + step]:
+            length += step
+            step <<= 1
+        while step > 1:
+            step >>= 1
+            if length + step <= limit and base[base_offset + length:base_offset + length + step] == target[target_offset + length:target_offset + length + step]:
+                length += step
+        return length
+
+    def _insert(self, out, literal):
+        for start in range(0, len(literal), self.MAX_INSERT):
+            chunk = literal[start:start + self.MAX_INSERT]
+            out.append(len(chunk))
+            out += chunk
+
+    def _copy(self, out, offset, size):
+        while size:
+            chunk = min(size, self.MAX_COPY)
+            command = 0x80
+            args = bytearray()
+            for i in range(4): # offset bytes present only when non zero
+                byte = (offset >> (8 * i)) & 0xFF
+                if byte:
+                    command |= 1 << i
+                    args.append(byte)
+            if chunk != self.MAX_COPY: # all size bytes absent means 0x10000
+                for i in range(3):
+                    byte = (chunk >> (8 * i)) & 0xFF
+                    if byte:
+                        command |= 0x10 << i
+                        args.append(byte)
+            out.append(command)
+            out += args
+            offset += chunk
+            size -= chunk
+
+    # delta instructions for target, or None as soon as they would not fit in max_size
+    def create_delta(self, target: bytes, max_size=None):
+        block = self.BLOCK
+        blocks = self.blocks
+        target_len = len(target)
+        last = target_len - block
+        if last < 0 or not blocks:
+            return None
+        target_view = memoryview(target)
+        base = self.base
+
+        # cheap size estimate first, from a few samples of the target: a stretch whose match runs L bytes costs about
+        # one 4 byte copy per L bytes, a stretch with no match (none of its 16 alignments is a base block) costs itself
+        step = max(1, last // self.SAMPLES)
+        estimate = 0
+        for start in range(0, last + 1, step) if target_len >= self.ESTIMATE_MIN and max_size is not None else ():
+            for i in range(start, min(start + block, last + 1)):
+                offset = blocks.get(target[i:i + block])
+                if offset is not None:
+                    length = self._match_length(offset, target, i, min(len(base) - offset, target_len - i, step))
+                    estimate += min(step, 4 * step // length + 4)
+                    break
+            else:
+                estimate += step
+            if estimate > 2 * max_size: # way off already - not worth the full scan
+                return None
+
+        out = bytearray(self._varint(len(self.base)) + self._varint(target_len))
+        literal_start = 0 # target bytes from here up to i are still waiting to be inserted
+        i = 0
+        while i <= last:
+            best_offset = blocks.get(target[i:i + block])
+            if best_offset is None:
+                i += 1
+                if not i & 0xFF and max_size is not None and len(out) + i - literal_start > max_size: # checked now and then
+                    return None
+                continue
+
+            best_length = self._match_length(best_offset, target, i, min(len(base) - best_offset, target_len - i))
+            while best_offset and i > literal_start and base[best_offset - 1] == target[i - 1]: # growing backwards
+                best_offset -= 1
+                i -= 1
+                best_length += 1
+
+            self._insert(out, target_view[literal_start:i])
+            self._copy(out, best_offset, best_length)
+            i += best_length
+            literal_start = i
+            if max_size is not None and len(out) > max_size:
+                return None
+
+        self._insert(out, target_view[literal_start:])
+        if max_size is not None and len(out) > max_size:
+            return None
+        return bytes(out)
+
+
+# -------- SMART HTTP TRANSPORT --------
+
+# Reads one upload-pack response as pkt-lines. Once the pack starts, the side-band-64k channels are split on the fly:
+# read() hands out only band 1 (pack bytes) so it can feed PackStream directly, band 2 (progress) goes to stderr and
+# band 3 is the remote dying on us. A server without side-band sends the raw pack, which read() passes through.
+class PktLineStream:
+    FLUSH, DELIM, RESPONSE_END = 0, 1, 2 # special pkt-lines (v2 adds delim and response-end)
+    PACK = 3                             # raw pack data starts here (no side-band)
+
+    def __init__(self, source, progress=False):
+        self.source = source
+        self.progress = progress
+        self.band = memoryview(b'') # band 1 payload not handed out yet
+        self.pos = 0
+        self.raw = False
+        self.pending = None         # first side-band packet, seen while still reading plain lines
+
+    def _read_exact(self, n):
+        data = self.source.read(n)
+        while len(data) < n:
+            more = self.source.read(n - len(data))
+            if not more:
+                raise EOFError("connection closed inside a pkt-line")
+            data += more
+        return data
+
+    # next pkt-line payload, or one of the FLUSH / DELIM / RESPONSE_END / PACK codes - None at the end of the response
+    def read_pkt(self):
+        length_hex = self.source.read(4)
+        if not length_hex:
+            return None
+        if len(length_hex) < 4:
+            length_hex += self._read_exact(4 - len(length_hex))
+        if length_hex == b'PACK':
+            self.band, self.pos, self.raw = memoryview(b'PACK'), 0, True
+            return PktLineStream.PACK
+        length = int(length_hex, 16)
+        if length < 4:
+            return length
+        return self._read_exact(length - 4)
+
+    # pack bytes - up to n of them, b'' once the pack is over
+    def read(self, n):
+        while self.pos >= len(self.band):
+            if self.raw:
+                return self.source.read(n)
+            payload, self.pending = self.pending or self.read_pkt(), None
+            if not isinstance(payload, bytes):
+                return b'' # flush (or the end of the response) closes the pack
+            channel = payload[0]
+            if channel == 1:
+                self.band, self.pos = memoryview(payload), 1
+            elif channel == 2:
+                if self.progress:
+                    sys.stderr.write("remote: " + payload[1:].decode('utf-8', 'replace'))
+            elif channel == 3:
+                raise ValueError(f"remote error: {payload[1:].decode('utf-8', 'replace').strip()}")
+            else:
+                raise ValueError(f"unexpected side-band channel {channel}")
+        data = self.band[self.pos:self.pos + n]
+        self.pos += len(data)
+        return data
+
+
+# One keep-alive HTTP(S) connection to a remote, shared by ref discovery, every negotiation round and the pack request
+# (urllib would open a new connection - TCP and TLS handshake - for each of them). Asks for protocol v2 and falls back
+# to v0 when the server answers in v0; with v2 the refs come from ls-refs, filtered down to the prefixes we need.
+class SmartHttpTransport:
+    USER_AGENT = 'git/2.0.0'
+    MAX_REDIRECTS = 5
+    V2_FETCH_FEATURES = {'side-band-64k', 'ofs-delta', 'thin-pack', 'no-progress'} # always there with v2 fetch
+
+    def __init__(self, repo_url, protocol_version=2):
+        self.repo_url = repo_url.rstrip('/')
+        self.protocol_version = protocol_version # what we ask for - drops to 0 if the server does not speak v2
+        self.capabilities = {}                   # name -> value (None for bare names)
+        self.progress = sys.stderr.isatty()
+        self.connection = None
+        self.response = None                     # last response - drained before the connection is reused
+        self.trace = None                        # PerfTrace counting the bytes downloaded, when tracing
+
+    # pkt-line: 4 hex digits of length (including themselves), then the payload
+    @staticmethod
+    def pkt_line(content: bytes) -> bytes:
+        return f"{len(content) + 4:04x}".encode('ascii') + content
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+        self.connection = self.response = None
+
+    def supports(self, name: str) -> bool:
+        if self.protocol_version == 2:
+            return name in self.V2_FETCH_FEATURES or name in (self.capabilities.get('fetch') or '').split()
+        return name in self.capabilities
+
+    # one HTTP request on the shared connection - reconnecting once if the server dropped the idle connection
+    def _request(self, method, path, body=None, headers=None):
+        import http.client, urllib.parse
+        headers = dict(headers or {}, **{'User-Agent': self.USER_AGENT})
+        if self.protocol_version == 2:
+            headers['Git-Protocol'] = 'version=2'
+
+        for redirect in range(self.MAX_REDIRECTS + 1):
+            if self.response is not None: # the connection is only free again once the last response is fully read
+                self.response.read()
+                if self.response.will_close:
+                    self.close()
+            self.response = None
+
+            url = urllib.parse.urlsplit(self.repo_url + path)
+            for attempt in range(2):
+                reused = self.connection is not None
+                if not reused:
+                    connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+                    self.connection = connection_class(url.netloc)
+                try:
+                    self.connection.request(method, url.path + ('?' + url.query if url.query else ''), body=body, headers=headers)
+                    self.response = self.connection.getresponse()
+                    break
+                except (http.client.RemoteDisconnected, ConnectionError):
+                    self.close()
+                    if not reused or attempt:
+                        raise
+
+            status = self.response.status
+            if status in (301, 302, 303, 307, 308) and path.partition('?')[0] in self.response.getheader('Location', ''):
+                # moved repository - remembering the new base url for the following requests too
+                location = urllib.parse.urljoin(self.repo_url + path, self.response.getheader('Location'))
+                self.repo_url = location[:location.index(path.partition('?')[0])]
+                continue
+            if status != 200:
+                self.response.read()
+                raise OSError(f"HTTP {status} {self.response.reason} for {self.repo_url + path}")
+            if self.trace is not None:
+                self.response.read = self.trace.wrap('network read', self.response.read, 'bytes downloaded')
+            return self.response
+        raise OSError(f"too many redirects for {self.repo_url}")
+
+    # GET info/refs - the capabilities, then the refs (v0 lists them right there, v2 needs an ls-refs request)
+    # returns {ref name: sha hex}, HEAD included
+    def discover_refs(self, prefixes=('HEAD', 'refs/heads/')):
+        stream = PktLineStream(self._request('GET', '/info/refs?service=git-upload-pack'))
+        lines = []
+        while (pkt := stream.read_pkt()) is not None:
+            if isinstance(pkt, bytes) and not pkt.startswith(b'# service='):
+                lines.append(pkt.rstrip(b'\n'))
+
+        if lines and lines[0] == b'version 2':
+            for line in lines[1:]:
+                name, _, value = line.decode('ascii').partition('=')
+                self.capabilities[name] = value or None
+            return self.ls_refs(prefixes)
+
+        self.protocol_version = 0
+        refs = {}
+        for index, line in enumerate(lines):
+            if line.startswith(b'ERR '):
+                raise ValueError(f"remote error: {line[4:].decode('utf-8', 'replace')}")
+            ref_line, _, capabilities = line.partition(b'\x00')
+            if index == 0: # capabilities ride after the NUL of the first ref line
+                for capability in capabilities.decode('ascii').split():
+                    name, _, value = capability.partition('=')
+                    self.capabilities[name] = value or None
+            sha, _, name = ref_line.partition(b' ')
+            if name != b'capabilities^{}': # what an empty repository advertises
+                refs[name.decode('utf-8')] = sha.decode('ascii')
+        return refs
+
+    # v2 ls-refs - only the refs under the given prefixes are sent (a repo with 100k tags costs nothing extra)
+    def ls_refs(self, prefixes):
+        arguments = [b'symrefs\n'] + [f"ref-prefix {prefix}\n".encode('utf-8') for prefix in prefixes]
+        refs = {}
+        for line in self.command(b'ls-refs', arguments)[0]:
+            sha, _, rest = line.rstrip(b'\n').partition(b' ')
+            refs[rest.split(b' ')[0].decode('utf-8')] = sha.decode('ascii')
+        return refs
+
+    # v2 request - "command=<name>", our capabilities, delim, arguments, flush
+    def command(self, name, arguments):
+        body = self.pkt_line(b'command=' + name + b'\n')
+        if 'agent' in self.capabilities:
+            body += self.pkt_line(f"agent={self.USER_AGENT}\n".encode('ascii'))
+        body += b'0001' + b''.join(self.pkt_line(argument) for argument in arguments) + b'0000'
+        return self.upload_pack(body)
+
+    # POST git-upload-pack - returns (plain pkt-lines before the pack, PktLineStream positioned at the pack or None)
+    def upload_pack(self, body: bytes):
+        response = self._request('POST', '/git-upload-pack', body, {
+            'Content-Type': 'application/x-git-upload-pack-request',
+            'Accept': 'application/x-git-upload-pack-result',
+        })
+        stream = PktLineStream(response, self.progress)
+        lines = []
+        while (pkt := stream.read_pkt()) is not None:
+            if pkt == PktLineStream.PACK:
+                return lines, stream
+            if not isinstance(pkt, bytes):
+                continue # flush / delim between sections
+            if pkt[0] in (1, 2, 3): # side-band has started - the pack (and progress) follow
+                stream.pending = pkt
+                return lines, stream
+            if pkt.startswith(b'ERR '):
+                raise ValueError(f"remote error: {pkt[4:].decode('utf-8', 'replace').strip()}")
+            lines.append(pkt.rstrip(b'\n'))
+        return lines, None
+
+
+# -------- PIPELINE --------
+
+# The stages of receiving a pack run on their own threads, joined by bounded queues: network reads -> parse and
+# inflate (the caller's thread) -> hashing, and -> disk writes. zlib, hashlib and file/socket I/O release the GIL, so
+# the stages really overlap, and the queue bounds keep memory flat - a stage only waits when the next one is full.
+
+# Per-stage busy time, items and bytes, for the throughput report (clone --stats)
+class PipelineStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {} # name -> [seconds, items, bytes], in the order first seen
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds, items=0, nbytes=0):
+        with self.lock:
+            totals = self.stages.setdefault(stage, [0.0, 0, 0])
+            totals[0] += seconds
+            totals[1] += items
+            totals[2] += nbytes
+
+    def report(self, out=None):
+        out = out or sys.stderr
+        wall = time.perf_counter() - self.started
+        for stage, (seconds, items, nbytes) in self.stages.items():
+            line = f"{stage:<10} {seconds:8.3f}s busy"
+            if items:
+                line += f"  {items:>9} items {items / max(seconds, 1e-9):>11.0f}/s"
+            if nbytes:
+                line += f"  {nbytes / 1e6:>9.1f} MB {nbytes / 1e6 / max(seconds, 1e-9):>9.1f} MB/s"
+            print(line, file=out)
+        print(f"{'total':<10} {wall:8.3f}s wall", file=out)
+
+
+# A thread pulling a source (read(n)) into a bounded queue of chunks - the network keeps downloading while the
+# parser is busy inflating. wait is how long the reading side spent blocked on the network.
+class PrefetchReader:
+    QUEUE_DEPTH = 64 # chunks in flight (64 x 64K = 4 MiB)
+
+    def __init__(self, source, chunk_size, stats=None):
+        self.source = source
+        self.chunk_size = chunk_size
+        self.stats = stats
+        self.queue = queue.Queue(maxsize=self.QUEUE_DEPTH)
+        self.chunk = b''
+        self.wait = 0.0
+        threading.Thread(target=self._run, name='network', daemon=True).start()
+
+    def _run(self):
+        busy = 0.0
+        total = 0
+        try:
+            while True:
+                started = time.perf_counter()
+                chunk = self.source.read(self.chunk_size)
+                busy += time.perf_counter() - started
+                total += len(chunk)
+                self.queue.put(chunk)
+                if not chunk:
+                    break
+        except BaseException as e: # handed over to the reading side
+            self.queue.put(e)
+        if self.stats:
+            self.stats.add('network', busy, 0, total)
+
+    def read(self, n):
+        if not self.chunk:
+            started = time.perf_counter()
+            chunk = self.queue.get()
+            self.wait += time.perf_counter() - started
+            if isinstance(chunk, BaseException):
+                self.queue.put(chunk) # every later read fails the same way
+                raise chunk
+            if not chunk:
+                self.queue.put(chunk) # end of stream stays the end
+                return b''
+            self.chunk = chunk
+        data, self.chunk = self.chunk[:n], self.chunk[n:]
+        return data
+
+
+# A worker thread handling items in batches - put() gathers items until batch_bytes, then queues the batch
+# (handing single small objects across threads would cost more than the work). close() drains it and re-raises
+# whatever the worker hit.
+class PipelineStage:
+    QUEUE_DEPTH = 16
+    BATCH_BYTES = 1024 * 1024
+
+    def __init__(self, name, handle, stats=None):
+        self.name = name
+        self.handle = handle
+        self.stats = stats
+        self.queue = queue.Queue(maxsize=self.QUEUE_DEPTH)
+        self.batch = []
+        self.batch_bytes = 0
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def put(self, item, nbytes):
+        self.batch.append(item)
+        self.batch_bytes += nbytes
+        if self.batch_bytes >= self.BATCH_BYTES:
+            self._flush()
+
+    def _flush(self):
+        if self.error is not None:
+            raise self.error
+        if self.batch:
+            self.queue.put((self.batch, self.batch_bytes))
+            self.batch = []
+            self.batch_bytes = 0
+
+    def _run(self):
+        while (work := self.queue.get()) is not None:
+            if self.error is not None:
+                continue # still draining, so put() never blocks on a dead stage
+            batch, nbytes = work
+            started = time.perf_counter()
+            try:
+                self.handle(batch)
+            except BaseException as e:
+                self.error = e
+            if self.stats:
+                self.stats.add(self.name, time.perf_counter() - started, len(batch), nbytes)
+
+    def close(self):
+        try:
+            self._flush()
+        finally:
+            self.queue.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+# -------- PERF TRACE --------
+
+# Per-phase wall and CPU time, counters and histograms for one command (GIT_TRACE_PERFORMANCE=1 or --trace-perf).
+# When tracing is off there is no PerfTrace at all: the hot methods are only wrapped (on the Git instance) once one
+# exists, and everything else checks `trace is not None` at most once per phase, never per byte.
+class PerfTrace:
+    ENV_VAR = 'GIT_TRACE_PERFORMANCE'
+    # Git methods timed per call while tracing - (method, phase, counter fed with the length of what it returns)
+    INSTRUMENTED = (
+        ('_inflate_at', 'inflate (pack)', 'bytes inflated'),
+        ('_get_object_content', 'inflate (loose)', 'bytes inflated'),
+        ('_apply_delta', 'apply delta', None),
+        ('_write_object', 'write object', None),
+        ('_checkout_file', 'checkout file', None),
+    )
+
+    def __init__(self, path=None):
+        self.path = path      # JSON lines appended here, None for the summary on stderr
+        self.started = (time.perf_counter(), time.process_time())
+        self.phases = {}      # name -> [wall seconds, cpu seconds, calls, bytes], in the order first seen
+        self.counters = {}    # name -> total
+        self.histograms = {}  # name -> {value: times seen}
+        self.lock = threading.Lock()
+
+    # GIT_TRACE_PERFORMANCE: unset / 0 / false -> off, 1 / 2 / true -> stderr, an absolute path -> JSON lines there
+    @classmethod
+    def from_env(cls):
+        value = os.environ.get(cls.ENV_VAR, '')
+        if value.lower() in ('', '0', 'false', 'no', 'off'):
+            return None
+        return cls(value if os.path.isabs(value) else None)
+
+    def add(self, name, wall, cpu, calls=1, nbytes=0):
+        with self.lock:
+            totals = self.phases.setdefault(name, [0.0, 0.0, 0, 0])
+            totals[0] += wall
+            totals[1] += cpu
+            totals[2] += calls
+            totals[3] += nbytes
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, histogram, value):
+        with self.lock:
+            buckets = self.histograms.setdefault(histogram, {})
+            buckets[value] = buckets.get(value, 0) + 1
+
+    # a stretch of one command - CPU is the whole process's, so the worker threads busy meanwhile count too
+    @contextlib.contextmanager
+    def phase(self, name):
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+    # func timed on every call (CPU of the calling thread only), counter gets the length of each result
+    def wrap(self, name, func, counter=None):
+        def traced(*args, **kwargs):
+            wall, cpu = time.perf_counter(), time.thread_time()
+            result = func(*args, **kwargs)
+            if counter is not None and result is None: # a miss (no loose file, the packs are asked next) - nothing inflated
+                return result
+            nbytes = len(result) if counter is not None else 0
+            self.add(name, time.perf_counter() - wall, time.thread_time() - cpu, 1, nbytes)
+            if nbytes:
+                self.count(counter, nbytes)
+            return result
+        return traced
+
+    def instrument(self, git):
+        for method, name, counter in self.INSTRUMENTED:
+            setattr(git, method, self.wrap(name, getattr(git, method), counter))
+
+    # back to the plain methods - the daemon's Git outlives one traced command
+    def restore(self, git):
+        for method, _, _ in self.INSTRUMENTED:
+            git.__dict__.pop(method, None)
+
+    def report(self, command):
+        wall = time.perf_counter() - self.started[0]
+        cpu = time.process_time() - self.started[1]
+        if self.path is not None:
+            records = [{'type': 'command', 'name': command, 'wall': wall, 'cpu': cpu}]
+            records += [{'type': 'phase', 'name': name, 'wall': phase_wall, 'cpu': phase_cpu, 'calls': calls, 'bytes': nbytes}
+                        for name, (phase_wall, phase_cpu, calls, nbytes) in self.phases.items()]
+            records += [{'type': 'counter', 'name': name, 'value': value} for name, value in self.counters.items()]
+            records += [{'type': 'histogram', 'name': name, 'buckets': {str(value): n for value, n in sorted(buckets.items())}}
+                        for name, buckets in self.histograms.items()]
+            with open(self.path, 'a') as f:
+                f.writelines(json.dumps(dict(record, command=command, pid=os.getpid())) + '\n' for record in records)
+            return
+
+        out = sys.stderr
+        print(f"perf: {command}  {wall:.3f}s wall  {cpu:.3f}s cpu", file=out)
+        for name, (phase_wall, phase_cpu, calls, nbytes) in self.phases.items():
+            line = f"  {name:<20} {phase_wall:9.3f}s wall {phase_cpu:9.3f}s cpu"
+            if calls > 1:
+                line += f"  {calls:>9} calls"
+            if nbytes:
+                line += f"  {nbytes / 1e6:>9.1f} MB"
+            print(line, file=out)
+        for name, value in self.counters.items():
+            print(f"  {name:<40} {value:>12}", file=out)
+        for name, buckets in self.histograms.items():
+            print(f"  {name}: " + '  '.join(f"{value}:{n}" for value, n in sorted(buckets.items())), file=out)
+
+
+# -------- INDEX (.git/index) --------
+
+# DIRCACHE version 2 - header | entries sorted by path | TREE extension | sha1 of all of it
+# each entry: ctime, mtime (sec + nsec), dev, ino, mode, uid, gid, size (10 x 32 bit) | sha (20) | flags (16 bit) | path | NUL padding to 8 bytes
+# here it is a stat cache first - a file whose stat data still matches its entry keeps its cached sha, no rehash
+class GitIndex:
+    SIGNATURE = b'DIRC'
+    VERSION = 2
+    TREE_EXTENSION = b'TREE'
+    ENTRY_HEADER = struct.Struct('>10I20sH')
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}     # path -> (10 stat fields, sha bytes)
+        self.trees = {}       # directory path ('' for root) -> (entry count, subtree count, sha bytes) - the TREE extension
+        self.mtime_ns = None  # index file mtime - entries modified at/after it are racily clean and not trusted
+
+    @classmethod
+    def read(cls, path: str):
+        index = cls(path)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            index.mtime_ns = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return index # no index yet - empty cache
+
+        if data[:4] != cls.SIGNATURE or hashlib.sha1(data[:-20]).digest() != data[-20:]:
+            print(f"warning: ignoring corrupt index {path}", file=sys.stderr)
+            return cls(path)
+
+        version, count = struct.unpack('>II', data[4:12])
+        pos = 12
+        for _ in range(count):
+            *stat_fields, sha, flags = cls.ENTRY_HEADER.unpack_from(data, pos)
+            path_start = pos + cls.ENTRY_HEADER.size
+            path_end = data.index(b'\x00', path_start)
+            index.entries[data[path_start:path_end].decode('utf-8')] = (tuple(stat_fields), sha)
+            pos += (path_end - pos + 8) // 8 * 8 # entry length padded with 1-8 NULs
+
+        # extensions - 4 byte signature, 4 byte size, data; only TREE is understood, the rest is skipped
+        while pos < len(data) - 20:
+            signature = data[pos:pos + 4]
+            size = struct.unpack('>I', data[pos + 4:pos + 8])[0]
+            if signature == cls.TREE_EXTENSION:
+                index._parse_trees(data[pos + 8:pos + 8 + size])
+            pos += 8 + size
+
+        return index
+
+    # TREE records come in pre-order: name NUL entry_count SP subtree_count LF [sha if entry_count >= 0]
+    def _parse_trees(self, data: bytes):
+        pos = 0
+        parents = [] # stack of (directory path, children still to read)
+        while pos < len(data):
+            null_ind = data.index(b'\x00', pos)
+            name = data[pos:null_ind].decode('utf-8')
+            newline_ind = data.index(b'\n', null_ind)
+            entry_count, subtree_count = (int(n) for n in data[null_ind + 1:newline_ind].split(b' '))
+            pos = newline_ind + 1
+
+            while parents and parents[-1][1] == 0:
+                parents.pop()
+            if parents:
+                parent_path, remaining = parents[-1]
+                parents[-1] = (parent_path, remaining - 1)
+                tree_path = parent_path + '/' + name if parent_path else name
+            else:
+                tree_path = name
+
+            if entry_count >= 0:
+                self.trees[tree_path] = (entry_count, subtree_count, data[pos:pos + 20])
+                pos += 20
+            parents.append((tree_path, subtree_count))
+
+    def write(self):
+        parts = [self.SIGNATURE, struct.pack('>II', self.VERSION, len(self.entries))]
+        for path in sorted(self.entries, key=lambda p: p.encode('utf-8')):
+            stat_fields, sha = self.entries[path]
+            path_bytes = path.encode('utf-8')
+            entry = self.ENTRY_HEADER.pack(*stat_fields, sha, min(len(path_bytes), 0xFFF)) + path_bytes
+            parts.append(entry + b'\x00' * (8 - len(entry) % 8))
+
+        tree_data = self._format_trees()
+        if tree_data:
+            parts.append(self.TREE_EXTENSION + struct.pack('>I', len(tree_data)) + tree_data)
+
+        data = b''.join(parts)
+        tmp_path = self.path + '.lock'
+        with open(tmp_path, 'wb') as f:
+            f.write(data + hashlib.sha1(data).digest())
+        os.replace(tmp_path, self.path)
+
+    # pre-order dump of the cached trees - directories whose own tree is not cached get -1 so their children still fit
+    def _format_trees(self) -> bytes:
+        if not self.trees:
+            return b''
+        children = {}
+        for tree_path in self.trees:
+            while tree_path:
+                parent_path = tree_path.rpartition('/')[0]
+                kids = children.setdefault(parent_path, set())
+                if tree_path in kids:
+                    break
+                kids.add(tree_path)
+                tree_path = parent_path
+
+        out = []
+        pending = ['']
+        while pending:
+            tree_path = pending.pop()
+            kids = sorted(children.get(tree_path, ()))
+            name = tree_path.rpartition('/')[2].encode('utf-8')
+            cached = self.trees.get(tree_path)
+            if cached is not None:
+                out.append(b'%s\x00%d %d\n%s' % (name, cached[0], len(kids), cached[2]))
+            else:
+                out.append(b'%s\x00-1 %d\n' % (name, len(kids)))
+            pending.extend(reversed(kids))
+        return b''.join(out)
+
+    # the 10 stat fields git keeps, all truncated to 32 bits
+    @staticmethod
+    def stat_fields(st, mode: int):
+        return tuple(value & 0xFFFFFFFF for value in (
+            int(st.st_ctime), st.st_ctime_ns % 1_000_000_000,
+            int(st.st_mtime), st.st_mtime_ns % 1_000_000_000,
+            st.st_dev, st.st_ino, mode, st.st_uid, st.st_gid, st.st_size,
+        ))
+
+    # the (stat fields, sha) entry for path if the file's stat data is unchanged since it was recorded, else None
+    def cached_entry(self, path: str, st):
+        entry = self.entries.get(path)
+        if entry is None:
+            return None
+        stat_fields = entry[0]
+        # dev/uid/gid are left out like core.checkStat=minimal would - they do not change for a file's content
+        if (stat_fields[2] != int(st.st_mtime) & 0xFFFFFFFF or stat_fields[3] != st.st_mtime_ns % 1_000_000_000
+                or stat_fields[0] != int(st.st_ctime) & 0xFFFFFFFF or stat_fields[1] != st.st_ctime_ns % 1_000_000_000
+                or stat_fields[9] != st.st_size & 0xFFFFFFFF or stat_fields[5] != st.st_ino & 0xFFFFFFFF):
+            return None
+        if self.mtime_ns is None or st.st_mtime_ns >= self.mtime_ns: # racily clean - could have changed within the same tick
+            return None
+        return entry
+
+    # cached sha for path if its stat data and mode are unchanged, else None
+    def cached_sha(self, path: str, st, mode: int):
+        entry = self.cached_entry(path, st)
+        if entry is None or entry[0][6] != mode:
+            return None
+        return entry[1]
+
+    def update(self, path: str, st, mode: int, sha: bytes):
+        self.entries[path] = (self.stat_fields(st, mode), sha)
+        self.invalidate(path)
+
+    # a changed path makes the cached tree of every directory above it stale
+    def invalidate(self, path: str):
+        while path:
+            path = path.rpartition('/')[0]
+            self.trees.pop(path, None)
+
 
 class Git:
     # hard coding - reusability - ALL_CAPS - convention variable name
@@ -22,9 +1078,62 @@ class Git:
     OBJ_TAG = 4
     OBJ_OFS_DELTA = 6 
     OBJ_REF_DELTA = 7
-
-    def __init__(self, git_dir = '.git'):
+    NULL_SHA = b'\x00' * 20
+
+    TYPE_NAMES = {
+        OBJ_COMMIT: "commit",
+        OBJ_TREE: "tree",
+        OBJ_BLOB: "blob",
+        OBJ_TAG: "tag",
+    }
+
+    PACK_DIR = 'pack'
+    INDEX_FILE = 'index'
+    SHALLOW_FILE = 'shallow'
+    PACKED_REFS_FILE = 'packed-refs'
+    CONFIG_FILE = 'config'
+    COMMIT_GRAPH_FILE = os.path.join('info', 'commit-graph') # under objects/
+
+    PARALLEL_DELTA_THRESHOLD = 1000 # fewer deltas than this are resolved in-process
+    PACK_REUSE_CHUNK = 1024 * 1024 # bytes of a reused pack sent at a time
+
+    CHECKOUT_WORKERS = 8              # threads writing files during checkout
+    HASH_WORKERS = os.cpu_count() or 1 # threads hashing + compressing blobs in write-tree
+    BLOB_CHUNK_SIZE = 1024 * 1024      # files bigger than this are hashed + compressed as a stream
+    HEADER_WINDOW = 64                 # compressed bytes read to get at an object's header
+    OBJECT_CACHE_LIMIT = 32 * 1024 * 1024 # byte budget of the recently read objects cache
+    LAZY_FETCH_BATCH = 1000            # missing blobs asked for per request in a partial clone
+    MAX_HAVES_IN_VAIN = 256            # fetch negotiation gives up after this many haves with no new common commit
+    CHECKOUT_BUFFER_SIZE = 64 * 1024  # per worker read buffer for loose objects
+    TREE_CACHE_LIMIT = 4096            # parsed trees kept by _parse_tree
+
+    MODE_TREE = 0o40000
+    MODE_SYMLINK = 0o120000
+    MODE_GITLINK = 0o160000
+    MODE_TYPES = {0o100644: b'blob', 0o100755: b'blob', MODE_SYMLINK: b'blob', MODE_TREE: b'tree', MODE_GITLINK: b'commit'}
+    LS_TREE_PREFIXES = {mode: b'%06o %s ' % (mode, obj_type) for mode, obj_type in MODE_TYPES.items()} # "<mode> <type> "
+
+    def __init__(self, git_dir = '.git', delta_base_cache_limit = DeltaBaseCache.DEFAULT_LIMIT, jobs = None, checkout_workers = CHECKOUT_WORKERS, hash_workers = HASH_WORKERS, protocol_version = 2):
         self.git_dir = git_dir
+        self.delta_base_cache_limit = delta_base_cache_limit # byte budget for delta bases while indexing a pack
+        self.jobs = jobs or os.cpu_count() or 1 # worker processes for delta resolution
+        self.checkout_workers = checkout_workers
+        self.hash_workers = hash_workers
+        self._checkout_local = threading.local() # holds each checkout worker's preallocated buffer
+        self._object_cache = DeltaBaseCache(Git.OBJECT_CACHE_LIMIT) # same byte-bounded LRU, keyed by sha -> (None, object bytes)
+        self._packs = None # PackIndex list of .git/objects/pack, loaded on first use
+        self.protocol_version = protocol_version # wire protocol asked for - v0 is used when the server has no v2
+        self._transports = {} # remote url -> SmartHttpTransport, so one connection serves all requests to it
+        self._pending_pack = None # PendingPack being indexed while checkout already reads from it
+        self.stats = None # PipelineStats when clone --stats asked for a per-stage report
+        self._commit_graph = None # CommitGraph of objects/info/commit-graph, False when there is none
+        self._commit_nodes = {} # commit sha -> (tree, parents, generation, time), from the graph or parsed
+        self._shallow_commits = None # .git/shallow as a set of sha hex, read on first use
+        self._tree_cache = OrderedDict() # tree sha hex -> parsed entries, LRU of TREE_CACHE_LIMIT trees
+        self._tree_cache_lock = threading.Lock() # serve answers many clients from one instance
+        self._store_stamps = {} # path -> stat when its cached form (pack list, commit-graph) was loaded
+        self._packed_refs_cache = None # .git/packed-refs as {ref name: sha hex}, read on first use
+        self.trace = None # PerfTrace when GIT_TRACE_PERFORMANCE / --trace-perf is on
 
 
     # -------- GIT COMMANDS --------
@@ -43,12 +1152,27 @@ class Git:
 
 
     # -- 2. COMMAND : git cat-file <flag> <hash-of-the-file> --
+    # -t and -s only inflate the object header, -p needs the whole object
     def cat_file(self, args): 
+        if args.batch or args.batch_check:
+            return self._cat_file_batch(args.batch)
+
         sha = args.object_hash
-        object_path = self._object_path(sha) # the object associated with the given hash
-        
-        # Need content of file at the path - zlib decompression
-        content = self._get_object_content(object_path)
+        if sha is None:
+            print("Usage: cat-file <flag> <hash-of-object>", file=sys.stderr)
+            sys.exit(1)
+
+        if args.t or args.s:
+            info = self._object_info(sha)
+            if info is None:
+                print(f"fatal: Not a valid object name {sha}", file=sys.stderr)
+                sys.exit(1)
+            type, size = info
+            print(type if args.t else size, end='')
+            return
+
+        # Need content of the object - loose file (zlib decompression) or from a pack via its .idx
+        content = self._read_object(sha)
 
         # Content format - <object-type>\x20<size>\x00<content>
         if content is None:
@@ -56,20 +1180,51 @@ class Git:
             sys.exit(1)
 
         header, _ , body = content.partition(b'\x00')
-        type, _ , size = header.partition(b'\x20')
             
         if args.p:
             print(body.decode('utf-8'), end='') # content byte -> string 
-        elif args.t:
-            print(type.decode('utf-8'), end='')
-        elif args.s:
-            print(size.decode('utf-8'), end='')
         else:
             print("Usage: cat-file <flag> <hash-of-object>", file=sys.stderr)
 
+    # 2b. cat-file --batch / --batch-check - one sha per stdin line, answered as "<sha> <type> <size>" (+ content
+    # for --batch) and flushed per request, so a long running caller can pipeline thousands of lookups
+    def _cat_file_batch(self, with_content: bool):
+        out = sys.stdout.buffer
+        for line in sys.stdin.buffer:
+            sha = line.strip().decode('ascii', 'replace')
+            if not sha:
+                continue
+
+            if with_content:
+                content = self._read_object(sha)
+                if content is None:
+                    out.write(f"{sha} missing\n".encode('ascii', 'replace'))
+                else:
+                    header, _, body = content.partition(b'\x00')
+                    out.write(sha.encode('ascii') + b' ' + header + b'\n')
+                    out.write(body)
+                    out.write(b'\n')
+            else:
+                info = self._object_info(sha)
+                if info is None:
+                    out.write(f"{sha} missing\n".encode('ascii', 'replace'))
+                else:
+                    out.write(f"{sha} {info[0]} {info[1]}\n".encode('ascii'))
+            out.flush()
+
 
     # -- 3. COMMAND: git hash-object <flag> <file-name> -- 
     def hash_object(self, args):
+        if args.stdin_paths:
+            if args.file_path is not None:
+                print("fatal: Can't specify files with --stdin-paths", file=sys.stderr)
+                sys.exit(129)
+            paths = (line.decode('utf-8').rstrip('\n') for line in sys.stdin.buffer)
+            self._bulk_check_in((path for path in paths if path), args.w)
+            return
+        if args.file_path is None:
+            print("usage: hash-object [-w] (--stdin-paths | <file>)", file=sys.stderr)
+            sys.exit(129)
         if not os.path.exists(args.file_path):
             print(f"fatal: file does not exist.")
             sys.exit(1)
@@ -79,124 +1234,194 @@ class Git:
         print(sha1)
 
 
-    # -- 4. Command - git ls-tree <flag> <tree-sha> -- 
+    # -- 4. Command - git ls-tree [-r] [-t] [--name-only] <tree-ish> [<path>...] -- 
+    # every line goes through one buffered binary writer, and the "<mode> <type> " part of it comes ready-made
+    # from a table - listing a huge tree is then mostly the tree walk itself
     def ls_tree(self, args):
 
         # given sha - we know path - decompress - work on --name-only - parse the names 
         hash_of_tree_object = args.tree_hash
-        path_to_tree_object = self._object_path(hash_of_tree_object)
-        content_of_tree_object = self._get_object_content(path_to_tree_object)
-
-        if content_of_tree_object is None:
-            print(f"fatal: Not a valid object name: {hash_of_tree_object}", file=sys.stderr)
-            sys.exit(1)
-
-        header , _ , body = content_of_tree_object.partition(b'\x00')
-
-        if not header.startswith(b'tree '):
-            print(f"fatal: {hash_of_tree_object} is not a tree object", file=sys.stderr)
-            sys.exit(1)
-
-        # Parsing of each entry needed
-        tree_entries = body
-        i = 0
-
-        # format  - <mode>\x20<filename>\x00<sha1-hash>
-        while i < len(tree_entries):
-
-            # first component - mode
-            space_index = tree_entries.find(b'\x20', i)
-            if space_index == -1: break # should not happend in a valid tree
-
-            mode = tree_entries[i : space_index]
-
-            # second Component - filename
-            filename_start = space_index + 1
-            null_index = tree_entries.find(b'\x00', space_index)
-            if null_index == -1 : break # not a valid tree
-            filename = tree_entries[filename_start: null_index]
-
-            # third component - sha1 hash
-            sha1_start = null_index + 1
-            sha1 = tree_entries[sha1_start: sha1_start + 20]
-
-            if args.name_only:
-                # currently we need to print only the file name
-                print(filename.decode('utf-8'))
-
-            else:
-                mode_str = mode.decode('ascii')
-                if mode_str == '100644' or mode_str == '100755' or mode_str == '120000' or mode_str == '160000':
-                    type = 'blob'
-                elif mode_str == '40000':
-                    type = 'tree'
+        if len(hash_of_tree_object) == 40:
+            info = self._object_info(hash_of_tree_object)
+            if info is None:
+                print(f"fatal: Not a valid object name: {hash_of_tree_object}", file=sys.stderr)
+                sys.exit(1)
+            if info[0] not in ('tree', 'commit', 'tag'):
+                print(f"fatal: {hash_of_tree_object} is not a tree object", file=sys.stderr)
+                sys.exit(1)
+        tree_sha = self._resolve_tree(hash_of_tree_object)
+
+        # path filters: "dir" shows the entry itself (its contents with -r), "dir/" its contents; the directories
+        # above a filtered path are walked through silently (shown with -t)
+        filters = [(path.rstrip('/'), path.endswith('/')) for path in args.paths]
+        recursive, show_trees = args.r, args.t
+        prefixes = Git.LS_TREE_PREFIXES
+        out = sys.stdout.buffer
+        write = out.write
+
+        # format  - <mode>\x20<filename>\x00<sha1-hash>, already split up by the tree parser
+        stack = [(self._parse_tree(tree_sha), 0, '')] # (entries, next entry, path prefix) - depth first, in tree order
+        while stack:
+            entries, i, prefix = stack[-1]
+            if i == len(entries):
+                stack.pop()
+                continue
+            stack[-1] = (entries, i + 1, prefix)
+            filename, mode, sha1 = entries[i]
+            path = prefix + filename
+            is_tree = mode == Git.MODE_TREE
+
+            show, descend = True, is_tree and recursive
+            if filters:
+                inside = any(path == f or path.startswith(f + '/') for f, _ in filters)
+                if inside:
+                    opened = any(path == f and contents for f, contents in filters) # "dir/" - list what is in it
+                    show = not opened or show_trees
+                    descend = is_tree and (recursive or opened)
+                elif is_tree and any(f.startswith(path + '/') for f, _ in filters):
+                    show, descend = show_trees, True
                 else:
-                    type = 'unknown' # cases of symlinks and other cases
-
-                sha1_hex_string = sha1.hex()
-
-                to_print = mode.decode('utf-8') + '\t' + type + '\t' + sha1_hex_string + '\t' + filename.decode('utf-8')
-
-                print(to_print)
+                    continue
+            if descend and recursive and not show_trees and show:
+                show = False # -r lists what is in a tree instead of the tree
 
-            i = sha1_start + 20
+            if show:
+                if args.name_only:
+                    write(path.encode('utf-8', 'surrogateescape') + b'\n')
+                else:
+                    line_prefix = prefixes.get(mode) or b'%06o unknown ' % mode
+                    write(line_prefix + sha1.hex().encode('ascii') + b'\t' + path.encode('utf-8', 'surrogateescape') + b'\n')
+            if descend:
+                stack.append((self._parse_tree(sha1.hex()), 0, path + '/'))
+        out.flush()
 
 
     # -- 5. SubCommand - git write-tree --
+    # the whole working directory is still the "staged" state, but .git/index works as a stat cache - unchanged files
+    # keep their cached sha and unchanged directories their cached tree sha (TREE extension), so nothing is rehashed
+    # three steps: scan the directories into a work list, hash + compress the changed blobs on a thread pool
+    # (hashlib and zlib let go of the GIL on big buffers), then build the trees bottom-up from their children's shas
     def write_tree(self, args, directory_path = '.'):
-        tree_entries_str = b''
-        entries = []
-
-        # Iterating over the Dir
-        dir_path = directory_path
+        index = self._load_index()
+        new_index = GitIndex(index.path) # rebuilt from the scan, so deleted files and directories drop out of it
 
         try:
-            contents = os.listdir(dir_path)
-
-            # critical step - ignoring .git directory
-            filtered_contents = [ name for name in contents 
-                                if name not in ('.git', '.', '..')]
-
-            if not filtered_contents:
-                # empty directory
-                tree_object = b'tree 0\x00'
-                return self._write_object(tree_object)
-
-            for object in filtered_contents:
-                object_path = os.path.join(directory_path, object)
-                if os.path.isfile(object_path):
-                    # Need - sha1 hash(20 byte), mode, filename
-                    blob_sha1_hex = self._write_blob(object_path, True)
-                    blob_sha1_bytes = bytes.fromhex(blob_sha1_hex)
-                    # Mode - according to git standards -  not the os full permissions
-                    if os.access(object_path, os.X_OK):
-                        mode_str = '100755'
-                    else:
-                        mode_str = '100644'
-                    
-                    # appending tuple(filename, object) to sort later on alphabetically
-                    entries.append((object, mode_str.encode('ascii') + b'\x20' + object.encode('utf-8') + b'\x00' + blob_sha1_bytes))
-
-                elif os.path.isdir(object_path):
-                    sub_tree_sha_hex = self.write_tree(args, object_path)
-                    entries.append((object + '/', b'40000' + b'\x20' + object.encode('utf-8') + b'\x00' + bytes.fromhex(sub_tree_sha_hex)))
-
-            entries.sort()
-            for entry in entries:
-                tree_entries_str += entry[1]
-            size_of_tree_object = len(tree_entries_str)
-            tree_object = b'tree ' + str(size_of_tree_object).encode('ascii') + b'\x00' + tree_entries_str
-
-            tree_sha = self._write_object(tree_object)
-
-            if dir_path == '.':
-                print(tree_sha)
-            return tree_sha
-
+            with self._phase('scan work tree'):
+                directories, blob_jobs = self._scan_work_tree(directory_path, index, new_index)
         except FileNotFoundError:
-            print(f"Error: Directory {dir_path} not found.", file=sys.stderr)
+            print(f"Error: Directory {directory_path} not found.", file=sys.stderr)
             sys.exit(1)
 
+        threads = getattr(args, 'threads', None) or self.hash_workers
+        with self._phase('hash blobs'), ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+            blob_shas = pool.map(lambda job: self._write_link_blob(job[1], True) if job[4] == '120000' else self._write_blob(job[1], True), blob_jobs)
+            for (tree_entry, object_path, rel_path, st, mode_str), blob_sha1_hex in zip(blob_jobs, blob_shas):
+                tree_entry[2] = bytes.fromhex(blob_sha1_hex)
+                new_index.entries[rel_path] = (index.stat_fields(st, int(mode_str, 8)), tree_entry[2])
+
+        with self._phase('build trees'):
+            tree_sha, changed = self._build_trees(directories, index, new_index)
+
+        if changed or len(new_index.entries) != len(index.entries): # a no-op write-tree leaves the index alone
+            new_index.write()
+
+        if directory_path == '.':
+            print(tree_sha)
+        return tree_sha
+
+    # 5b. scanning the working tree (iteratively, parents before children) into
+    #   directories - one dict per directory: repo path, its [name, mode, sha] tree entries, its parent and the counts
+    #   blob jobs   - (tree entry, file path, repo path, stat, mode) for every file the index cannot vouch for
+    def _scan_work_tree(self, directory_path, index, new_index):
+        directories = []
+        blob_jobs = []
+        pending = [(directory_path, '', None, None)] # (path, repo path, parent directory, slot in the parent's entries)
+
+        while pending:
+            dir_path, rel_dir, parent, parent_entry = pending.pop()
+            directory = {
+                'rel_dir': rel_dir, 'entries': [], 'parent': parent, 'parent_entry': parent_entry,
+                'entry_count': 0, 'subtree_count': 0, 'changed': False,
+            }
+            directories.append(directory)
+            prefix = rel_dir + '/' if rel_dir else ''
+
+            # scandir hands back the file type with the names - no extra isfile/isdir syscall per entry
+            with os.scandir(dir_path) as it:
+                contents = list(it)
+
+            for dir_entry in contents:
+                object = dir_entry.name
+                if object in ('.git', '.', '..'): # critical step - ignoring .git directory
+                    continue
+
+                # symlinks are never followed - a link is an entry of its own (120000, its target path as the blob),
+                # a link to a directory is not descended into (one pointing up the tree would loop forever)
+                is_link = dir_entry.is_symlink()
+                if is_link or dir_entry.is_file(follow_symlinks=False):
+                    # Need - sha1 hash(20 byte), mode, filename - the sha comes from the index if the file is untouched
+                    # (a chmod changes ctime too, so a matching entry also means its mode is still right)
+                    st = dir_entry.stat(follow_symlinks=False)
+                    rel_path = prefix + object
+                    cached_entry = index.cached_entry(rel_path, st)
+                    if cached_entry is not None:
+                        new_index.entries[rel_path] = cached_entry
+                        directory['entries'].append([object, f"{cached_entry[0][6]:o}", cached_entry[1]])
+                    else:
+                        # Mode - according to git standards -  not the os full permissions
+                        if is_link:
+                            mode_str = '120000'
+                        else:
+                            mode_str = '100755' if os.access(dir_entry.path, os.X_OK) else '100644'
+                        tree_entry = [object, mode_str, None] # sha filled in by the hashing pool
+                        directory['entries'].append(tree_entry)
+                        blob_jobs.append((tree_entry, dir_entry.path, rel_path, st, mode_str))
+                        directory['changed'] = True
+                    directory['entry_count'] += 1
+
+                elif dir_entry.is_dir(follow_symlinks=False):
+                    tree_entry = [object + '/', '40000', None] # sha filled in once the subtree is built
+                    directory['entries'].append(tree_entry)
+                    directory['subtree_count'] += 1
+                    pending.append((dir_entry.path, prefix + object, directory, tree_entry))
+
+        return directories, blob_jobs
+
+    # 5c. building the tree objects bottom-up (reverse scan order = children first) - returns (root sha, changed)
+    def _build_trees(self, directories, index, new_index):
+        for directory in reversed(directories):
+            rel_dir = directory['rel_dir']
+            entries = directory['entries']
+
+            # nothing below changed and the same number of entries and subtrees as last time - the cached tree is still right
+            cached = index.trees.get(rel_dir)
+            if not directory['changed'] and cached is not None and cached[:2] == (directory['entry_count'], directory['subtree_count']):
+                tree_sha1_bytes = cached[2]
+            else:
+                if not entries:
+                    # empty directory
+                    tree_object = b'tree 0\x00'
+                else:
+                    # appended as (filename, mode, sha) - sorted alphabetically, directories with a trailing / like git does
+                    entries.sort()
+                    tree_entries_str = b''.join(
+                        mode_str.encode('ascii') + b'\x20' + name.rstrip('/').encode('utf-8') + b'\x00' + sha1_bytes
+                        for name, mode_str, sha1_bytes in entries
+                    )
+                    size_of_tree_object = len(tree_entries_str)
+                    tree_object = b'tree ' + str(size_of_tree_object).encode('ascii') + b'\x00' + tree_entries_str
+
+                tree_sha1_bytes = bytes.fromhex(self._write_object(tree_object))
+                directory['changed'] = True
+
+            new_index.trees[rel_dir] = (directory['entry_count'], directory['subtree_count'], tree_sha1_bytes)
+
+            parent = directory['parent']
+            if parent is None:
+                return tree_sha1_bytes.hex(), directory['changed']
+            directory['parent_entry'][2] = tree_sha1_bytes
+            parent['entry_count'] += directory['entry_count']
+            parent['changed'] = parent['changed'] or directory['changed']
 
     # -- 6. SubCommand - git commit-tree <tree-sha> -p <parent-commit-sha> -m <commit-message> --
     def commit_tree(self, args):
@@ -251,46 +1476,375 @@ class Git:
 
         os.makedirs(target_dir, exist_ok=True) # creating a target clone folder
         self.git_dir = os.path.join(target_dir, '.git') # redirecting all object writes to new clone git 
+        self._packs = None
+        if args.delta_base_cache_limit is not None:
+            self.delta_base_cache_limit = args.delta_base_cache_limit
+        if args.jobs is not None:
+            self.jobs = args.jobs
+        if args.checkout_workers is not None:
+            self.checkout_workers = args.checkout_workers
+        if args.protocol is not None:
+            self.protocol_version = args.protocol
+        if args.stats:
+            self.stats = PipelineStats()
         self.init(args)
 
-        # GET request to get refs
-        data = self._discover_refs(repo_url)
-        lines = self._parse_pkt_lines(data)
-
-        # for testing
-        # for line in lines: 
-        #     print(line)
+        # GET request to get refs (v2: an ls-refs request for HEAD and the branches only)
+        with self._phase('discover refs'):
+            refs = self._discover_refs(repo_url)
 
         # Extracting the SHA of head commit - eg main branch
-        head_commit_sha = self._get_head_commit_sha(lines)
+        head_commit_sha = self._get_head_commit_sha(refs)
+        if head_commit_sha is None: # like git - the repo is set up, there is just nothing to check out
+            self._write_config(repo_url, args.filter)
+            print("warning: You appear to have cloned an empty repository.", file=sys.stderr)
+            return
+
+        # shallow / partial clone need the server to support them
+        transport = self._transport(repo_url)
+        if args.depth is not None and not transport.supports('shallow'):
+            print("fatal: server does not support shallow clients", file=sys.stderr)
+            sys.exit(1)
+        if args.filter is not None and not transport.supports('filter'):
+            print("fatal: server does not support filter", file=sys.stderr)
+            sys.exit(1)
 
-        # Asking for PACK data using POST request and head commit sha
-        pack_data = self._request_pack(repo_url, head_commit_sha.encode('ascii'))
+        # remote url (and for a partial clone the promisor settings, used later to fetch missing blobs lazily)
+        self._write_config(repo_url, args.filter)
 
-        # extracting pack bytes - pack_data = pkt line + pack bytes
-        pack_bytes = self._extract_pack_bytes(pack_data)
+        # Asking for PACK data using POST request and head commit sha - the pkt lines in front of the pack (shallow
+        # info, NAK) come back on their own, the pack itself is parsed as its side-band packets arrive
+        with self._phase('negotiate'):
+            response_lines, pack_source = self._request_pack(repo_url, [head_commit_sha.encode('ascii')], depth=args.depth, filter_spec=args.filter)
 
-        version, object_count = self._parse_pack_header(pack_bytes)
+        # checkout runs while the pack is still being indexed - every file is written as soon as its blob is resolved
+        def checkout():
+            # finding the tree this commit points to, by reading the commit object we just received
+            commit_content = self._read_object(head_commit_sha)
+            _, _, commit_body = commit_content.partition(b'\x00')
+            first_line = commit_body.split(b'\n')[0]
+            root_tree_sha = first_line.split(b' ')[1].decode('ascii')
 
-        # testing
-        # print(f"version={version}, obj_count={object_count}")
+            with self._phase('checkout'):
+                self._checkout_tree(root_tree_sha, target_dir)
 
-        self._parse_pack_objects(pack_bytes, object_count)
+        # the pack is kept as it is under objects/pack, with a generated .idx - no loose objects exploded out of it
+        self._receive_remote_pack(pack_source, promisor=args.filter is not None, overlap=checkout)
 
-        self._write_refs_and_head(target_dir, head_commit_sha)
+        # commits the history was cut at - their parents are not here, and that is expected
+        shallow_shas = [line.split(b' ')[1].strip().decode('ascii') for line in response_lines if line.startswith(b'shallow ')]
+        if shallow_shas:
+            with open(os.path.join(self.git_dir, Git.SHALLOW_FILE), 'w') as f:
+                f.write(''.join(sha + '\n' for sha in sorted(shallow_shas)))
 
-        # finding the tree this commit points to, by reading the commit object we just wrote
-        commit_content = self._get_object_content(self._object_path(head_commit_sha))
-        _, _, commit_body = commit_content.partition(b'\x00')
-        first_line = commit_body.split(b'\n')[0]
-        root_tree_sha = first_line.split(b' ')[1].decode('ascii')
-
-        self._checkout_tree(root_tree_sha, target_dir)
+        self._write_refs_and_head(target_dir, head_commit_sha)
 
+        if self.stats is not None:
+            self.stats.report()
         print(f"Cloned into : {target_dir}")
     # finishhhhhhhhhhhhh
         
 
+    # -- 8. Subcommand - git add <path>... --
+    # hashes and stores the given files (directories recursively) and records them in .git/index with their stat data
+    def add(self, args):
+        index = self._load_index()
+        work_tree = os.path.dirname(os.path.abspath(self.git_dir))
+
+        for path in args.paths:
+            rel_path = os.path.relpath(os.path.abspath(path), work_tree).replace(os.sep, '/')
+            if rel_path == '.':
+                rel_path = ''
+            if rel_path.startswith('..'):
+                print(f"fatal: {path} is outside repository", file=sys.stderr)
+                sys.exit(1)
+
+            if not os.path.lexists(path):
+                # removed from the working tree - staging the deletion
+                stale = [p for p in index.entries if p == rel_path or p.startswith(rel_path + '/')]
+                if not stale:
+                    print(f"fatal: pathspec '{path}' did not match any files", file=sys.stderr)
+                    sys.exit(1)
+                for p in stale:
+                    del index.entries[p]
+                    index.invalidate(p)
+                continue
+
+            if os.path.isdir(path) and not os.path.islink(path):
+                files = []
+                for root, dirs, names in os.walk(path): # links to directories are listed in dirs, never walked
+                    files.extend(os.path.join(root, name) for name in names + [d for d in dirs if os.path.islink(os.path.join(root, d))])
+                    dirs[:] = [d for d in dirs if d != '.git']
+            else:
+                files = [path]
+
+            for file_path in files:
+                is_link = os.path.islink(file_path)
+                if not is_link and not os.path.isfile(file_path):
+                    continue
+                file_rel = os.path.relpath(os.path.abspath(file_path), work_tree).replace(os.sep, '/')
+                if is_link:
+                    mode = Git.MODE_SYMLINK
+                else:
+                    mode = 0o100755 if os.access(file_path, os.X_OK) else 0o100644
+                st = os.lstat(file_path)
+                if index.cached_sha(file_rel, st, mode) is not None:
+                    continue # untouched since it was last added
+                sha = self._write_link_blob(file_path, True) if is_link else self._write_blob(file_path, True)
+                index.update(file_rel, st, mode, bytes.fromhex(sha))
+
+        index.write()
+
+
+    # -- 9. Subcommand - git fetch [<url>] --
+    # downloads only what the remote has that we do not: our commits are offered as "have" lines in growing batches
+    # until the server knows what we share, then it sends a thin pack (deltas may lean on our own objects)
+    def fetch(self, args):
+        repo_url = args.repo_address or self._config_get('remote.origin.url')
+        if not repo_url:
+            print("fatal: no remote url - pass one or clone with this tool first", file=sys.stderr)
+            sys.exit(1)
+        if args.protocol is not None:
+            self.protocol_version = args.protocol
+
+        with self._phase('discover refs'):
+            remote_sha = self._get_head_commit_sha(self._discover_refs(repo_url))
+        if remote_sha is None:
+            print("fatal: couldn't find remote ref HEAD - the remote repository is empty", file=sys.stderr)
+            sys.exit(128)
+        remote_ref = os.path.join(self.REFS_DIR, 'remotes', 'origin', 'main')
+        old_sha = self._read_ref(remote_ref) or self._read_ref(os.path.join(self.REFS_DIR, self.HEADS_DIR, 'main'))
+
+        if self._has_object(remote_sha):
+            print("Already up to date.")
+        else:
+            filter_spec = None
+            if self._config_get('remote.origin.promisor') == 'true':
+                filter_spec = self._config_get('remote.origin.partialclonefilter')
+            shallow_shas = self._read_shallow()
+
+            wanted = [remote_sha.encode('ascii')]
+            with self._phase('negotiate'):
+                common, pack_source = self._negotiate(repo_url, wanted, shallow_shas, filter_spec)
+                if pack_source is None: # v2 sends the pack with the round that made it ready, v0 only after "done"
+                    _, pack_source = self._request_pack(repo_url, wanted, filter_spec=filter_spec, haves=common, shallow_shas=shallow_shas)
+            self._receive_remote_pack(pack_source, promisor=filter_spec is not None)
+
+        self._write_ref(remote_ref, remote_sha)
+        with open(os.path.join(self.git_dir, 'FETCH_HEAD'), 'w') as f:
+            f.write(f"{remote_sha}\t\tbranch 'main' of {repo_url}\n")
+
+        if old_sha != remote_sha:
+            print(f"From {repo_url}")
+            print(f"   {(old_sha or '0' * 40)[:7]}..{remote_sha[:7]}  main       -> origin/main")
+
+
+    # -- 10. Subcommand - git gc [--window N] [--depth N] --
+    # everything reachable goes into one new delta compressed pack, then the loose copies and the packs it made
+    # redundant are deleted (unreachable loose objects are left alone)
+    def gc(self, args):
+        with self._phase('find reachable'):
+            objects = self._reachable_objects()
+        if not objects:
+            print("Nothing to pack")
+            return
+
+        pack_dir = os.path.join(self.git_dir, Git.OBJECTS_DIR, Git.PACK_DIR)
+        old_packs = list(self._pack_indexes())
+        promisor = any(os.path.exists(pack_index.pack_path[:-len('.pack')] + '.promisor') for pack_index in old_packs)
+        with self._phase('pack objects'):
+            pack_sha, delta_count = self._pack_objects(objects, os.path.join(pack_dir, 'pack'), args.window, args.depth, promisor)
+        new_pack_path = os.path.join(pack_dir, f"pack-{pack_sha}.pack")
+
+        packed = {sha for sha, _ in objects}
+        removed_packs = 0
+        for pack_index in old_packs:
+            if pack_index.pack_path == new_pack_path: # nothing changed since the last gc - same pack again
+                continue
+            if all(pack_index.sha_at(i).hex() in packed for i in range(pack_index.count)):
+                for ext in ('.pack', '.idx', '.promisor'):
+                    path = pack_index.pack_path[:-len('.pack')] + ext
+                    if os.path.exists(path):
+                        os.remove(path)
+                removed_packs += 1
+
+        removed_loose = 0
+        objects_dir = os.path.join(self.git_dir, Git.OBJECTS_DIR)
+        for dir_name in os.listdir(objects_dir):
+            dir_path = os.path.join(objects_dir, dir_name)
+            if len(dir_name) != 2 or not os.path.isdir(dir_path):
+                continue
+            for file_name in os.listdir(dir_path):
+                if dir_name + file_name in packed:
+                    os.remove(os.path.join(dir_path, file_name))
+                    removed_loose += 1
+            if not os.listdir(dir_path):
+                os.rmdir(dir_path)
+
+        self._packs = None
+        self._object_cache = DeltaBaseCache(Git.OBJECT_CACHE_LIMIT)
+        with self._phase('commit-graph'):
+            commit_count = self._write_commit_graph()
+        print(f"Packed {len(objects)} objects ({delta_count} deltas) into pack-{pack_sha}.pack, "
+              f"removed {removed_loose} loose objects and {removed_packs} old packs"
+              + (f", {commit_count} commits in the commit-graph" if commit_count else ""))
+
+
+    # -- 11. Subcommand - git pack-objects [--window N] [--depth N] <base-name> --
+    # object names come in on stdin, one per line - optionally followed by a path, as rev-list --objects prints them
+    # (the path only helps pick delta bases); writes <base-name>-<sha>.pack + .idx and prints the sha
+    def pack_objects(self, args):
+        objects = []
+        seen = set()
+        for line in sys.stdin.buffer:
+            sha, _, name = line.decode('utf-8').rstrip('\n').partition(' ')
+            if sha and sha not in seen:
+                seen.add(sha)
+                objects.append((sha, name))
+
+        pack_sha, _ = self._pack_objects(objects, args.base_name, args.window, args.depth)
+        print(pack_sha)
+
+
+    # -- 12. Subcommand - git commit-graph write --
+    # (re)writes objects/info/commit-graph for every commit reachable from the refs and HEAD
+    def commit_graph(self, args):
+        commit_count = self._write_commit_graph()
+        if commit_count is None:
+            print("fatal: the commit-graph is not written in a shallow repository", file=sys.stderr)
+            sys.exit(1)
+        print(f"Wrote {commit_count} commits to the commit-graph")
+
+
+    # -- 13. Subcommand - git log [--oneline] [-n N] [<rev>...] --
+    # the walk runs on the commit-graph, only the commits actually printed get inflated
+    def log(self, args):
+        include, exclude = self._parse_revs(args.revs or ['HEAD'])
+        out = sys.stdout
+        for i, sha in enumerate(self._rev_list(include, exclude, args.max_count)):
+            _, _, body = self._read_object(sha).partition(b'\x00')
+            headers, _, message = body.decode('utf-8', 'replace').partition('\n\n')
+            if args.oneline:
+                subject = ' '.join(message.strip('\n').split('\n\n', 1)[0].split('\n')) # first paragraph, as one line
+                out.write(f"{sha[:7]} {subject}\n")
+                continue
+
+            parents = []
+            author = ''
+            for line in headers.split('\n'):
+                key, _, value = line.partition(' ')
+                if key == 'parent':
+                    parents.append(value)
+                elif key == 'author':
+                    author = value
+            if i:
+                out.write('\n')
+            out.write(f"commit {sha}\n")
+            if len(parents) > 1:
+                out.write("Merge: " + ' '.join(parent[:7] for parent in parents) + '\n')
+            name, _, when = author.rpartition('> ')
+            out.write(f"Author: {name}>\nDate:   {self._format_date(when)}\n\n")
+            out.write(''.join('    ' + line + '\n' if line else '\n' for line in message.rstrip('\n').split('\n')))
+
+
+    # -- 14. Subcommand - git rev-list [--count] [-n N] <rev>... (^<rev> / <a>..<b> excludes) --
+    def rev_list(self, args):
+        include, exclude = self._parse_revs(args.revs)
+        commits = self._rev_list(include, exclude, args.max_count)
+        if args.count:
+            print(len(commits))
+        else:
+            sys.stdout.write(''.join(sha + '\n' for sha in commits))
+
+
+    # -- 15. Subcommand - git merge-base [--all] <a> <b> / --is-ancestor <a> <b> --
+    def merge_base(self, args):
+        first, second = (self._resolve_rev(rev) for rev in args.commits)
+        if args.is_ancestor:
+            sys.exit(0 if self._is_ancestor(first, second) else 1)
+
+        bases = self._merge_bases(first, second)
+        if not bases:
+            sys.exit(1)
+        print('\n'.join(bases if args.all else bases[:1]))
+
+
+    # -- 16. Subcommand - git diff-tree [-r] [-t] [--name-only | --name-status] <tree-ish> [<tree-ish>] --
+    # one commit is compared with its (only) parent, like git - root and merge commits print nothing
+    def diff_tree(self, args):
+        if args.new is None:
+            commit = self._resolve_rev(args.old)
+            _, parents, _, _ = self._commit_node(commit)
+            if len(parents) != 1:
+                return
+            old_tree, new_tree = self._commit_node(parents[0])[0], self._commit_node(commit)[0]
+            print(commit)
+        else:
+            old_tree, new_tree = self._resolve_tree(args.old), self._resolve_tree(args.new)
+
+        lines = []
+        for path, old_mode, old_sha, new_mode, new_sha in self._diff_trees(old_tree, new_tree, args.r or args.t, args.t):
+            status = self._change_status(old_mode, new_mode)
+            if args.name_only:
+                lines.append(path)
+            elif args.name_status:
+                lines.append(f"{status}\t{path}")
+            else:
+                lines.append(f":{old_mode:06o} {new_mode:06o} {(old_sha or self.NULL_SHA).hex()} "
+                             f"{(new_sha or self.NULL_SHA).hex()} {status}\t{path}")
+        sys.stdout.write(''.join(line + '\n' for line in lines))
+
+
+    # -- 17. Subcommand - git checkout <rev> --
+    # moves HEAD (a branch name is checked out as that branch, anything else detached) and the work tree to another
+    # commit - only the paths that differ between the two trees are written or deleted
+    def checkout(self, args):
+        target = self._resolve_rev(args.rev)
+        branch = f'refs/heads/{args.rev}' if self._read_ref(f'refs/heads/{args.rev}') else None
+        head = self._read_ref('HEAD')
+        while head and head.startswith('ref: '):
+            head = self._read_ref(head[5:])
+
+        if head is None: # nothing checked out yet - plain full checkout
+            self._checkout_tree(self._commit_node(target)[0], '.')
+        else:
+            self._checkout_changes(self._commit_node(head)[0], self._commit_node(target)[0], '.')
+
+        with open(os.path.join(self.git_dir, Git.HEAD_FILE), 'w') as f:
+            f.write(f"ref: {branch}\n" if branch else target + '\n')
+        if branch:
+            print(f"Switched to branch '{args.rev}'", file=sys.stderr)
+        else:
+            print(f"HEAD is now at {target[:7]}", file=sys.stderr)
+
+    # -- 20. Subcommand - git index-pack [-v] [-o <index-file>] <pack-file> --
+    # the .idx for a pack file on disk, built the way clone indexes what it receives - the pack is checked while it is
+    # parsed (header, every entry's size, the trailing SHA-1) and each entry's CRC32 taken on the way. Prints the pack
+    # checksum, -v adds the object and delta chain stats
+    def index_pack(self, args):
+        pack_path = args.pack_file
+        if not pack_path.endswith('.pack'):
+            print(f"fatal: packfile name '{pack_path}' does not end with '.pack'", file=sys.stderr)
+            sys.exit(128)
+        pack_entries, pack_sha = self._index_pack_file(pack_path)
+        index_entries = [(sha, crc, offset) for offset, _, _, crc, sha in pack_entries]
+        self._write_pack_index(args.index_file or pack_path[:-len('.pack')] + '.idx', index_entries, pack_sha)
+        print(pack_sha.hex())
+        if args.verbose:
+            print('\n'.join(self._pack_stats_lines(pack_entries)), file=sys.stderr)
+
+    # -- 21. Subcommand - git verify-pack [-v | -s] <pack>.idx... --
+    # each pack checked against its .idx (see _verify_pack) - silent when all is well, unless -v / -s asked for the
+    # object list / the stats
+    def verify_pack(self, args):
+        failed = False
+        for path in args.packs:
+            base_path = path[:-len('.idx')] if path.endswith('.idx') else path[:-len('.pack')] if path.endswith('.pack') else path
+            failed |= not self._verify_pack(base_path + '.pack', base_path + '.idx', args.verbose, args.stat_only)
+        if failed:
+            sys.exit(1)
+
+
     # -------- HELPER FUNCTIONS --------
 
     # 1. Reading and Decompress a zlib-compressed object file
@@ -317,13 +1871,18 @@ class Git:
     
 
     # 3. Reading, hashing, compressing, and optionally writing
+    # small files go through _write_object in one piece; anything bigger than a chunk is streamed - each chunk
+    # feeds the sha1 and the zlib compressor at once, so memory stays at one chunk however big the file is
     def _write_blob(self, file_path: str, write_to_disk: bool) -> str:
 
         # Need to : Read file -> Add header -> Calculate sha1 hash -> compress with zlib -> write to Git database
         try:
             with open(file_path, 'rb') as f:
+                file_content_size = os.fstat(f.fileno()).st_size
+                if file_content_size > self.BLOB_CHUNK_SIZE:
+                    return self._stream_blob(f, file_content_size, write_to_disk)
                 file_content_bytes= f.read()
-        except Exception as e:
+        except OSError as e:
             print(f"Error in reading the file: {e}", file=sys.stderr)
             sys.exit(1)
 
@@ -336,6 +1895,165 @@ class Git:
 
         return self._compute_sha1_hash(file_content_with_header)
 
+    # 3b. Streaming hash-and-compress of a big open file - the compressed object goes to a temp file in .git/objects
+    # which is renamed onto its sha path at the end (or thrown away if the object turns out to exist already)
+    def _stream_blob(self, f, file_content_size: int, write_to_disk: bool) -> str:
+        header_bytes = f"blob {file_content_size}\x00".encode('ascii')
+        sha1 = hashlib.sha1(header_bytes)
+        compressor = zlib.compressobj() if write_to_disk else None
+        tmp_file = None
+        if write_to_disk:
+            tmp_fd, tmp_path = tempfile.mkstemp(prefix='tmp_obj_', dir=os.path.join(self.git_dir, Git.OBJECTS_DIR))
+            tmp_file = open(tmp_fd, 'wb')
+            tmp_file.write(compressor.compress(header_bytes))
+
+        try:
+            read_size = 0
+            while True:
+                chunk = f.read(self.BLOB_CHUNK_SIZE)
+                if not chunk:
+                    break
+                read_size += len(chunk)
+                sha1.update(chunk)
+                if tmp_file is not None:
+                    tmp_file.write(compressor.compress(chunk))
+
+            if read_size != file_content_size: # the header already promised a size
+                raise OSError(f"{f.name} changed size while it was being read")
+
+            sha1_hex = sha1.hexdigest()
+            if tmp_file is None:
+                return sha1_hex
+
+            tmp_file.write(compressor.flush())
+            tmp_file.close()
+            self._store_loose_file(tmp_path, sha1_hex)
+            return sha1_hex
+
+        except BaseException:
+            if tmp_file is not None:
+                tmp_file.close()
+                os.remove(tmp_path)
+            raise
+
+    # 3d. hash-object --stdin-paths - with -w every new blob goes whole into one new pack (+ .idx) rather than a loose
+    # file each, so the cost is hashing and compressing, not a mkdir, temp file and rename per object; blobs the store
+    # already has, or this run already packed (the in-memory sha set), are only hashed. The shas are printed once the
+    # pack is in place - a run that fails part way prints none, since none of its objects were stored
+    def _bulk_check_in(self, paths, write_to_disk: bool):
+        out = sys.stdout.buffer
+        if not write_to_disk:
+            for path in paths:
+                out.write(self._write_blob(path, False).encode('ascii') + b'\n')
+            return
+
+        pack_dir = os.path.join(self.git_dir, Git.OBJECTS_DIR, Git.PACK_DIR)
+        os.makedirs(pack_dir, exist_ok=True)
+        fd, tmp_pack_path = tempfile.mkstemp(prefix='tmp_pack_', dir=pack_dir)
+        index_entries = [] # (sha bytes, crc32, offset)
+        packed = set()
+        shas = []
+        try:
+            with open(fd, 'w+b') as pack_file, self._phase('bulk check-in'):
+                pack_file.write(b'PACK' + struct.pack('>II', 2, 0)) # the object count is filled in at the end
+                for path in paths:
+                    shas.append(self._append_blob(pack_file, path, packed, index_entries))
+                if index_entries:
+                    pack_sha = self._finish_pack(pack_file, len(index_entries))
+        except BaseException:
+            os.remove(tmp_pack_path)
+            raise
+
+        if not index_entries: # nothing new - no empty pack
+            os.remove(tmp_pack_path)
+        else:
+            pack_name = f"pack-{pack_sha.hex()}"
+            os.chmod(tmp_pack_path, 0o444) # packs never change once written, like loose objects
+            os.replace(tmp_pack_path, os.path.join(pack_dir, pack_name + '.pack'))
+            self._write_pack_index(os.path.join(pack_dir, pack_name + '.idx'), index_entries, pack_sha)
+            self._packs = None # new pack on disk, reload the indexes next time
+        out.writelines(sha.hex().encode('ascii') + b'\n' for sha in shas)
+
+    # 3e. Appending one file to a bulk check-in pack as a whole blob - returns its sha (bytes); small files are hashed
+    # before compressing, big ones are streamed in one pass and cut back off the pack if the blob turns out to be known
+    def _append_blob(self, pack_file, path: str, packed: set, index_entries: list) -> bytes:
+        try:
+            with open(path, 'rb') as f:
+                file_content_size = os.fstat(f.fileno()).st_size
+                header_bytes = f"blob {file_content_size}\x00".encode('ascii')
+                sha1 = hashlib.sha1(header_bytes)
+                offset = pack_file.tell()
+
+                if file_content_size <= self.BLOB_CHUNK_SIZE:
+                    file_content_bytes = f.read()
+                    if len(file_content_bytes) != file_content_size: # the header already promised a size
+                        raise OSError(f"{path} changed size while it was being read")
+                    sha1.update(file_content_bytes)
+                    sha = sha1.digest()
+                    if sha in packed or self._has_object(sha.hex()):
+                        if self.trace is not None:
+                            self.trace.count('bulk objects already present')
+                        return sha
+                    entry = self._encode_object_header(self.OBJ_BLOB, file_content_size) + zlib.compress(file_content_bytes)
+                    pack_file.write(entry)
+                    crc = zlib.crc32(entry)
+                else:
+                    entry_header = self._encode_object_header(self.OBJ_BLOB, file_content_size)
+                    pack_file.write(entry_header)
+                    crc = zlib.crc32(entry_header)
+                    compressor = zlib.compressobj()
+                    read_size = 0
+                    while True:
+                        chunk = f.read(self.BLOB_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        read_size += len(chunk)
+                        sha1.update(chunk)
+                        compressed = compressor.compress(chunk)
+                        pack_file.write(compressed)
+                        crc = zlib.crc32(compressed, crc)
+                    if read_size != file_content_size:
+                        raise OSError(f"{path} changed size while it was being read")
+                    compressed = compressor.flush()
+                    pack_file.write(compressed)
+                    crc = zlib.crc32(compressed, crc)
+                    sha = sha1.digest()
+                    if sha in packed or self._has_object(sha.hex()):
+                        pack_file.truncate(offset)
+                        pack_file.seek(offset)
+                        if self.trace is not None:
+                            self.trace.count('bulk objects already present')
+                        return sha
+        except OSError as e:
+            print(f"Error in reading the file: {e}", file=sys.stderr)
+            sys.exit(1)
+
+        packed.add(sha)
+        index_entries.append((sha, crc, offset))
+        if self.trace is not None:
+            self.trace.count('bulk objects written')
+        return sha
+
+    # 3f. A symlink as git stores it (mode 120000) - a blob of the link's target path, whatever it points at
+    def _write_link_blob(self, link_path: str, write_to_disk: bool) -> str:
+        target = os.fsencode(os.readlink(link_path))
+        content_with_header = f"blob {len(target)}\x00".encode('ascii') + target
+        if write_to_disk:
+            return self._write_object(content_with_header)
+        return self._compute_sha1_hash(content_with_header)
+
+    # 3c. Moving a finished temp object file onto its sha path - atomic, so readers never see half an object
+    def _store_loose_file(self, tmp_path: str, sha1: str):
+        if self._has_object(sha1):
+            os.remove(tmp_path)
+            if self.trace is not None:
+                self.trace.count('loose objects already present')
+            return
+        os.chmod(tmp_path, 0o444) # objects never change once written
+        os.replace(tmp_path, self._object_path(sha1, make_dir=True))
+        if self.trace is not None:
+            self.trace.count('loose objects written')
+
     # 4. finding object path -> making dir if required -> returning path
     def _object_path(self, sha, make_dir=False):
         path_dir = os.path.join(self.git_dir, Git.OBJECTS_DIR, sha[:2])
@@ -344,29 +2062,38 @@ class Git:
         return os.path.join(path_dir, sha[2:])
 
     # 5. computing sha1 hash, getb object path via _object_path func, zlib compress the content, writing to the disk, return the hex SHA
+    # written to a temp file and renamed into place, so parallel writers of the same object cannot clash
     def _write_object(self, content_with_header: bytes)->str:
         sha1 = self._compute_sha1_hash(content_with_header)
-        path_new_object = self._object_path(sha1, make_dir=True)
 
-        if os.path.exists(path_new_object):
+        if self._has_object(sha1):
+            if self.trace is not None:
+                self.trace.count('loose objects already present')
             return sha1
 
         compressed_data = zlib.compress(content_with_header)
         try:
-            with open(path_new_object, 'wb') as f:
+            tmp_fd, tmp_path = tempfile.mkstemp(prefix='tmp_obj_', dir=os.path.join(self.git_dir, Git.OBJECTS_DIR))
+            with open(tmp_fd, 'wb') as f:
                 f.write(compressed_data)
+            self._store_loose_file(tmp_path, sha1)
         except Exception as e:
             print(f"Error while writing to file : {e}", file=sys.stderr)
             sys.exit(1)
 
         return sha1
 
-    # 6. Sending GET request for git clone implemetation - get pkt line response
+    # 6. Ref discovery for git clone implemetation - {ref name: sha}, over the remote's shared keep-alive connection
     def _discover_refs(self, repo_url):
-        url = f"{repo_url}/info/refs?service=git-upload-pack"
-        req = urllib.request.Request(url, headers={'User-Agent': 'git/2.0.0'})
-        with urllib.request.urlopen(req) as response:
-            return response.read()
+        return self._transport(repo_url).discover_refs()
+
+    # 6b. one SmartHttpTransport (one HTTP connection) per remote url, reused by every request that follows
+    def _transport(self, repo_url) -> SmartHttpTransport:
+        transport = self._transports.get(repo_url)
+        if transport is None:
+            transport = self._transports[repo_url] = SmartHttpTransport(repo_url, self.protocol_version)
+        transport.trace = self.trace # per command - in the daemon, the transport outlives it
+        return transport
 
     # 7. packet line parser
     def _parse_pkt_lines(self, data: bytes):
@@ -376,7 +2103,7 @@ class Git:
             length_hex = data[i:i+4]
             length = int(length_hex, 16)
 
-            if length == 0: # flush packet found
+            if length < 4: # flush packet (or a v2 delim / response-end) found
                 i += 4
                 continue
 
@@ -386,52 +2113,109 @@ class Git:
 
         return lines
 
-    # 8. Parsing pkt line from get request to get head commit sha
-    def _get_head_commit_sha(self, lines)->str :
-        sha, _ , refs = lines[1].partition(b'\x20')
-        return sha.decode('ascii')
+    # 8. Picking the head commit sha out of the discovered refs - None when the remote has no branches (an empty repository)
+    def _get_head_commit_sha(self, refs)->str :
+        if 'HEAD' in refs:
+            return refs['HEAD']
+        return refs.get('refs/heads/main') or next((sha for name, sha in refs.items() if name.startswith('refs/heads/')), None)
+
+    # 9. requesting the pack using head commit sha - returns (the pkt lines before the pack, the pack source or None)
+    # depth -> "deepen N" (shallow clone), filter_spec -> "filter <spec>" (partial clone)
+    # fetch adds its have lines (and our shallow commits); done=False makes it a negotiation round - ACK/NAK only,
+    # except that a v2 server which is "ready" sends the pack straight away
+    # v0 puts the capabilities on the first want line, v2 sends them as plain arguments of the fetch command
+    def _request_pack(self, repo_url, want_shas, depth=None, filter_spec=None, haves=(), shallow_shas=(), done=True):
+        transport = self._transport(repo_url)
+        features = ['multi_ack_detailed', 'side-band-64k', 'thin-pack', 'ofs-delta']
+        if not transport.progress:
+            features.append('no-progress')
+        if depth is not None or shallow_shas:
+            features.append('shallow')
+        if filter_spec is not None:
+            features.append('filter')
+        features = [feature.encode('ascii') for feature in features if transport.supports(feature)]
+
+        arguments = []
+        if transport.protocol_version == 2:
+            arguments += [feature + b"\n" for feature in features if feature not in (b'multi_ack_detailed', b'side-band-64k', b'shallow', b'filter')]
+            arguments += [b"want " + want_sha + b"\n" for want_sha in want_shas]
+        else:
+            if 'agent' in transport.capabilities:
+                features.append(f"agent={SmartHttpTransport.USER_AGENT}".encode('ascii'))
+            arguments.append(b"want " + want_shas[0] + b" " + b" ".join(features) + b"\n")
+            arguments += [b"want " + want_sha + b"\n" for want_sha in want_shas[1:]]
+        arguments += [b"shallow " + shallow_sha + b"\n" for shallow_sha in shallow_shas]
+        if depth is not None:
+            arguments.append(f"deepen {depth}\n".encode('ascii'))
+        if filter_spec is not None:
+            arguments.append(f"filter {filter_spec}\n".encode('ascii'))
+        haves = [b"have " + have_sha + b"\n" for have_sha in haves]
+
+        if transport.protocol_version == 2:
+            return transport.command(b'fetch', arguments + haves + ([b"done\n"] if done else []))
 
-    # 9. requesting the pack using head commit sha
-    def _request_pack(self, repo_url, want_sha: bytes)->bytes:
-        want_line = self._build_pkt_line(b"want " + want_sha + b"\n")
         flush = b"0000"
-        done_line = self._build_pkt_line(b"done\n")
-
-        body = want_line + flush + done_line
-
-        url = f"{repo_url}/git-upload-pack"
-        req = urllib.request.Request(
-            url, 
-            data=body,
-            headers={
-                'User-Agent': 'git/2.0.0',
-                'Content-Type': 'application/x-git-upload-pack-request',
-                'Accept': 'application/x-git-upload-pack-result',
-            }
-        )
-        with urllib.request.urlopen(req) as response:
-            return response.read()
+        want_lines = b''.join(self._build_pkt_line(argument) for argument in arguments)
+        have_lines = b''.join(self._build_pkt_line(have) for have in haves)
+        done_line = self._build_pkt_line(b"done\n") if done else flush
+        body = want_lines + flush + have_lines + done_line
+        return transport.upload_pack(body)
 
 
     # 10. building a pkt line - reverse of parsing
     def _build_pkt_line(self, content:bytes)->bytes:
-        length = len(content) + 4
-        return f"{length:04x}".encode('ascii') + content
-
-    # 11. Extract pack data, excluding the pkt line from the POST request
-    def _extract_pack_bytes(self, pack_data: bytes)->bytes:
-        pack_start = pack_data.find(b'PACK')
-        return pack_data[pack_start:]
+        return SmartHttpTransport.pkt_line(content)
+
+    # 11. Wrapping the pack part of an upload-pack response (side-band already demultiplexed) for parsing
+    def _open_pack_stream(self, pack_source) -> PackStream:
+        if pack_source is None:
+            raise ValueError("remote sent no pack")
+        return PackStream(pack_source)
+
+    # 11b. _receive_pack for a pack coming off the network - a cut off or corrupted one is a fatal error (nothing of it
+    # is kept), not a traceback
+    def _receive_remote_pack(self, pack_source, promisor: bool = False, overlap=None) -> str:
+        import http.client # already loaded by the transport
+        try:
+            return self._receive_pack(self._open_pack_stream(pack_source), promisor, overlap)
+        except (http.client.HTTPException, ConnectionError) as e:
+            print(f"fatal: the remote end hung up unexpectedly ({type(e).__name__})", file=sys.stderr)
+        except (ValueError, EOFError) as e:
+            print(f"fatal: {e}", file=sys.stderr)
+        sys.exit(128)
 
     # 12. PACK has a conatining version and object number
     def _parse_pack_header(self, pack_bytes: bytes):
         magic = pack_bytes[0:4]
         version = struct.unpack('>I', pack_bytes[4:8])[0] # 4 byte version field
         object_count = struct.unpack('>I', pack_bytes[8:12])[0]
+        if magic != b'PACK':
+            raise ValueError("bad pack header - not a pack file")
+        if version not in (2, 3): # 3 only differs in allowing bigger objects, nobody writes it but it reads the same
+            raise ValueError(f"pack version {version} unsupported")
         return version, object_count
 
+    # 12b. A whole pack off a stream, checked as it is parsed: the header, every entry, then the trailing SHA-1 against
+    # the hash of all the bytes before it - a sink on the stream, so checking costs no second pass over the pack.
+    # A truncated or corrupted pack raises EOFError / ValueError. Returns (pack entries, pack checksum bytes)
+    def _read_pack(self, pack_stream: PackStream, hasher=None):
+        checksum = hashlib.sha1()
+        sink = checksum.update
+        pack_stream.sinks.append(sink)
+        try:
+            _, object_count = self._parse_pack_header(pack_stream.read(12))
+            pack_entries = self._parse_pack_objects(pack_stream, object_count, hasher)
+        except zlib.error as e:
+            raise ValueError(f"pack is corrupted at offset {pack_stream.offset}: {e}")
+        finally:
+            pack_stream.sinks.remove(sink)
+        pack_sha = pack_stream.read(20) # trailing SHA-1 checksum of the whole pack - also names the pack
+        if pack_sha != checksum.digest():
+            raise ValueError("pack is corrupted (SHA1 mismatch)")
+        return pack_entries, pack_sha
+
     # 13. Moving to objects of PACK - parsing the object header - lovely bit manipulation 
-    def _read_object_header(self, pack_data: bytes, offset: int):
+    def _read_object_header(self, pack_data, offset: int):
         # we need to traverse byte by byte now
         byte = pack_data[offset]
         obj_type = (byte >> 4) & 0x7    # buts 6-4
@@ -447,63 +2231,190 @@ class Git:
 
         return obj_type, size, offset
 
-    # 14. Decompressing the data after parsing the object header
-    def _decompress_object(self, pack_data:bytes, offset: int):
+    # 14. Decompressing the data after parsing the object header - works on a memoryview, so nothing after offset is copied
+    def _decompress_object(self, pack_data, offset: int):
         decompressor = zlib.decompressobj()
-        decompressed = decompressor.decompress(pack_data[offset: ])
-        consumed = len(pack_data[offset:]) - len(decompressor.unused_data)
+        with memoryview(pack_data)[offset:] as rest:
+            decompressed = decompressor.decompress(rest)
+            consumed = len(rest) - len(decompressor.unused_data)
         return decompressed, offset + consumed
 
-    # 15. this will used the above two function to parse the objects of PACK
-    def _parse_pack_objects(self, pack_bytes: bytes, object_count: int):
-        offset = 12 # skipping past "PACK" + version (4) + object_count(4)
-
-        type_names = {
-            self.OBJ_COMMIT: "commit",
-            self.OBJ_TREE: "tree",
-            self.OBJ_BLOB: "blob",
-        }
+    # 15. this will used the above helpers to parse the objects of PACK, straight off the stream
+    # first pass only - records [offset, type, base, crc32, sha] per object (base = offset for OFS_DELTA, 20 byte sha
+    # for REF_DELTA); non-delta objects get their sha right away, deltas are resolved in a second pass (_resolve_deltas)
+    # with a hasher (PipelineStage) the whole objects are hashed on its thread, their sha is filled in by the time it is closed
+    def _parse_pack_objects(self, pack_stream: PackStream, object_count: int, hasher=None):
+        pack_entries = []
 
-        resolved = {} # offset where object started
-
-        # we will traverse each object one by one
+        # we will traverse each object one by one, as the bytes come in
         for _ in range(object_count):
-            obj_start = offset
-            obj_type, size, offset = self._read_object_header(pack_bytes, offset)
+            obj_start = pack_stream.offset
+            pack_stream.crc32 = 0 # crc covers the raw entry bytes - header + compressed data
+
+            # object header is at most a handful of bytes - peek a small window and parse it in place
+            head = pack_stream.peek(32)
+            obj_type, size, header_len = self._read_object_header(head, 0)
 
             if obj_type == self.OBJ_OFS_DELTA:
-                back_distance, offset = self._read_ofs_delta_offset(pack_bytes, offset)
+                back_distance, header_len = self._read_ofs_delta_offset(head, header_len)
+                pack_stream.skip(header_len)
+                self._inflate_entry(pack_stream, obj_start, size) # only walking past the diff instructions for now
                 base_offset = obj_start - back_distance # where the base object started
-                delta_content, offset = self._decompress_object(pack_bytes, offset) # decompressing the diff instruction
-
-                base_type, base_content = resolved[base_offset]
-                content = self._apply_delta(base_content, delta_content) # reconstructing a real contetn
-
-                resolved[obj_start] = (base_type, content) # delta inherits its base type
-                type_name = type_names[base_type]
-                header = f"{type_name} {len(content)}\x00".encode('ascii')
-                self._write_object(header + content) # writing to the disk
+                pack_entries.append([obj_start, obj_type, base_offset, pack_stream.crc32, None])
                 continue
 
             if obj_type == self.OBJ_REF_DELTA: # base identified by full 20 bytes sha and not offset
-                print("Skipping REF Delta for now")
-                offset += 20 # the 20 bytes SGA
-                _, offset = self._decompress_object(pack_bytes, offset)
+                pack_stream.skip(header_len)
+                base_sha = pack_stream.read(20) # the 20 bytes SHA - the base may come later in the pack, or not at all
+                self._inflate_entry(pack_stream, obj_start, size)
+                pack_entries.append([obj_start, obj_type, base_sha, pack_stream.crc32, None])
                 continue
 
-            content, offset = self._decompress_object(pack_bytes, offset)
-
-            # note that the decompressed data does not have the header of an usual object so we need to add that now
-            resolved[obj_start] = (obj_type, content)
+            if obj_type not in self.TYPE_NAMES:
+                raise ValueError(f"pack is corrupted: unknown object type {obj_type} at offset {obj_start}")
+            pack_stream.skip(header_len)
+            content = self._inflate_entry(pack_stream, obj_start, size)
 
-            type_name = type_names[obj_type]
-            header = f"{type_name} {len(content)}\x00".encode('ascii')
-            full_object = header + content
-
-            self._write_object(full_object)
+            # note that the decompressed data does not have the header of an usual object so we need to add that now for the sha
+            entry = [obj_start, obj_type, None, pack_stream.crc32, None]
+            pack_entries.append(entry)
+            if hasher is not None:
+                hasher.put((entry, obj_type, content), len(content))
+            else:
+                entry[4] = self._hash_object_content(obj_type, content)
+
+        return pack_entries
+
+    # 15b. second pass - resolving every delta against its base, reading back from the pack file on disk
+    # every base and all the deltas built on it (directly or down a chain) form one independent delta tree,
+    # so the trees are spread over a process pool - each worker resolves and hashes its own trees
+    # REF_DELTAs are queued by base sha (as offsets only) and hang off whichever object turns out to have that sha -
+    # whatever is still queued afterwards must be based on an object we already have (a thin pack)
+    def _resolve_deltas(self, pack_path: str, pack_entries):
+        entry_at = {}
+        ofs_children = {} # base offset -> offsets of the OFS_DELTAs built directly on it
+        ref_children = {} # base sha -> offsets of the queued REF_DELTAs waiting for it
+        for entry in pack_entries:
+            entry_at[entry[0]] = entry
+            if entry[1] == self.OBJ_OFS_DELTA:
+                ofs_children.setdefault(entry[2], []).append(entry[0])
+            elif entry[1] == self.OBJ_REF_DELTA:
+                ref_children.setdefault(entry[2], []).append(entry[0])
+
+        # sha -> offset map of everything known up front, built once - O(1) lookups for the REF_DELTA bases
+        sha_offsets = {entry[4]: entry[0] for entry in pack_entries if entry[4] is not None}
+        roots = [(offset, sha) for sha, offset in sha_offsets.items() if offset in ofs_children or sha in ref_children]
+        self._run_delta_trees(pack_path, roots, ofs_children, ref_children, entry_at)
+
+        # REF_DELTAs still unresolved - their base is not in this pack, so it has to be in the object store already
+        # (deltas on top of those are picked up by the same trees)
+        resolved_shas = {entry[4] for entry in pack_entries}
+        external = [base_sha for base_sha in ref_children if base_sha not in resolved_shas and self._has_object(base_sha.hex())]
+        self._run_delta_trees(pack_path, [(None, base_sha) for base_sha in external], ofs_children, ref_children, entry_at)
+
+        unresolved = [entry for entry in pack_entries if entry[4] is None]
+        if unresolved:
+            raise ValueError(f"pack has {len(unresolved)} unresolved deltas")
+        return external # bases a thin pack leaned on, the caller appends them to make the pack self contained
+
+    # 15c. resolving a batch of delta trees, in-process or over the pool - roots are (offset or None, sha)
+    def _run_delta_trees(self, pack_path: str, roots, ofs_children, ref_children, entry_at):
+        delta_count = sum(1 for entry in entry_at.values() if entry[4] is None)
+        jobs = min(self.jobs, len(roots))
+
+        if jobs <= 1 or delta_count < self.PARALLEL_DELTA_THRESHOLD: # not worth starting processes
+            for root_offset, root_sha in roots:
+                resolved = self._resolve_delta_tree(pack_path, root_offset, root_sha, ofs_children, ref_children, self.delta_base_cache_limit)
+                self._record_resolved(entry_at, resolved)
+            return
+
+        # the children maps go to each worker once (initializer), work items are just the roots
+        # each worker gets its share of the cache budget
+        cache_limit = self.delta_base_cache_limit // jobs
+        work = [(pack_path, root_offset, root_sha, cache_limit) for root_offset, root_sha in roots]
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        # forking while other threads run (a pipelined checkout) could copy a held lock into the child - forkserver then
+        mp_context = multiprocessing.get_context('forkserver') if threading.active_count() > 1 and os.name == 'posix' else None
+        with ProcessPoolExecutor(max_workers=jobs, mp_context=mp_context, initializer=_init_delta_worker, initargs=(self.git_dir, ofs_children, ref_children)) as pool:
+            # results are written back as they come in, while the other trees are still being resolved
+            for resolved in pool.map(_resolve_delta_tree_worker, work, chunksize=max(1, len(work) // (jobs * 8))):
+                self._record_resolved(entry_at, resolved)
+
+    # 15d. resolving one delta tree depth-first from its root - returns [(offset, type, sha)] for its deltas
+    # the root is a resolved object of the pack (root_offset) or, for a thin pack, an object of the store (root_offset None)
+    # depth-first order keeps a base hot in the cache while its deltas (and theirs) are built on it
+    def _resolve_delta_tree(self, pack_path: str, root_offset, root_sha: bytes, ofs_children, ref_children, cache_limit: int):
+        child_counts = {}
+        base_cache = DeltaBaseCache(cache_limit, child_counts)
+        ref_offsets = {} # REF_DELTA base sha -> offset, for the bases met in this tree
+        resolved = []
+
+        def children_of(offset, sha):
+            kids = ofs_children.get(offset, [])
+            if sha in ref_children:
+                kids = kids + ref_children[sha]
+                if offset is not None:
+                    ref_offsets[sha] = offset
+            return kids
+
+        pack_data = PackIndex.map_file(pack_path)
+        kids = children_of(root_offset, root_sha)
+        if root_offset is not None:
+            child_counts[root_offset] = len(kids)
+        stack = [(root_offset, kid) for kid in reversed(kids)]
+
+        while stack:
+            base_offset, offset = stack.pop()
+            obj_type, content = self._unpack_object(pack_data, offset, base_cache, ref_offsets.get)
+            sha = self._hash_object_content(obj_type, content)
+            resolved.append((offset, obj_type, sha))
+            if base_offset is not None:
+                base_cache.release(base_offset)
+
+            kids = children_of(offset, sha)
+            if kids: # now known to be a base - keep it around for its deltas
+                child_counts[offset] = len(kids)
+                base_cache.put(offset, obj_type, content)
+                stack.extend((offset, kid) for kid in reversed(kids))
+
+        return resolved
+
+    # 15e. writing resolved (offset, type, sha) results back into the pack entries
+    def _record_resolved(self, entry_at, resolved):
+        for offset, obj_type, sha in resolved:
+            entry = entry_at[offset]
+            entry[1] = obj_type # delta inherits its base type
+            entry[4] = sha
+        if self._pending_pack is not None: # checkout may be waiting for one of these
+            self._pending_pack.add((sha, offset) for offset, _, sha in resolved)
+
+    # 15f. hashing stage of _receive_pack - a batch of (entry, type, content) whole objects
+    def _hash_pack_objects(self, objects, pending=None):
+        for entry, obj_type, content in objects:
+            entry[4] = self._hash_object_content(obj_type, content)
+        if pending is not None:
+            pending.add((entry[4], entry[0]) for entry, _, _ in objects)
+
+    # 15g. inflating the data of the entry at obj_start - it has to come out exactly as big as its header said
+    def _inflate_entry(self, pack_stream: PackStream, obj_start: int, size: int) -> bytes:
+        content = pack_stream.inflate()
+        if len(content) != size:
+            raise ValueError(f"pack is corrupted: entry at offset {obj_start} inflates to {len(content)} bytes, not {size}")
+        return content
+
+    # 16b. OFS_DELTA distance, the way _read_ofs_delta_offset reads it back (that +1 quirk undone on every byte)
+    def _encode_ofs_delta_offset(self, distance: int) -> bytes:
+        out = [distance & 0x7F]
+        distance >>= 7
+        while distance:
+            distance -= 1
+            out.append(0x80 | (distance & 0x7F))
+            distance >>= 7
+        return bytes(reversed(out))
 
     # 16. Reading OFS delta offset
-    def _read_ofs_delta_offset(self, pack_data:bytes, offset: int):
+    def _read_ofs_delta_offset(self, pack_data, offset: int):
         byte = pack_data[offset]
         result = byte & 0x7F
         offset += 1
@@ -536,35 +2447,52 @@ class Git:
         result_size = read_varint() # exopected final reconstructed size
 
         result = bytearray() # will build the reconstructed object content here
-        while pos < len(delta):
+        base_view = memoryview(base) # slicing views instead of bytes - copy/insert data is only copied once, into result
+        delta_view = memoryview(delta)
+        delta_len = len(delta)
+
+        while pos < delta_len:
             byte = delta[pos]
             pos += 1
 
             if byte & 0x80:
                 # copy instruc - the msb flag is set, which say copy from base, but the rest 7 bits are also flags and not data, each flag says whether a correpsonding offset/size byte is present next
+                # bits 0 se 3 of instruction byte - will tell aboutb upto 4 offset bytes, bits 4 se 6 - upto 3 size bytes (unrolled, this is the hot loop)
                 copy_offset = 0
                 copy_size = 0 
 
-                for i in range(4): # bits 0 se 3 of instruction byte - will tell aboutb upto 4 offset bytes
-                    if byte & (1 << i):
-                        copy_offset |= delta[pos] << (8 * i)
-                        pos += 1
-
-                for i in range(3):  # bits 4 se 6 of instruction byte - will tell aboutb upto 3 size bytes
-                    if byte & (1 << (4 + i)):
-                        copy_size |= delta[pos] << (8 * i)
-                        pos += 1
+                if byte & 0x01:
+                    copy_offset = delta[pos]
+                    pos += 1
+                if byte & 0x02:
+                    copy_offset |= delta[pos] << 8
+                    pos += 1
+                if byte & 0x04:
+                    copy_offset |= delta[pos] << 16
+                    pos += 1
+                if byte & 0x08:
+                    copy_offset |= delta[pos] << 24
+                    pos += 1
+                if byte & 0x10:
+                    copy_size = delta[pos]
+                    pos += 1
+                if byte & 0x20:
+                    copy_size |= delta[pos] << 8
+                    pos += 1
+                if byte & 0x40:
+                    copy_size |= delta[pos] << 16
+                    pos += 1
 
                 if copy_size == 0: # scepific special case size 0 means 65536
                     copy_size = 0x10000
 
-                result += base[copy_offset:copy_offset + copy_size]
+                result += base_view[copy_offset:copy_offset + copy_size]
 
             else:
                 # insert instruct - new literal bytes and not from the base
                 # incstruct byte own value is the length (max 127 as the top bit is 0)
                 insert_size = byte
-                result += delta[pos : pos + insert_size]
+                result += delta_view[pos : pos + insert_size]
                 pos += insert_size
 
         return bytes(result) # reconstructed object content
@@ -577,45 +2505,2225 @@ class Git:
         # HEAD already points to "ref: refs/heads/main" from intit() - nothign to do there
 
     # 19. Walks a tree object and write real files to disk - reverse of write_tree
+    # three steps: flatten the whole tree into a work list, create every directory up front, then let a
+    # thread pool inflate and write the blobs (zlib and file writes release the GIL, so the syscalls overlap)
     def _checkout_tree(self, tree_sha: str, target_dir: str):
-        tree_path = self._object_path(tree_sha)
-        content = self._get_object_content(tree_path)
-        header, _, body = content.partition(b'\x00')
+        started = time.perf_counter()
+        directories, files, trees = self._flatten_tree(tree_sha, target_dir)
+
+        for directory in directories:
+            os.makedirs(directory, exist_ok=True)
+
+        # partial clone - the blobs we do not have yet are fetched up front, in batches, instead of one by one. Only
+        # there: while a clone's pack is still being indexed each lookup waits for its sha, so a full clone leaves it to
+        # the workers, and each file is written as soon as its own blob is resolved
+        if self._config_get('remote.origin.promisor') == 'true':
+            missing = list(dict.fromkeys(sha1_hex for _, _, sha1_hex, _ in files if not self._has_object(sha1_hex)))
+            if missing:
+                self._fetch_missing_objects(missing)
+
+        self._pack_indexes() # loading the .idx files once, before the threads race for them
+        index = GitIndex(os.path.join(self.git_dir, Git.INDEX_FILE))
+        written = 0
+        with ThreadPoolExecutor(max_workers=max(1, self.checkout_workers)) as pool:
+            # the stat data of every written file goes straight into .git/index, so write-tree starts warm
+            for file_entry, st in zip(files, pool.map(self._checkout_file, files)):
+                if st is not None:
+                    _, mode, sha1_hex, rel_path = file_entry
+                    index.entries[rel_path] = (index.stat_fields(st, mode), bytes.fromhex(sha1_hex))
+                    written += st.st_size
+
+        # every tree we just checked out is a valid cached tree - entry count is the index entries below it
+        entry_counts = dict.fromkeys(trees, 0)
+        for rel_path in index.entries:
+            while rel_path:
+                rel_path = rel_path.rpartition('/')[0]
+                entry_counts[rel_path] += 1
+        for rel_dir, (sha1_hex, subtree_count) in trees.items():
+            index.trees[rel_dir] = (entry_counts[rel_dir], subtree_count, bytes.fromhex(sha1_hex))
+        index.write()
+        if self.stats is not None:
+            self.stats.add('checkout', time.perf_counter() - started, len(files), written)
+        if self.trace is not None:
+            self.trace.count('files checked out', len(files))
+            self.trace.count('bytes checked out', written)
+
+    # 19b. Flattening a tree (iteratively) into the directories to create, the (path, mode, sha, repo path) files
+    # to write, and the trees met on the way (repo path -> (sha, subtree count))
+    def _flatten_tree(self, tree_sha: str, target_dir: str):
+        directories = []
+        files = []
+        trees = {}
+        pending = [(tree_sha, target_dir, '')]
+
+        while pending:
+            sha, directory, rel_dir = pending.pop()
+            prefix = rel_dir + '/' if rel_dir else ''
+            subtree_count = 0
+
+            for file_name, mode, entry_sha in self._parse_tree(sha):
+                full_path = os.path.join(directory, file_name)
+
+                if mode == Git.MODE_TREE: # subtree, goes on the work list instead of recursion
+                    directories.append(full_path)
+                    pending.append((entry_sha.hex(), full_path, prefix + file_name))
+                    subtree_count += 1
+                elif mode == Git.MODE_GITLINK: # submodule commit - real git leaves an empty directory too
+                    directories.append(full_path)
+                else:
+                    files.append((full_path, mode, entry_sha.hex(), prefix + file_name))
+
+            trees[rel_dir] = (sha, subtree_count)
+
+        return directories, files, trees
+
+    # 19c. Writing one blob to disk - runs on a checkout worker thread
+    # 100755 -> executable file, 120000 -> symlink whose target is the blob content, anything else -> regular file
+    # returns the stat of the written file for the index (lstat for symlinks - git hashes the link text, not its target)
+    def _checkout_file(self, file_entry):
+        full_path, mode, sha1_hex, _ = file_entry
+
+        if os.path.lexists(full_path): # re-checkout over an existing file or symlink
+            os.remove(full_path)
+
+        if mode == Git.MODE_SYMLINK:
+            content = self._read_object(sha1_hex)
+            os.symlink(content[content.index(b'\x00') + 1:].decode('utf-8'), full_path)
+            return os.lstat(full_path) # the link itself, indexed as 120000 like git does
+
+        permissions = 0o777 if mode == 0o100755 else 0o666 # umask applies, like real git
+        fd = os.open(full_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, permissions)
+        with open(fd, 'wb') as f:
+            loose_path = self._object_path(sha1_hex)
+            if os.path.exists(loose_path):
+                self._inflate_loose_into(loose_path, f)
+            else: # packed - write the body straight out of the object bytes, no partition copy
+                content = self._read_object(sha1_hex)
+                with memoryview(content) as view:
+                    f.write(view[content.index(b'\x00') + 1:])
+        return os.stat(full_path)
+
+    # 19d. Inflating a loose blob chunk by chunk into an open file, through this worker's preallocated buffer
+    def _inflate_loose_into(self, loose_path: str, f):
+        buffer = getattr(self._checkout_local, 'buffer', None)
+        if buffer is None:
+            buffer = self._checkout_local.buffer = bytearray(self.CHECKOUT_BUFFER_SIZE)
+
+        decompressor = zlib.decompressobj()
+        header = b'' # "blob <size>\0" has to be skipped, it may straddle two chunks
+        with open(loose_path, 'rb') as src, memoryview(buffer) as view:
+            while True:
+                n = src.readinto(buffer)
+                if not n:
+                    break
+                data = decompressor.decompress(view[:n])
+                if header is not None:
+                    header += data
+                    null_ind = header.find(b'\x00')
+                    if null_ind == -1:
+                        continue
+                    data = header[null_ind + 1:]
+                    header = None
+                f.write(data)
+            f.write(decompressor.flush())
+
+    # 19f. Writing .git/config for a clone - the remote url, plus the promisor settings for a partial clone
+    # (same keys real git uses, so it can lazily fetch in this repo too)
+    def _write_config(self, repo_url: str, filter_spec=None):
+        lines = ['[core]', f"\trepositoryformatversion = {1 if filter_spec else 0}", '\tbare = false']
+        lines += ['[remote "origin"]', f"\turl = {repo_url}"]
+        if filter_spec:
+            lines += ['\tpromisor = true', f"\tpartialclonefilter = {filter_spec}"]
+            lines += ['[extensions]', '\tpartialclone = origin']
+        with open(os.path.join(self.git_dir, Git.CONFIG_FILE), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    # 19g. Reading one value out of .git/config - key as "section.subsection.name", e.g. remote.origin.url
+    def _config_get(self, key: str):
+        try:
+            with open(os.path.join(self.git_dir, Git.CONFIG_FILE)) as f:
+                config_lines = f.read().splitlines()
+        except FileNotFoundError:
+            return None
+
+        section = ''
+        for line in config_lines:
+            line = line.strip()
+            if not line or line[0] in '#;':
+                continue
+            if line.startswith('['): # [core] or [remote "origin"]
+                name, _, subsection = line[1:-1].partition(' ')
+                section = name.lower() + ('.' + subsection.strip('"') if subsection else '')
+                continue
+            name, _, value = line.partition('=')
+            if f"{section}.{name.strip().lower()}" == key:
+                return value.strip()
+        return None
+
+    # 19h. Partial clone - fetching objects we do not have from the promisor remote, LAZY_FETCH_BATCH wants per request
+    # returns False when this is not a partial clone (or the remote could not give us the objects)
+    def _fetch_missing_objects(self, shas) -> bool:
+        if self._config_get('remote.origin.promisor') != 'true':
+            return False
+        repo_url = self._config_get('remote.origin.url')
+        shas = [sha for sha in shas if len(sha) == 40 and all(c in '0123456789abcdef' for c in sha)]
+        if not repo_url or not shas:
+            return False
+
+        import http.client # for its errors - the transport loads it anyway
+        try:
+            for start in range(0, len(shas), self.LAZY_FETCH_BATCH):
+                batch = [sha.encode('ascii') for sha in shas[start:start + self.LAZY_FETCH_BATCH]]
+                _, pack_source = self._request_pack(repo_url, batch)
+                self._receive_pack(self._open_pack_stream(pack_source), promisor=True)
+        except (OSError, ValueError, EOFError, http.client.HTTPException) as e:
+            print(f"warning: could not fetch missing objects from {repo_url}: {e}", file=sys.stderr)
+            return False
+        return True
+
+    # 19e. .git/index of the current repo (empty if there is none yet)
+    def _load_index(self) -> GitIndex:
+        return GitIndex.read(os.path.join(self.git_dir, Git.INDEX_FILE))
+
+    # 20. Reading any object by sha - loose file first, then the packs - full content with header, or None
+    # recently read objects come out of an in-process LRU cache
+    def _read_object(self, sha: str):
+        cached = self._object_cache.get(sha)
+        if cached is not None:
+            return cached[1]
+
+        content = self._get_object_content(self._object_path(sha))
+        if content is None:
+            packed = self._find_packed(sha)
+            if packed is None and self._fetch_missing_objects([sha]): # partial clone - ask the promisor remote
+                packed = self._find_packed(sha)
+            if packed is None:
+                return None
+
+            pack_index, offset = packed
+            obj_type, body = self._read_packed_object(pack_index, offset)
+            content = f"{self.TYPE_NAMES[obj_type]} {len(body)}\x00".encode('ascii') + body
+
+        self._object_cache.put(sha, None, content)
+        return content
+
+    # 20b. (type name, size) of an object without inflating more than its header - or None if there is no such object
+    def _object_info(self, sha: str):
+        cached = self._object_cache.get(sha)
+        if cached is not None:
+            header = cached[1][:cached[1].index(b'\x00')]
+        else:
+            header = self._read_loose_header(self._object_path(sha))
+
+        if header is not None:
+            type, _, size = header.partition(b'\x20')
+            return type.decode('ascii'), int(size)
+
+        packed = self._find_packed(sha)
+        if packed is None and self._fetch_missing_objects([sha]): # partial clone - ask the promisor remote
+            packed = self._find_packed(sha)
+        if packed is None:
+            return None
+        return self._packed_object_info(*packed)
+
+    # 20c. inflating just "<type> <size>" of a loose object - small reads, small output window
+    def _read_loose_header(self, file_path: str):
+        try:
+            with open(file_path, 'rb') as f:
+                decompressor = zlib.decompressobj()
+                header = b''
+                while b'\x00' not in header:
+                    data = decompressor.unconsumed_tail or f.read(self.HEADER_WINDOW)
+                    if not data:
+                        return None
+                    header += decompressor.decompress(data, self.HEADER_WINDOW)
+                return header[:header.index(b'\x00')]
+        except (FileNotFoundError, zlib.error):
+            return None
+
+    # 20d. (type name, size) of a packed object from the entry headers alone - a delta's size sits at the front of its
+    # delta data, and its type is the type at the bottom of the chain, found by walking headers only
+    def _packed_object_info(self, pack_index: PackIndex, offset: int):
+        pack_data = pack_index.pack_data()
+        size = None
+        while True:
+            obj_type, entry_size, header_end = self._read_object_header(pack_data, offset)
+
+            if obj_type == self.OBJ_OFS_DELTA:
+                back_distance, header_end = self._read_ofs_delta_offset(pack_data, header_end)
+                base_offset = offset - back_distance
+            elif obj_type == self.OBJ_REF_DELTA:
+                base_sha = bytes(pack_data[header_end:header_end + 20])
+                header_end += 20
+                base_offset = pack_index.find(base_sha)
+            else:
+                return self.TYPE_NAMES[obj_type], entry_size if size is None else size
+
+            if size is None: # result size of the top delta = size of the object asked for
+                decompressor = zlib.decompressobj()
+                delta_head = b''
+                pos = header_end
+                # both varints fit in 20 bytes - a deflate block header can take more than one window to get there
+                while len(delta_head) < 20 and not decompressor.eof:
+                    window = pack_data[pos:pos + self.HEADER_WINDOW]
+                    if not window:
+                        break
+                    pos += len(window)
+                    delta_head += decompressor.decompress(window, 20 - len(delta_head))
+                    while decompressor.unconsumed_tail and len(delta_head) < 20:
+                        delta_head += decompressor.decompress(decompressor.unconsumed_tail, 20 - len(delta_head))
+                pos = 0
+                for _ in range(2): # base size varint, then result size varint
+                    size, shift = 0, 0
+                    while True:
+                        byte = delta_head[pos]
+                        pos += 1
+                        size |= (byte & 0x7F) << shift
+                        shift += 7
+                        if not byte & 0x80:
+                            break
+
+            if base_offset is None: # REF_DELTA against an object outside this pack
+                base_info = self._object_info(base_sha.hex())
+                return (base_info[0] if base_info else None), size
+            offset = base_offset
+
+    # 21. Loading (once) the .idx of every pack under .git/objects/pack
+    def _pack_indexes(self):
+        packs = self._packs
+        if packs is None: # built aside and then published - a server thread never sees a half loaded list
+            pack_dir = os.path.join(self.git_dir, Git.OBJECTS_DIR, Git.PACK_DIR)
+            packs = []
+            if os.path.isdir(pack_dir):
+                for name in sorted(os.listdir(pack_dir)):
+                    if name.endswith('.idx') and os.path.exists(os.path.join(pack_dir, name[:-4] + '.pack')):
+                        packs.append(PackIndex(os.path.join(pack_dir, name)))
+            self._packs = packs
+        return packs
+
+    # 22. Finding which pack holds a sha - binary search of each .idx - returns (PackIndex, offset) or None
+    def _find_packed(self, sha: str):
+        try:
+            sha_bytes = bytes.fromhex(sha)
+        except ValueError: # not a sha at all
+            return None
+        if len(sha_bytes) != 20:
+            return None
+        for pack_index in self._pack_indexes():
+            offset = pack_index.find(sha_bytes)
+            if offset is not None:
+                return pack_index, offset
+        pending = self._pending_pack
+        if pending is not None: # pack still being indexed - waits until this sha is resolved (or never will be)
+            offset = pending.find(sha_bytes)
+            if offset is not None:
+                return pending, offset
+        return None
+
+    # 23. Inflating one object out of a pack (by its .idx) at a given offset - returns (type, content)
+    def _read_packed_object(self, pack_index: PackIndex, offset: int):
+        return self._unpack_object(pack_index.pack_data(), offset, pack_index.base_cache, pack_index.find)
+
+    # 23b. Reading one raw pack entry at offset, straight out of the mapped pack - returns (type, base offset,
+    # base sha, inflated data); the headers are parsed in place, only the inflated data is new memory
+    def _read_pack_entry(self, pack_data, offset: int):
+        obj_type, size, header_end = self._read_object_header(pack_data, offset)
+        base_offset = base_sha = None
+
+        if obj_type == self.OBJ_OFS_DELTA:
+            back_distance, header_end = self._read_ofs_delta_offset(pack_data, header_end)
+            base_offset = offset - back_distance
+        elif obj_type == self.OBJ_REF_DELTA:
+            base_sha = bytes(pack_data[header_end:header_end + 20])
+            header_end += 20
+
+        return obj_type, base_offset, base_sha, self._inflate_at(pack_data, header_end, size)
+
+    # 23f. Inflating the zlib stream at pack_data[start:] - size is what it inflates to, so the first window (size plus
+    # a little, deflate hardly ever grows data more) nearly always holds the whole stream; the rest of the pack is
+    # never touched
+    def _inflate_at(self, pack_data, start: int, size: int) -> bytes:
+        decompressor = zlib.decompressobj()
+        window = size + 1024
+        out = []
+        while not decompressor.eof:
+            chunk = pack_data[start:start + window]
+            if not chunk:
+                raise EOFError("pack ended inside a compressed object")
+            out.append(decompressor.decompress(chunk))
+            start += len(chunk)
+            window = PackStream.CHUNK_SIZE
+        return out[0] if len(out) == 1 else b''.join(out)
+
+    # 23c. Unpacking the object at offset, walking its delta chain down to a cached or plain base, then
+    # replaying the deltas back up - iterative, so long chains do not hit the recursion limit
+    # find_offset(sha bytes) -> offset or None locates REF_DELTA bases inside the same pack, otherwise the store is asked
+    def _unpack_object(self, pack_data, offset: int, base_cache: DeltaBaseCache, find_offset=None):
+        chain = [] # (offset, delta) from the requested object down towards the base
+
+        while True:
+            cached = base_cache.get(offset)
+            if cached is not None:
+                obj_type, content = cached
+                break
+
+            obj_type, base_offset, base_sha, data = self._read_pack_entry(pack_data, offset)
+
+            if obj_type == self.OBJ_OFS_DELTA:
+                chain.append((offset, data))
+                offset = base_offset
+                continue
+
+            if obj_type == self.OBJ_REF_DELTA:
+                base_offset = find_offset(base_sha) if find_offset else None
+                if base_offset is not None: # base in the same pack - keep walking the chain
+                    chain.append((offset, data))
+                    offset = base_offset
+                    continue
+
+                base = self._read_object(base_sha.hex())
+                base_header, _, base_content = base.partition(b'\x00')
+                obj_type = self._type_from_name(base_header.split(b' ')[0])
+                content = self._apply_delta(base_content, data)
+            else:
+                content = data
+            base_cache.put(offset, obj_type, content)
+            break
+
+        for delta_offset, delta in reversed(chain):
+            content = self._apply_delta(content, delta)
+            base_cache.put(delta_offset, obj_type, content)
+
+        return obj_type, content
+
+    # 23d. sha of an object the way git names it - header + content, without building the joined bytes
+    def _hash_object_content(self, obj_type: int, content: bytes) -> bytes:
+        sha1 = hashlib.sha1(f"{self.TYPE_NAMES[obj_type]} {len(content)}\x00".encode('ascii'))
+        sha1.update(content)
+        return sha1.digest()
+
+    # 23e. Is the object in the store at all - loose or packed - without inflating it
+    def _has_object(self, sha: str) -> bool:
+        return os.path.exists(self._object_path(sha)) or self._find_packed(sha) is not None
+
+    # 24. object type name -> pack type number
+    def _type_from_name(self, type_name: bytes) -> int:
+        for obj_type, name in self.TYPE_NAMES.items():
+            if name.encode('ascii') == type_name:
+                return obj_type
+        raise ValueError(f"unknown object type {type_name!r}")
+
+    # 25. Receiving a pack stream: write it as-is under objects/pack while parsing, then generate its .idx
+    # a pack from a promisor remote (partial clone) gets a .promisor marker, like git - objects it leaves out are expected
+    def _receive_pack(self, pack_stream: PackStream, promisor: bool = False, overlap=None) -> str:
+        pack_dir = os.path.join(self.git_dir, Git.OBJECTS_DIR, Git.PACK_DIR)
+        os.makedirs(pack_dir, exist_ok=True)
+        fd, tmp_pack_path = tempfile.mkstemp(prefix='tmp_pack_', dir=pack_dir) # unique - a lazy fetch may nest in here
+        stats = self.stats
+
+        # pipelined - the network, parsing/inflating (this thread), hashing and disk writes each have their own thread
+        pack_stream.source = PrefetchReader(pack_stream.source, PackStream.CHUNK_SIZE, stats)
+        if self.trace is not None:
+            pack_stream.inflate = self.trace.wrap('inflate (stream)', pack_stream.inflate, 'bytes inflated')
+        pending = PendingPack(tmp_pack_path) if overlap is not None else None
+
+        with open(fd, 'wb') as pack_file:
+            writer = PipelineStage('write', pack_file.writelines, stats)
+            hasher = PipelineStage('hash', lambda objects: self._hash_pack_objects(objects, pending), stats)
+            sink = lambda data: writer.put(bytes(data), len(data)) # bytes lands on disk as they are parsed
+            pack_stream.sinks.append(sink)
+            started = time.perf_counter()
+            try:
+                try:
+                    with self._phase('receive pack'):
+                        pack_entries, pack_sha = self._read_pack(pack_stream, hasher) # checked as it comes in
+                finally:
+                    pack_stream.sinks.remove(sink)
+                    writer.close()
+                    hasher.close()
+            except BaseException: # short or corrupt - nothing of it may stay behind in the object store
+                os.remove(tmp_pack_path)
+                raise
+            if stats:
+                stats.add('parse', time.perf_counter() - started - pack_stream.source.wait, len(pack_entries), pack_stream.offset)
+
+        # the pack is complete on disk - overlap (the clone's checkout) starts reading it while the deltas get resolved,
+        # each object it asks for is handed over as soon as it is
+        errors = []
+        if overlap is not None:
+            def run_overlap():
+                try:
+                    overlap()
+                except BaseException as e:
+                    errors.append(e)
+            self._pending_pack = pending
+            overlap_thread = threading.Thread(target=run_overlap, name='checkout', daemon=True)
+            overlap_thread.start()
+
+        started = time.perf_counter()
+        try:
+            try:
+                with self._phase('resolve deltas'):
+                    external_bases = self._resolve_deltas(tmp_pack_path, pack_entries)
+            finally:
+                if pending is not None:
+                    pending.finish()
+            if self.trace is not None:
+                self._trace_pack_entries(pack_entries)
+            if stats:
+                stats.add('deltas', time.perf_counter() - started, sum(1 for entry in pack_entries if entry[2] is not None))
+            if external_bases: # thin pack - completing it with the local bases, like index-pack --fix-thin
+                pack_sha = self._fix_thin_pack(tmp_pack_path, external_bases, pack_entries)
+        except BaseException: # deltas that cannot be resolved - the pack does not go into the store either
+            if overlap is not None:
+                overlap_thread.join()
+                self._pending_pack = None
+            os.remove(tmp_pack_path)
+            raise
+
+        if overlap is not None: # the pack keeps its tmp name until nobody reads it through the pending index
+            overlap_thread.join()
+            self._pending_pack = None
+
+        started = time.perf_counter()
+        pack_name = f"pack-{pack_sha.hex()}"
+        pack_path = os.path.join(pack_dir, pack_name + '.pack')
+        os.chmod(tmp_pack_path, 0o444) # packs never change once written, like loose objects
+        os.replace(tmp_pack_path, pack_path)
+
+        index_entries = [(sha, crc, offset) for offset, _, _, crc, sha in pack_entries]
+        with self._phase('write index'):
+            self._write_pack_index(os.path.join(pack_dir, pack_name + '.idx'), index_entries, pack_sha)
+        if promisor:
+            open(os.path.join(pack_dir, pack_name + '.promisor'), 'w').close()
+        self._packs = None # new pack on disk, reload the indexes next time
+        if stats:
+            stats.add('index', time.perf_counter() - started, len(pack_entries))
+        if errors: # the pack itself is fine and stays, what failed was the overlapped work
+            raise errors[0]
+        return pack_sha.hex()
+
+    # 25b. Appending the objects a thin pack deltas against (they are in our store) as whole objects, then fixing the
+    # object count in the header and the trailing checksum - returns the new pack checksum
+    def _fix_thin_pack(self, pack_path: str, base_shas, pack_entries) -> bytes:
+        with open(pack_path, 'r+b') as pack_file:
+            pack_file.seek(0, os.SEEK_END)
+            pack_file.truncate(pack_file.tell() - 20) # the old checksum goes, a new one is computed below
+            pack_file.seek(0, os.SEEK_END)
+
+            for base_sha in base_shas:
+                content = self._read_object(base_sha.hex())
+                header, _, body = content.partition(b'\x00')
+                obj_type = self._type_from_name(header.split(b' ')[0])
+                entry = self._encode_object_header(obj_type, len(body)) + zlib.compress(body)
+                pack_entries.append([pack_file.tell(), obj_type, None, zlib.crc32(entry), base_sha])
+                pack_file.write(entry)
+
+            pack_file.seek(8)
+            object_count = struct.unpack('>I', pack_file.read(4))[0] + len(base_shas)
+            return self._finish_pack(pack_file, object_count)
+
+    # 25i. Closing off a pack written with a provisional header - puts the real object count in and appends the
+    # trailing checksum over the whole file; returns the checksum
+    def _finish_pack(self, pack_file, object_count: int) -> bytes:
+        pack_file.seek(8)
+        pack_file.write(struct.pack('>I', object_count))
+
+        pack_file.seek(0)
+        pack_sha = hashlib.sha1()
+        while True:
+            chunk = pack_file.read(PackStream.CHUNK_SIZE)
+            if not chunk:
+                break
+            pack_sha.update(chunk)
+        pack_file.write(pack_sha.digest())
+        return pack_sha.digest()
+
+    # 25c. Pack object header - type in bits 6-4 of the first byte, size in 4 bits + 7 bits per continuation byte
+    # (the exact reverse of _read_object_header)
+    def _encode_object_header(self, obj_type: int, size: int) -> bytes:
+        byte = (obj_type << 4) | (size & 0x0F)
+        size >>= 4
+        out = bytearray()
+        while size:
+            out.append(byte | 0x80)
+            byte = size & 0x7F
+            size >>= 7
+        out.append(byte)
+        return bytes(out)
+
+    # 25d. Tracing what a received pack held, once its deltas are resolved - see _pack_entry_stats
+    def _trace_pack_entries(self, pack_entries):
+        type_counts, delta_counts, depths = self._pack_entry_stats(pack_entries)
+        counts = {f"objects parsed: {name}": count for name, count in type_counts.items()}
+        counts.update((f"deltas: {kind}", count) for kind, count in delta_counts.items())
+        for name, count in sorted(counts.items()):
+            self.trace.count(name, count)
+        for depth in depths.values():
+            self.trace.observe('delta chain depth', depth)
+
+    # 25e. What a pack holds, once its deltas are resolved - ({type name: objects}, {'ofs' / 'ref': deltas},
+    # {delta offset: chain depth}). A delta counts as its base's type. A delta entry keeps its base in [2]: the base
+    # offset (OFS_DELTA) or sha bytes (REF_DELTA) - a base outside the pack (thin pack) is depth 0
+    def _pack_entry_stats(self, pack_entries):
+        entry_at = {entry[0]: entry for entry in pack_entries}
+        sha_offsets = {entry[4]: entry[0] for entry in pack_entries}
+        type_counts = {}
+        delta_counts = {}
+        depths = {} # delta offset -> chain depth
+        for entry in pack_entries:
+            name = self.TYPE_NAMES[entry[1]]
+            type_counts[name] = type_counts.get(name, 0) + 1
+            if entry[2] is not None:
+                kind = 'ofs' if isinstance(entry[2], int) else 'ref'
+                delta_counts[kind] = delta_counts.get(kind, 0) + 1
+            chain = []
+            while entry is not None and entry[2] is not None and entry[0] not in depths:
+                chain.append(entry[0])
+                entry = entry_at.get(entry[2] if isinstance(entry[2], int) else sha_offsets.get(entry[2]))
+            depth = depths.get(entry[0], 0) if entry is not None else 0
+            for offset in reversed(chain):
+                depth += 1
+                depths[offset] = depth
+        return type_counts, delta_counts, depths
+
+    # 25f. The stats index-pack -v and verify-pack print - objects by type, deltas by kind, then the delta chain
+    # histogram exactly as git verify-pack prints it
+    def _pack_stats_lines(self, pack_entries):
+        type_counts, delta_counts, depths = self._pack_entry_stats(pack_entries)
+        plural = lambda count: 'object' if count == 1 else 'objects'
+        lines = [
+            f"{len(pack_entries)} {plural(len(pack_entries))}: " + ', '.join(f"{name} {type_counts.get(name, 0)}" for name in self.TYPE_NAMES.values()),
+            f"{len(depths)} deltas: ofs {delta_counts.get('ofs', 0)}, ref {delta_counts.get('ref', 0)}, longest chain {max(depths.values(), default=0)}",
+        ]
+        histogram = {}
+        for depth in depths.values():
+            histogram[depth] = histogram.get(depth, 0) + 1
+        non_delta = len(pack_entries) - len(depths)
+        lines.append(f"non delta: {non_delta} {plural(non_delta)}")
+        lines += [f"chain length = {depth}: {count} {plural(count)}" for depth, count in sorted(histogram.items())]
+        return lines
+
+    # 25g. A pack file on disk, parsed and checked like a received one (_read_pack), its deltas resolved - returns
+    # (pack entries, checksum bytes). Exits on a broken pack, and on a thin one: a delta whose base is not in the pack
+    # can't be indexed from the file alone
+    def _index_pack_file(self, pack_path: str):
+        try:
+            with open(pack_path, 'rb') as f:
+                pack_stream = PackStream(f)
+                pack_entries, pack_sha = self._read_pack(pack_stream)
+                if pack_stream.peek(1):
+                    raise ValueError("pack has trailing garbage")
+        except (OSError, ValueError, EOFError) as e:
+            print(f"fatal: {pack_path}: {e}", file=sys.stderr)
+            sys.exit(128)
+
+        try:
+            external = self._resolve_deltas(pack_path, pack_entries)
+        except ValueError as e:
+            print(f"fatal: {pack_path}: {e}", file=sys.stderr)
+            sys.exit(128)
+        if external:
+            print(f"fatal: {pack_path}: pack has deltas against {len(external)} objects outside of it (a thin pack)", file=sys.stderr)
+            sys.exit(128)
+        return pack_entries, pack_sha
+
+    # 25h. Checking a pack against its .idx - both checksums, and every object's sha, offset and CRC32 as indexing the
+    # pack again finds them. Problems are printed; returns whether there were none. verbose lists every object the
+    # way git verify-pack -v does: sha, type, size, size in the pack, offset (+ chain depth and base sha for a delta)
+    def _verify_pack(self, pack_path: str, idx_path: str, verbose=False, stat_only=False) -> bool:
+        try:
+            pack_index = PackIndex(idx_path)
+        except (OSError, ValueError) as e:
+            print(f"error: {e}", file=sys.stderr)
+            return False
+        errors = []
+        idx_data = pack_index.data
+        if hashlib.sha1(idx_data[:-20]).digest() != idx_data[-20:]:
+            errors.append(f"{idx_path}: index checksum mismatch")
+
+        pack_entries, pack_sha = self._index_pack_file(pack_path)
+        if idx_data[-40:-20] != pack_sha:
+            errors.append(f"{idx_path}: index is for another pack")
+        indexed = {pack_index.sha_at(i): (pack_index.offset_at(i), pack_index.crc_at(i)) for i in range(pack_index.count)}
+        if len(indexed) != len(pack_entries):
+            errors.append(f"{idx_path}: {len(indexed)} objects in the index, {len(pack_entries)} in the pack")
+        for offset, _, _, crc, sha in pack_entries:
+            if sha not in indexed:
+                errors.append(f"{sha.hex()} at offset {offset} is not in the index")
+            elif indexed[sha] != (offset, crc):
+                errors.append(f"{sha.hex()}: index says offset {indexed[sha][0]} crc {indexed[sha][1]:08x}, pack has {offset} {crc:08x}")
+
+        if verbose and not stat_only:
+            pack_data = PackIndex.map_file(pack_path)
+            sha_at = {entry[0]: entry[4] for entry in pack_entries}
+            _, _, depths = self._pack_entry_stats(pack_entries)
+            ends = [entry[0] for entry in pack_entries[1:]] + [len(pack_data) - 20]
+            out = []
+            for (offset, obj_type, base, _, sha), end in zip(pack_entries, ends):
+                size = self._read_object_header(pack_data, offset)[1]
+                line = f"{sha.hex()} {self.TYPE_NAMES[obj_type]:<6} {size} {end - offset} {offset}"
+                if base is not None:
+                    line += f" {depths[offset]} {(sha_at[base] if isinstance(base, int) else base).hex()}"
+                out.append(line + '\n')
+            sys.stdout.writelines(out)
+        if verbose or stat_only:
+            print('\n'.join(self._pack_stats_lines(pack_entries)))
+        for error in errors:
+            print(f"error: {error}", file=sys.stderr)
+        if verbose and not stat_only:
+            print(f"{pack_path}: {'bad' if errors else 'ok'}")
+        return not errors
+
+    # 26. Writing a version 2 .idx for (sha bytes, crc32, offset) entries - see PackIndex for the layout
+    def _write_pack_index(self, idx_path: str, index_entries, pack_sha: bytes):
+        index_entries = sorted(index_entries)
+
+        fanout = [0] * 256
+        for sha, _, _ in index_entries:
+            fanout[sha[0]] += 1
+        for i in range(1, 256): # cumulative counts
+            fanout[i] += fanout[i - 1]
+
+        small_offsets = []
+        large_offsets = []
+        for _, _, offset in index_entries:
+            if offset < 0x80000000:
+                small_offsets.append(offset)
+            else: # does not fit in 31 bits - store it in the 8 byte table and point at it
+                small_offsets.append(0x80000000 | len(large_offsets))
+                large_offsets.append(offset)
+
+        count = len(index_entries)
+        idx_data = b''.join([
+            PackIndex.IDX_MAGIC,
+            struct.pack('>I', PackIndex.IDX_VERSION),
+            struct.pack('>256I', *fanout),
+            b''.join(sha for sha, _, _ in index_entries),
+            struct.pack(f'>{count}I', *(crc for _, crc, _ in index_entries)),
+            struct.pack(f'>{count}I', *small_offsets),
+            struct.pack(f'>{len(large_offsets)}Q', *large_offsets),
+            pack_sha,
+        ])
+        idx_data += hashlib.sha1(idx_data).digest()
+
+        tmp_idx_path = idx_path + '.tmp'
+        with open(tmp_idx_path, 'wb') as f:
+            f.write(idx_data)
+        os.chmod(tmp_idx_path, 0o444)
+        os.replace(tmp_idx_path, idx_path)
+
+    # 27. have/want negotiation for fetch - our commits newest first, in doubling batches, until the server is "ready",
+    # we run out, or MAX_HAVES_IN_VAIN haves bring nothing new; returns the commits both sides have (bytes shas), plus
+    # the pack when a v2 server already sent it (stateless http - every round resends the wants and the common haves)
+    def _negotiate(self, repo_url, wanted, shallow_shas, filter_spec):
+        queue = [] # (-commit time, sha) heap - newest commit first
+        seen = set()
+        for ref_path in self._local_refs():
+            sha = self._resolve_ref(ref_path)
+            if sha and sha not in seen and self._has_object(sha):
+                seen.add(sha)
+                heapq.heappush(queue, (-self._parse_commit(sha)[2], sha))
+
+        common = []
+        common_set = set()
+        batch_size = 16
+        in_vain = 0
+
+        while queue and in_vain < self.MAX_HAVES_IN_VAIN:
+            batch = []
+            while queue and len(batch) < batch_size:
+                _, sha = heapq.heappop(queue)
+                if sha not in common_set: # ancestors of a common commit are common too - no need to say them
+                    batch.append(sha)
+                for parent in self._parse_commit(sha)[1]:
+                    if parent not in seen and self._has_object(parent): # shallow history just stops
+                        seen.add(parent)
+                        if sha in common_set:
+                            common_set.add(parent)
+                        heapq.heappush(queue, (-self._parse_commit(parent)[2], parent))
+            if not batch:
+                break
+
+            haves = common + [sha.encode('ascii') for sha in batch]
+            reply, pack_source = self._request_pack(repo_url, wanted, filter_spec=filter_spec, haves=haves, shallow_shas=shallow_shas, done=False)
+
+            found = 0
+            ready = False
+            for line in reply: # v0: "ACK <sha> common|ready", v2: "ACK <sha>" lines and a separate "ready"
+                if line.startswith(b'ACK '):
+                    parts = line.split()
+                    sha = parts[1].decode('ascii')
+                    if sha not in common_set:
+                        common_set.add(sha)
+                        common.append(parts[1])
+                        found += 1
+                    ready = ready or (len(parts) > 2 and parts[2] == b'ready')
+                ready = ready or line == b'ready'
+
+            if pack_source is not None:
+                return common, pack_source
+            in_vain = 0 if found else in_vain + len(batch)
+            if ready:
+                break
+            batch_size = min(batch_size * 2, 1024)
+
+        return common, None
+
+    # 27b. (tree sha, parent shas, commit time) of a commit - only the header lines are looked at
+    def _parse_commit(self, sha: str):
+        content = self._read_object(sha)
+        _, _, body = content.partition(b'\x00')
+        tree_sha = None
+        parents = []
+        commit_time = 0
+        for line in body.split(b'\n'):
+            if not line: # blank line - the message starts
+                break
+            key, _, value = line.partition(b' ')
+            if key == b'tree':
+                tree_sha = value.decode('ascii')
+            elif key == b'parent':
+                parents.append(value.decode('ascii'))
+            elif key == b'committer':
+                commit_time = int(value.rsplit(b' ', 2)[1])
+        return tree_sha, parents, commit_time
+
+    # 27c. every ref (heads, remotes, tags) - the files under .git/refs plus the ones only in .git/packed-refs, as
+    # paths relative to .git
+    def _local_refs(self):
+        refs = set(self._packed_refs())
+        refs_root = os.path.join(self.git_dir, self.REFS_DIR)
+        for root, _, names in os.walk(refs_root):
+            for name in names:
+                refs.add(os.path.relpath(os.path.join(root, name), self.git_dir).replace(os.sep, '/'))
+        return sorted(refs)
+
+    # 27d. reading / writing a ref file - sha (or "ref: <target>" for a symbolic ref) or None; a ref with no file
+    # of its own is looked up in .git/packed-refs, the loose file wins when both have it (like git)
+    def _read_ref(self, ref_path: str):
+        try:
+            with open(os.path.join(self.git_dir, ref_path)) as f:
+                return f.read().strip() or None
+        except (FileNotFoundError, IsADirectoryError):
+            return self._packed_refs().get(ref_path.replace(os.sep, '/'))
+
+    # 27f. a ref down to its sha - symbolic refs (HEAD, refs/remotes/origin/HEAD) are followed; None if it
+    # does not resolve to something that looks like a sha
+    def _resolve_ref(self, ref_path: str):
+        sha = self._read_ref(ref_path)
+        for _ in range(5): # git gives up on deeper symref chains too
+            if not sha or not sha.startswith('ref: '):
+                break
+            sha = self._read_ref(sha[5:].strip())
+        return sha if sha and self._is_sha(sha) else None
+
+    # 27g. .git/packed-refs as {ref name: sha hex}, cached until the file changes - "^<sha>" lines (the peeled
+    # target of the tag above) and the header comment are skipped
+    def _packed_refs(self):
+        path = os.path.join(self.git_dir, Git.PACKED_REFS_FILE)
+        if self._store_changed(path) or self._packed_refs_cache is None:
+            refs = {}
+            try:
+                with open(path) as f:
+                    for line in f:
+                        sha, _, name = line.rstrip('\n').partition(' ')
+                        if name and not sha.startswith(('#', '^')):
+                            refs[name] = sha
+            except FileNotFoundError:
+                pass
+            self._packed_refs_cache = refs
+        return self._packed_refs_cache
+
+    # 27h. 40 lowercase hex digits
+    def _is_sha(self, name: str) -> bool:
+        return len(name) == 40 and all(c in '0123456789abcdef' for c in name)
+
+    def _write_ref(self, ref_path: str, sha: str):
+        full_path = os.path.join(self.git_dir, ref_path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'w') as f:
+            f.write(sha + '\n')
+
+    # 27e. commits listed in .git/shallow (bytes shas) - the cut-off points of a shallow clone
+    def _read_shallow(self):
+        try:
+            with open(os.path.join(self.git_dir, Git.SHALLOW_FILE), 'rb') as f:
+                return [line.strip() for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    # 28. Writing objects [(sha hex, name)] into <pack_prefix>-<checksum>.pack + .idx - returns (checksum hex, delta count)
+    # delta bases are picked with git's sliding window: objects sorted by type, name hash and size (biggest first),
+    # each one tried against the `window` objects before it, the smallest delta wins and chains stop at `depth`.
+    # Sorted like that every base comes before its deltas, so the pack is written in one go as OFS_DELTAs
+    def _pack_objects(self, objects, pack_prefix: str, window: int = 10, depth: int = 50, promisor: bool = False):
+        entries = self._pack_order(objects)
+
+        pack_dir = os.path.dirname(pack_prefix) or '.'
+        os.makedirs(pack_dir, exist_ok=True)
+        fd, tmp_pack_path = tempfile.mkstemp(prefix='tmp_pack_', dir=pack_dir)
+        pack_sha = hashlib.sha1()
+        index_entries = []
+        delta_count = 0
+
+        with open(fd, 'wb') as pack_file:
+            header = b'PACK' + struct.pack('>II', 2, len(entries))
+            pack_sha.update(header)
+            pack_file.write(header)
+            offset = len(header)
+
+            for sha, head, data, is_delta in self._encode_pack_entries(entries, offset, window, depth):
+                for chunk in (head, data):
+                    pack_sha.update(chunk)
+                    pack_file.write(chunk)
+                index_entries.append((bytes.fromhex(sha), zlib.crc32(data, zlib.crc32(head)), offset))
+                offset += len(head) + len(data)
+                delta_count += is_delta
+
+            pack_file.write(pack_sha.digest())
+
+        pack_name = f"{pack_prefix}-{pack_sha.hexdigest()}"
+        os.chmod(tmp_pack_path, 0o444) # packs never change once written, like loose objects
+        os.replace(tmp_pack_path, pack_name + '.pack')
+        self._write_pack_index(pack_name + '.idx', index_entries, pack_sha.digest())
+        if promisor:
+            open(pack_name + '.promisor', 'w').close()
+        self._packs = None
+        return pack_sha.hexdigest(), delta_count
+
+    # 28e. (type, name hash, size, sha) of the objects, in the order _pack_objects writes them
+    def _pack_order(self, objects):
+        entries = []
+        for sha, name in objects:
+            info = self._object_info(sha)
+            if info is None:
+                print(f"fatal: object {sha} missing", file=sys.stderr)
+                sys.exit(1)
+            entries.append((self._type_from_name(info[0].encode('ascii')), self._name_hash(name), info[1], sha))
+        entries.sort(key=lambda entry: (-entry[0], -entry[1], -entry[2]))
+        return entries
+
+    # 28f. The pack entries for _pack_order'ed objects, one (sha, entry header, deflated data, is a delta) at a time -
+    # offset is where the first one lands in the pack, OFS_DELTAs point back from there. depth 0 means no deltas
+    def _encode_pack_entries(self, entries, offset: int, window: int = 10, depth: int = 50):
+        offsets = {}  # sha -> offset of its entry
+        depths = {}   # sha -> length of its delta chain
+        recent = deque(maxlen=max(window, 0)) # [sha, type, content, DeltaIndex built on first use]
+        for obj_type, _, _, sha in entries:
+            content = self._read_object(sha)
+            content = content[content.index(b'\x00') + 1:]
+
+            base_sha, delta = self._find_delta_base(obj_type, content, recent, depths, depth)
+            if delta is not None:
+                head = self._encode_object_header(self.OBJ_OFS_DELTA, len(delta)) + self._encode_ofs_delta_offset(offset - offsets[base_sha])
+                data = zlib.compress(delta)
+                depths[sha] = depths[base_sha] + 1
+            else:
+                head = self._encode_object_header(obj_type, len(content))
+                data = zlib.compress(content)
+                depths[sha] = 0
+
+            yield sha, head, data, delta is not None
+            offsets[sha] = offset
+            offset += len(head) + len(data)
+            recent.append([sha, obj_type, content, None])
+
+    # 28b. Best delta base for content among the recent objects - (base sha, delta) or (None, None)
+    # git's rules of thumb: a delta must be under half the object (minus the 20 bytes a base reference costs),
+    # bases with a full chain or 32x bigger than the target are skipped, every better delta lowers the bar.
+    # On top of that it must beat the object simply deflated - a delta of many short copies compresses badly
+    def _find_delta_base(self, obj_type, content, recent, depths, max_depth):
+        best_sha = best_delta = None
+        max_size = len(content) // 2 - 20
+        deflated = False
+        for candidate in reversed(recent): # nearest (most similar name and size) first
+            if max_size <= 0:
+                break
+            base_sha, base_type, base_content, base_index = candidate
+            if base_type != obj_type or depths[base_sha] >= max_depth:
+                continue
+            if not deflated: # fast deflate level - only a bound, worked out once there is a candidate at all
+                max_size = min(max_size, len(zlib.compress(content, 1)))
+                deflated = True
+            if len(content) < len(base_content) // 32 or len(content) - len(base_content) >= max_size:
+                continue
+            if base_index is None:
+                base_index = candidate[3] = DeltaIndex(base_content)
+            delta = base_index.create_delta(content, max_size)
+            if delta is not None and len(delta) < max_size:
+                best_sha, best_delta = base_sha, delta
+                max_size = len(delta)
+        return best_sha, best_delta
+
+    # 28c. git's pack name hash - the last characters of the path weigh the most, so same-named files in different
+    # directories (and same extensions) sort next to each other
+    def _name_hash(self, name: str) -> int:
+        name_hash = 0
+        for c in name.encode('utf-8'):
+            if c in b' \t\n\r\v\f':
+                continue
+            name_hash = ((name_hash >> 2) + (c << 24)) & 0xFFFFFFFF
+        return name_hash
+
+    # 28d. Every object reachable from HEAD, the refs and .git/index, as (sha hex, path name) - commits, tags,
+    # trees and blobs. Objects a shallow or partial clone left out are skipped, never fetched
+    def _reachable_objects(self):
+        stack = [(self._resolve_ref(ref_path), '', None) for ref_path in self._local_refs()] # (sha, name, type or None)
+        head = self._read_ref('HEAD')
+        if head and not head.startswith('ref: '): # detached HEAD
+            stack.append((head, '', None))
+        index = self._load_index()
+        stack += [(sha.hex(), path, 'blob') for path, (_, sha) in index.entries.items()]
+        stack += [(sha.hex(), rel_dir, 'tree') for rel_dir, (_, _, sha) in index.trees.items()]
+
+        seen = set()
+        objects = []
+        while stack:
+            sha, name, obj_type = stack.pop()
+            if not sha or sha in seen or not self._has_object(sha):
+                continue
+            seen.add(sha)
+            objects.append((sha, name))
+            if obj_type == 'blob':
+                continue
+
+            content = self._read_object(sha)
+            header, _, body = content.partition(b'\x00')
+            obj_type = header.split(b' ')[0]
+            if obj_type == b'commit':
+                tree_sha, parents, _ = self._parse_commit(sha)
+                stack.append((tree_sha, '', 'tree'))
+                stack += [(parent, '', 'commit') for parent in parents]
+            elif obj_type == b'tag':
+                stack.append((body.split(b'\n')[0].split(b' ')[1].decode('ascii'), '', None))
+            elif obj_type == b'tree':
+                prefix = name + '/' if name else ''
+                for entry_name, mode, entry_sha in self._parse_tree(sha):
+                    if mode == Git.MODE_TREE:
+                        stack.append((entry_sha.hex(), prefix + entry_name, 'tree'))
+                    elif mode != Git.MODE_GITLINK: # submodule commits live in another repository
+                        stack.append((entry_sha.hex(), prefix + entry_name, 'blob'))
+        return objects
+
+    # 29. Writing objects/info/commit-graph - every commit reachable from the refs and HEAD, sorted by sha, one fixed
+    # width record each. Returns the number of commits, or None in a shallow repository (parents are cut off there,
+    # a graph would carry made-up generations the day the history gets deepened)
+    def _write_commit_graph(self):
+        if self._read_shallow():
+            return None
+
+        tips = [self._resolve_ref(ref_path) for ref_path in self._local_refs()]
+        head = self._read_ref('HEAD')
+        if head and not head.startswith('ref: '):
+            tips.append(head)
+        tips = [sha for sha in (self._peel_to_commit(tip) for tip in tips if tip) if sha]
+
+        seen = set(tips)
+        stack = list(tips)
+        while stack:
+            for parent in self._commit_node(stack.pop())[1]:
+                if parent not in seen:
+                    seen.add(parent)
+                    stack.append(parent)
+
+        shas = sorted(bytes.fromhex(sha) for sha in seen)
+        position = {sha.hex(): i for i, sha in enumerate(shas)}
+        fanout = [0] * 256
+        for sha in shas:
+            fanout[sha[0]] += 1
+        for i in range(1, 256):
+            fanout[i] += fanout[i - 1]
+
+        records = []
+        edges = []
+        for sha in shas:
+            tree, parents, _, commit_time = self._commit_node(sha.hex())
+            generation = self._generation(sha.hex())
+            parent_positions = [position[parent] for parent in parents]
+            parent1 = parent_positions[0] if parent_positions else CommitGraph.PARENT_NONE
+            if len(parent_positions) > 2: # octopus - the rest of the parents go to EDGE
+                parent2 = CommitGraph.EXTRA_EDGES | len(edges)
+                edges += parent_positions[1:]
+                edges[-1] |= CommitGraph.EXTRA_EDGES
+            else:
+                parent2 = parent_positions[1] if len(parent_positions) == 2 else CommitGraph.PARENT_NONE
+            generation = min(generation, CommitGraph.MAX_GENERATION)
+            records.append(bytes.fromhex(tree) + struct.pack('>IIII', parent1, parent2,
+                                                             (generation << 2) | (commit_time >> 32 & 0x3),
+                                                             commit_time & 0xFFFFFFFF))
+
+        chunks = [(CommitGraph.CHUNK_FANOUT, struct.pack('>256I', *fanout)),
+                  (CommitGraph.CHUNK_OIDS, b''.join(shas)),
+                  (CommitGraph.CHUNK_DATA, b''.join(records))]
+        if edges:
+            chunks.append((CommitGraph.CHUNK_EDGES, struct.pack(f'>{len(edges)}I', *edges)))
+
+        header = CommitGraph.SIGNATURE + bytes([CommitGraph.VERSION, 1, len(chunks), 0]) # sha-1, no base graphs
+        offset = len(header) + 12 * (len(chunks) + 1)
+        table = b''
+        for chunk_id, chunk in chunks:
+            table += struct.pack('>4sQ', chunk_id, offset)
+            offset += len(chunk)
+        table += struct.pack('>4sQ', b'\x00' * 4, offset)
+        content = header + table + b''.join(chunk for _, chunk in chunks)
+
+        graph_path = os.path.join(self.git_dir, Git.OBJECTS_DIR, Git.COMMIT_GRAPH_FILE)
+        os.makedirs(os.path.dirname(graph_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(graph_path), prefix='tmp_graph_')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content + hashlib.sha1(content).digest())
+        os.replace(tmp_path, graph_path)
+        self._commit_graph = None
+        self._commit_nodes = {}
+        return len(shas)
+
+    # 29b. the commit-graph, loaded on first use - None when there is none (or the repo is shallow, see 29)
+    def _load_commit_graph(self):
+        if self._commit_graph is None:
+            graph_path = os.path.join(self.git_dir, Git.OBJECTS_DIR, Git.COMMIT_GRAPH_FILE)
+            self._commit_graph = False
+            if os.path.exists(graph_path) and not self._read_shallow():
+                try:
+                    self._commit_graph = CommitGraph(graph_path)
+                except (ValueError, KeyError, struct.error):
+                    print(f"warning: ignoring corrupt commit-graph {graph_path}", file=sys.stderr)
+        return self._commit_graph or None
+
+    # 29c. (tree, parents, generation, commit time) of a commit, all shas hex. Straight from the graph when it is in
+    # there; commits newer than the graph are parsed and have no generation (None) until _generation needs one.
+    # Shallow commits get no parents
+    def _commit_node(self, sha: str):
+        node = self._commit_nodes.get(sha)
+        if node is not None:
+            return node
+
+        graph = self._load_commit_graph()
+        position = graph.find(bytes.fromhex(sha)) if graph else None
+        if position is not None:
+            tree, parents, generation, commit_time = graph.commit_at(position)
+            node = (tree.hex(), [graph.sha_at(parent).hex() for parent in parents], generation, commit_time)
+        else:
+            tree, parents, commit_time = self._parse_commit(sha)
+            if self._shallow_commits is None:
+                self._shallow_commits = {line.decode('ascii') for line in self._read_shallow()}
+            if sha in self._shallow_commits:
+                parents = []
+            node = (tree, parents, None, commit_time)
+        self._commit_nodes[sha] = node
+        return node
+
+    # 29d. generation number of a commit - from the graph, or worked out from its parents' (which ends at the graph,
+    # or at the roots without one)
+    def _generation(self, sha: str) -> int:
+        generation = self._commit_node(sha)[2]
+        if generation is not None:
+            return generation
+
+        stack = [sha]
+        while stack:
+            tree, parents, generation, commit_time = self._commit_node(stack[-1])
+            if generation is not None:
+                stack.pop()
+                continue
+            missing = [parent for parent in parents if self._commit_node(parent)[2] is None]
+            if missing: # parents first
+                stack += missing
+                continue
+            generation = 1 + max((self._commit_nodes[parent][2] for parent in parents), default=0)
+            self._commit_nodes[stack.pop()] = (tree, parents, generation, commit_time)
+        return self._commit_nodes[sha][2]
+
+    # 29e. a revision name -> commit sha hex: a full sha, HEAD, or a ref (refs/..., a branch, tag or remote branch),
+    # optionally followed by ~N (N first parents back) and ^N (the Nth parent) steps
+    def _resolve_rev(self, rev: str) -> str:
+        name_end = min((i for i in (rev.find('~'), rev.find('^')) if i > 0), default=len(rev))
+        name, steps = rev[:name_end], rev[name_end:]
+
+        sha = None
+        if self._is_sha(name):
+            sha = name
+        else:
+            for ref_path in (name, f'refs/{name}', f'refs/heads/{name}', f'refs/tags/{name}', f'refs/remotes/{name}'):
+                sha = self._resolve_ref(ref_path) # symbolic refs (HEAD) followed
+                if sha:
+                    break
+        commit = self._peel_to_commit(sha) if sha else None
 
         i = 0
-        while i < len(body):
-            space_ind = body.find(b'\x20', i)
-            mode = body[i:space_ind]
-            null_ind = body.find(b'\x00', space_ind)
-            file_name = body[space_ind + 1 : null_ind].decode('utf-8')
-            sha1_bytes = body[null_ind + 1 : null_ind + 21]
-            sha1_hex = sha1_bytes.hex()
-
-            full_path = os.path.join(target_dir, file_name)
-
-            if mode == b'40000': # subtree, unleash the beauty of recursion
-                os.makedirs(full_path, exist_ok=True)
-                self._checkout_tree(sha1_hex, full_path)
-
-            else: # its a blob- decompress and write real content to the disk
-                blob_path = self._object_path(sha1_hex)
-                blob_content = self._get_object_content(blob_path)
-                _, _, file_body  = blob_content.partition(b'\x00')
-                with open(full_path, 'wb') as f:
-                    f.write(file_body)
+        while commit is not None and i < len(steps):
+            op = steps[i]
+            i += 1
+            digits_end = i
+            while digits_end < len(steps) and steps[digits_end].isdigit():
+                digits_end += 1
+            if op not in '~^':
+                commit = None
+                break
+            count = int(steps[i:digits_end]) if digits_end > i else 1
+            i = digits_end
+            if op == '~':
+                for _ in range(count):
+                    parents = self._commit_node(commit)[1]
+                    commit = parents[0] if parents else None
+                    if commit is None:
+                        break
+            elif count:
+                parents = self._commit_node(commit)[1]
+                commit = parents[count - 1] if count <= len(parents) else None
+
+        if commit is None:
+            print(f"fatal: bad revision '{rev}'", file=sys.stderr)
+            sys.exit(128)
+        return commit
+
+    # 29f. annotated tags point at their target - follows them down to a commit (None if it is not one)
+    def _peel_to_commit(self, sha: str):
+        while True:
+            if not self._is_sha(sha):
+                return None
+            if self._commit_nodes.get(sha) is not None:
+                return sha
+            graph = self._load_commit_graph()
+            if graph and graph.find(bytes.fromhex(sha)) is not None:
+                return sha
+            content = self._read_object(sha)
+            if content is None:
+                return None
+            header, _, body = content.partition(b'\x00')
+            if header.startswith(b'commit '):
+                return sha
+            if not header.startswith(b'tag '):
+                return None
+            sha = body.split(b'\n', 1)[0].split(b' ')[1].decode('ascii')
+
+    # 29g. rev arguments -> (include, exclude) sha lists: "^a" and "a..b" exclude a
+    def _parse_revs(self, revs):
+        include, exclude = [], []
+        for rev in revs:
+            if '..' in rev:
+                left, _, right = rev.partition('..')
+                exclude.append(self._resolve_rev(left or 'HEAD'))
+                include.append(self._resolve_rev(right or 'HEAD'))
+            elif rev.startswith('^'):
+                exclude.append(self._resolve_rev(rev[1:]))
+            else:
+                include.append(self._resolve_rev(rev))
+        return include, exclude
+
+    # 29h. commits reachable from include but not from exclude, newest commit time first (git's default order)
+    # the exclusion is worked out in generation order: a commit comes off the queue only after everything that can
+    # reach it, so its "uninteresting" mark is final then - and the walk ends as soon as only uninteresting commits
+    # are left in the queue, however much history lies below them
+    def _rev_list(self, include, exclude, limit=None):
+        wanted = None
+        if exclude:
+            uninteresting = set(exclude)
+            queue = []
+            queued = set()
+            interesting_queued = 0
+            for sha in dict.fromkeys(include + exclude):
+                generation, commit_time = self._generation(sha), self._commit_node(sha)[3]
+                heapq.heappush(queue, (-generation, -commit_time, sha))
+                queued.add(sha)
+                interesting_queued += sha not in uninteresting
+
+            wanted = set()
+            while interesting_queued:
+                _, _, sha = heapq.heappop(queue)
+                excluded = sha in uninteresting
+                if not excluded:
+                    interesting_queued -= 1
+                    wanted.add(sha)
+                for parent in self._commit_node(sha)[1]:
+                    if parent not in queued:
+                        queued.add(parent)
+                        generation, commit_time = self._generation(parent), self._commit_node(parent)[3]
+                        heapq.heappush(queue, (-generation, -commit_time, parent))
+                        if excluded:
+                            uninteresting.add(parent)
+                        else:
+                            interesting_queued += 1
+                    elif excluded and parent not in uninteresting: # queued as interesting - not anymore
+                        uninteresting.add(parent)
+                        interesting_queued -= 1
+
+        # output order: by commit time, newest first, among the wanted commits - stops at the limit
+        commits = []
+        queue = []
+        seen = set()
+        for sha in include:
+            if sha not in seen and (wanted is None or sha in wanted):
+                seen.add(sha)
+                heapq.heappush(queue, (-self._commit_node(sha)[3], len(seen), sha))
+        while queue and (limit is None or len(commits) < limit):
+            _, _, sha = heapq.heappop(queue)
+            commits.append(sha)
+            for parent in self._commit_node(sha)[1]:
+                if parent not in seen and (wanted is None or parent in wanted):
+                    seen.add(parent)
+                    heapq.heappush(queue, (-self._commit_node(parent)[3], len(seen), parent))
+        return commits
+
+    # 29i. is ancestor reachable from descendant - nothing with a generation below the ancestor's can lead to it
+    def _is_ancestor(self, ancestor: str, descendant: str) -> bool:
+        min_generation = self._generation(ancestor)
+        seen = {descendant}
+        stack = [descendant]
+        while stack:
+            sha = stack.pop()
+            if sha == ancestor:
+                return True
+            for parent in self._commit_node(sha)[1]:
+                if parent not in seen and self._generation(parent) >= min_generation:
+                    seen.add(parent)
+                    stack.append(parent)
+        return False
+
+    # 29j. best common ancestors of two commits, newest first - git's paint-down-to-common: both sides are painted
+    # in generation order, a commit painted by both is a candidate and its ancestors are stale from then on; the walk
+    # stops when only stale commits are queued. Candidates that reach another candidate are dropped
+    def _merge_bases(self, first: str, second: str):
+        if first == second:
+            return [first]
+        FIRST, SECOND, STALE = 1, 2, 4
+        flags = {first: FIRST, second: SECOND}
+        queue = []
+        for sha in (first, second):
+            generation, commit_time = self._generation(sha), self._commit_node(sha)[3]
+            heapq.heappush(queue, (-generation, -commit_time, sha))
+
+        candidates = []
+        active = 2 # queued commits that are not stale
+        while active:
+            _, _, sha = heapq.heappop(queue)
+            paint = flags[sha]
+            if not paint & STALE:
+                active -= 1
+            if paint == FIRST | SECOND:
+                candidates.append(sha)
+                paint |= STALE
+            for parent in self._commit_node(sha)[1]:
+                parent_flags = flags.get(parent)
+                if parent_flags is None:
+                    generation, commit_time = self._generation(parent), self._commit_node(parent)[3]
+                    heapq.heappush(queue, (-generation, -commit_time, parent))
+                    flags[parent] = paint
+                    active += not paint & STALE
+                elif parent_flags & paint != paint:
+                    flags[parent] = parent_flags | paint
+                    active -= bool(paint & STALE and not parent_flags & STALE)
+
+        bases = [sha for sha in candidates
+                 if not any(other != sha and self._is_ancestor(sha, other) for other in candidates)]
+        return sorted(bases, key=lambda sha: -self._commit_node(sha)[3])
+
+    # 30. Parsing a tree object into (name, mode, sha bytes) tuples, in the tree's own order - None if it is not a
+    # tree. The one tree parser everything shares; recently parsed trees are kept, diffs and checkouts keep
+    # coming back to the same ones
+    def _parse_tree(self, tree_sha: str):
+        with self._tree_cache_lock:
+            entries = self._tree_cache.get(tree_sha)
+            if entries is not None:
+                self._tree_cache.move_to_end(tree_sha)
+                return entries
+
+        content = self._read_object(tree_sha)
+        if content is None or not content.startswith(b'tree '):
+            return None
+        body_start = content.index(b'\x00') + 1
 
+        entries = []
+        i = body_start
+        while i < len(content):
+            space_ind = content.index(b'\x20', i)
+            null_ind = content.index(b'\x00', space_ind)
+            entries.append((content[space_ind + 1:null_ind].decode('utf-8', 'surrogateescape'),
+                            int(content[i:space_ind], 8), content[null_ind + 1:null_ind + 21]))
             i = null_ind + 21
+        entries = tuple(entries)
+
+        with self._tree_cache_lock:
+            self._tree_cache[tree_sha] = entries
+            if len(self._tree_cache) > Git.TREE_CACHE_LIMIT:
+                self._tree_cache.popitem(last=False)
+        return entries
+
+    # 30b. Comparing two trees (sha hex, None = empty) - yields (path, old mode, old sha, new mode, new sha) for every
+    # difference, 0 / None on the side that has no such entry. Both entry lists are sorted the way git sorts them
+    # (a subtree as "name/"), so one merge-like pass pairs them up; an entry with the same sha and mode on both sides
+    # is skipped whole - for a subtree that is everything below it, so the cost follows the change, not the tree.
+    # Subtrees are only opened up with recursive (show_trees still reports the subtree itself first)
+    def _diff_trees(self, old_tree, new_tree, recursive=False, show_trees=False, prefix=''):
+        old_entries = self._parse_tree(old_tree) if old_tree else ()
+        new_entries = self._parse_tree(new_tree) if new_tree else ()
+        i = j = 0
+        while i < len(old_entries) or j < len(new_entries):
+            old = old_entries[i] if i < len(old_entries) else None
+            new = new_entries[j] if j < len(new_entries) else None
+            old_key = old and (old[0] + '/' if old[1] == Git.MODE_TREE else old[0])
+            new_key = new and (new[0] + '/' if new[1] == Git.MODE_TREE else new[0])
+
+            if new is None or (old is not None and old_key < new_key):
+                new = None
+                i += 1
+            elif old is None or new_key < old_key:
+                old = None
+                j += 1
+            else:
+                i += 1
+                j += 1
+                if old[2] == new[2] and old[1] == new[1]: # identical - the whole subtree is skipped
+                    continue
+
+            name, mode = (new or old)[:2]
+            path = prefix + name
+            old_mode, old_sha = old[1:] if old else (0, None)
+            new_mode, new_sha = new[1:] if new else (0, None)
+            if recursive and mode == Git.MODE_TREE:
+                if show_trees:
+                    yield path, old_mode, old_sha, new_mode, new_sha
+                yield from self._diff_trees(old_sha and old_sha.hex(), new_sha and new_sha.hex(),
+                                            recursive, show_trees, path + '/')
+            else:
+                yield path, old_mode, old_sha, new_mode, new_sha
+
+    # 30c. A/D/M/T letter of a change - T when the kind of file changed (regular file, symlink, submodule)
+    def _change_status(self, old_mode: int, new_mode: int) -> str:
+        if not old_mode:
+            return 'A'
+        if not new_mode:
+            return 'D'
+        return 'T' if old_mode & 0o170000 != new_mode & 0o170000 else 'M'
+
+    # 30d. a tree-ish -> tree sha hex: a tree sha, anything _resolve_rev takes (the commit's tree), or <rev>:<path>
+    def _resolve_tree(self, rev: str) -> str:
+        rev, has_path, path = rev.partition(':')
+        if len(rev) == 40 and self._parse_tree(rev) is not None:
+            tree_sha = rev
+        else:
+            tree_sha = self._commit_node(self._resolve_rev(rev))[0]
 
+        for name in (path.split('/') if has_path else ()):
+            if not name:
+                continue
+            entry = next((entry for entry in self._parse_tree(tree_sha) if entry[0] == name), None)
+            if entry is None or entry[1] != Git.MODE_TREE:
+                print(f"fatal: '{path}' is not a directory in '{rev}'", file=sys.stderr)
+                sys.exit(128)
+            tree_sha = entry[2].hex()
+        return tree_sha
+
+    # 30e. Moving the work tree (and .git/index) from one tree to another by writing only what _diff_trees reports.
+    # Local changes in the way stop it before anything is touched. Deletions go first (a file can turn into a
+    # directory), then the new and changed files are written on the checkout pool like a full checkout
+    def _checkout_changes(self, old_tree: str, new_tree: str, target_dir: str):
+        started = time.perf_counter()
+        index = self._load_index()
+        removals = []
+        files = []
+        directories = []
+        conflicts = []
+        for path, old_mode, old_sha, new_mode, new_sha in self._diff_trees(old_tree, new_tree, recursive=True):
+            full_path = os.path.join(target_dir, path)
+            expected = old_sha if old_mode and old_mode != Git.MODE_GITLINK else None
+            if os.path.isfile(full_path) and not os.path.islink(full_path) and (expected or new_mode):
+                st = os.stat(full_path)
+                current = index.cached_sha(path, st, old_mode) if old_mode else None
+                if current is None:
+                    current = bytes.fromhex(self._write_blob(full_path, False))
+                if current not in (expected, new_sha if new_mode != Git.MODE_GITLINK else None):
+                    conflicts.append(path)
+            if old_mode:
+                removals.append((full_path, old_mode, path))
+            if new_mode == Git.MODE_GITLINK:
+                directories.append(full_path)
+            elif new_mode:
+                files.append((full_path, new_mode, new_sha.hex(), path))
+
+        if conflicts:
+            print("error: Your local changes to the following files would be overwritten by checkout:", file=sys.stderr)
+            for path in conflicts:
+                print(f"\t{path}", file=sys.stderr)
+            sys.exit(1)
 
-# -------- MAIN ---------
+        for full_path, old_mode, path in sorted(removals, key=lambda removal: removal[2], reverse=True):
+            if old_mode == Git.MODE_GITLINK:
+                if os.path.isdir(full_path) and not os.listdir(full_path):
+                    os.rmdir(full_path)
+            elif os.path.lexists(full_path):
+                os.remove(full_path)
+            index.entries.pop(path, None)
+            index.invalidate(path)
+            parent = os.path.dirname(full_path) # directories left empty go too
+            while parent and os.path.normpath(parent) != os.path.normpath(target_dir) and not os.listdir(parent):
+                os.rmdir(parent)
+                parent = os.path.dirname(parent)
+
+        for directory in directories + [os.path.dirname(full_path) for full_path, _, _, _ in files]:
+            os.makedirs(directory, exist_ok=True)
+        missing = list(dict.fromkeys(sha1_hex for _, _, sha1_hex, _ in files if not self._has_object(sha1_hex)))
+        if missing:
+            self._fetch_missing_objects(missing)
+
+        written = 0
+        with ThreadPoolExecutor(max_workers=max(1, self.checkout_workers)) as pool:
+            for file_entry, st in zip(files, pool.map(self._checkout_file, files)):
+                _, mode, sha1_hex, rel_path = file_entry
+                if st is not None:
+                    index.update(rel_path, st, mode, bytes.fromhex(sha1_hex))
+                    written += st.st_size
+                else:
+                    index.entries.pop(rel_path, None)
+                    index.invalidate(rel_path)
+
+        # the cached trees dropped above (every directory over a changed path) are known again from the new tree
+        entry_counts = {}
+        for rel_path in index.entries:
+            while rel_path:
+                rel_path = rel_path.rpartition('/')[0]
+                entry_counts[rel_path] = entry_counts.get(rel_path, 0) + 1
+        pending = [('', new_tree)]
+        while pending:
+            rel_dir, tree_sha = pending.pop()
+            cached = index.trees.get(rel_dir)
+            if cached is not None and cached[2].hex() == tree_sha: # untouched below here
+                continue
+            entries = self._parse_tree(tree_sha)
+            subtrees = [(name, sha) for name, mode, sha in entries if mode == Git.MODE_TREE]
+            index.trees[rel_dir] = (entry_counts.get(rel_dir, 0), len(subtrees), bytes.fromhex(tree_sha))
+            prefix = rel_dir + '/' if rel_dir else ''
+            pending += [(prefix + name, sha.hex()) for name, sha in subtrees]
+        index.write()
+        if self.stats is not None:
+            self.stats.add('checkout', time.perf_counter() - started, len(files), written)
+        if self.trace is not None:
+            self.trace.count('files checked out', len(files))
+            self.trace.count('bytes checked out', written)
+
+    # 29k. "<epoch> <+hhmm>" -> git's default date format, in the committer's own timezone
+    def _format_date(self, when: str) -> str:
+        epoch, _, zone = when.partition(' ')
+        offset = int(zone[1:3]) * 3600 + int(zone[3:5]) * 60 if len(zone) == 5 else 0
+        if zone.startswith('-'):
+            offset = -offset
+        t = time.gmtime(int(epoch) + offset)
+        return f"{time.strftime('%a %b', t)} {t.tm_mday} {time.strftime('%H:%M:%S %Y', t)} {zone}"
+
+    # 31. A named phase for the perf trace - nothing at all when tracing is off
+    def _phase(self, name: str):
+        return self.trace.phase(name) if self.trace is not None else contextlib.nullcontext()
+
+    # 31b. For a long-lived instance (daemon, serve) - dropping the pack list or the commit-graph when another
+    # process changed them on disk since they were loaded. Everything else cached is keyed by sha, never stale
+    def _reload_changed_stores(self):
+        objects_dir = os.path.join(self.git_dir, Git.OBJECTS_DIR)
+        if self._store_changed(os.path.join(objects_dir, Git.PACK_DIR)): # a pack came or went
+            self._packs = None
+        if self._store_changed(os.path.join(objects_dir, Git.COMMIT_GRAPH_FILE)):
+            self._commit_graph = None
+
+    def _store_changed(self, path: str) -> bool:
+        try:
+            st = os.stat(path)
+            stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+        except FileNotFoundError:
+            stamp = None
+        changed = self._store_stamps.get(path, stamp) != stamp
+        self._store_stamps[path] = stamp
+        return changed
+
+    # 32. The refs a server advertises - [(name, sha hex)], HEAD first (when it resolves), then the loose refs and
+    # .git/packed-refs (which git writes and mirrors are full of) sorted by name - plus what HEAD points to
+    def _advertised_refs(self):
+        refs = {}
+        for ref_path in self._local_refs():
+            sha = self._read_ref(ref_path)
+            if sha and not sha.startswith('ref: '):
+                refs[ref_path] = sha
+
+        head = self._read_ref('HEAD')
+        head_target = head[5:] if head and head.startswith('ref: ') else None
+        head_sha = refs.get(head_target) if head_target else head
+        advertised = [('HEAD', head_sha)] if head_sha else []
+        advertised += sorted(refs.items())
+        return advertised, head_target
+
+    # 32b. What an annotated tag finally points at (tags of tags are followed) - None for anything but a tag
+    def _peel(self, sha: str):
+        peeled = None
+        while (info := self._object_info(sha)) is not None and info[0] == 'tag':
+            _, _, body = self._read_object(sha).partition(b'\x00')
+            sha = peeled = body.split(b'\n', 1)[0].split(b' ')[1].decode('ascii')
+        return peeled
+
+    # 32c. The commits a fetch sends - (commits, boundary, shallow, unshallow). Without deepen it is _rev_list of the
+    # wants minus the common haves; boundary is what the client has right under them (their trees need not be sent).
+    # deepen N keeps the commits less than N away from a want (breadth first, like git), the ones at the cut become
+    # the client's new shallow commits, and a commit the client had as shallow that is now above the cut is
+    # unshallowed - its parents come along. relative (deepen-relative) counts the N from the client's shallow commits
+    # instead. Otherwise the client's shallow commits are walked as having no parents
+    def _fetch_commits(self, wants, common, client_shallow=(), deepen=None, relative=False):
+        if deepen is None and not client_shallow:
+            commits = self._rev_list(wants, common)
+            sent = set(commits)
+            boundary = {parent for sha in commits for parent in self._commit_node(sha)[1] if parent not in sent}
+            return commits, boundary, [], []
+
+        client_shallow = set(client_shallow)
+        has = set() # what the client has - reachable from the common commits, down to its shallow ones
+        stack = list(common)
+        while stack:
+            sha = stack.pop()
+            if sha not in has:
+                has.add(sha)
+                if sha not in client_shallow:
+                    stack += self._commit_node(sha)[1]
+
+        commits, shallow, unshallow = [], [], []
+        sent = set()
+        def walk(starts, limit):
+            depth = dict.fromkeys(starts, 1)
+            pending = deque(depth)
+            while pending:
+                sha = pending.popleft()
+                parents = self._commit_node(sha)[1]
+                if sha in has:
+                    if limit is None and sha not in client_shallow: # the client has all of its history already
+                        continue
+                elif sha not in sent:
+                    sent.add(sha)
+                    commits.append(sha)
+                if limit is not None and depth[sha] >= limit:
+                    if parents and sha not in has:
+                        shallow.append(sha)
+                    continue
+                if sha in client_shallow:
+                    if limit is None:
+                        continue
+                    if parents:
+                        unshallow.append(sha)
+                for parent in parents:
+                    if parent not in depth:
+                        depth[parent] = depth[sha] + 1
+                        pending.append(parent)
+
+        if relative and deepen is not None:
+            walk(wants, None) # what is new on top, down to what the client has
+            walk([sha for sha in client_shallow if sha in has], deepen + 1)
+        else:
+            walk(wants, deepen)
+
+        boundary = {parent for sha in commits for parent in self._commit_node(sha)[1] if parent in has and parent not in sent}
+        boundary.update(unshallow)
+        return commits, boundary, shallow, unshallow
+
+    # 32d. Every object a fetch sends, as (sha hex, path name) for _pack_objects' ordering: the commits, then the trees
+    # and blobs under them that are not already in a boundary commit's tree (git's "edge" objects). roots are wanted
+    # objects that are not commits (tags, and whatever they point at). blob_limit: None keeps every blob, otherwise
+    # only blobs of at most that many bytes go under the trees (-1: none at all - a blob:none partial clone)
+    def _fetch_objects(self, commits, boundary, roots=(), blob_limit=None):
+        have = set()
+        stack = [self._commit_node(sha)[0] for sha in boundary]
+        while stack:
+            tree_sha = stack.pop()
+            if tree_sha in have:
+                continue
+            have.add(tree_sha)
+            for _, mode, entry_sha in self._parse_tree(tree_sha) or ():
+                if mode == Git.MODE_TREE:
+                    stack.append(entry_sha.hex())
+                elif mode != Git.MODE_GITLINK:
+                    have.add(entry_sha.hex())
+
+        objects = [(sha, '') for sha in commits]
+        seen = set(have)
+        seen.update(commits)
+        stack = [(sha, '', None) for sha in roots] + [(self._commit_node(sha)[0], '', 'tree') for sha in reversed(commits)]
+        while stack:
+            sha, name, obj_type = stack.pop()
+            if sha in seen:
+                continue
+            seen.add(sha)
+            if obj_type is None:
+                obj_type = self._object_info(sha)[0]
+                if obj_type == 'commit': # a tag's commit - the commit walk decided about it already
+                    continue
+                if obj_type == 'blob': # asked for by name (a partial clone's lazy fetch) - sent whatever the filter
+                    objects.append((sha, name))
+                    continue
+                if obj_type == 'tag':
+                    objects.append((sha, name))
+                    _, _, body = self._read_object(sha).partition(b'\x00')
+                    stack.append((body.split(b'\n', 1)[0].split(b' ')[1].decode('ascii'), name, None))
+                    continue
+            if obj_type == 'blob':
+                if blob_limit is None or self._object_info(sha)[1] <= blob_limit:
+                    objects.append((sha, name))
+                continue
 
-def main():
+            objects.append((sha, name))
+            prefix = name + '/' if name else ''
+            for entry_name, mode, entry_sha in self._parse_tree(sha):
+                if mode == Git.MODE_TREE:
+                    stack.append((entry_sha.hex(), prefix + entry_name, 'tree'))
+                elif mode != Git.MODE_GITLINK:
+                    stack.append((entry_sha.hex(), prefix + entry_name, 'blob'))
+        return objects
+
+    # 32e. Streaming a pack of objects [(sha hex, name)] to write(bytes). With reuse, every pack of ours whose
+    # objects are all being sent goes out verbatim - its entries exactly as they are on disk, no inflate, delta search
+    # or deflate (OFS_DELTA distances stay right inside the copied run, and a pack never deltas against an object
+    # outside itself). The rest is encoded like _pack_objects does. Returns (objects reused, packs reused)
+    def _stream_pack(self, objects, write, reuse=True, window=10, depth=50):
+        remaining = dict(objects)
+        reused = []
+        if reuse:
+            for pack_index in self._pack_indexes():
+                if 0 < pack_index.count <= len(remaining):
+                    shas = [pack_index.sha_at(i).hex() for i in range(pack_index.count)]
+                    if all(sha in remaining for sha in shas):
+                        reused.append(pack_index)
+                        for sha in shas:
+                            del remaining[sha]
+
+        pack_sha = hashlib.sha1()
+        def emit(data):
+            pack_sha.update(data)
+            write(data)
+
+        reused_count = sum(pack_index.count for pack_index in reused)
+        emit(b'PACK' + struct.pack('>II', 2, reused_count + len(remaining)))
+        offset = 12
+        for pack_index in reused:
+            pack_data = pack_index.pack_data()
+            end = len(pack_data) - 20 # everything between the header and the checksum
+            for start in range(12, end, Git.PACK_REUSE_CHUNK):
+                emit(pack_data[start:min(start + Git.PACK_REUSE_CHUNK, end)])
+            offset += end - 12
+        for _, head, data, _ in self._encode_pack_entries(self._pack_order(remaining.items()), offset, window, depth):
+            emit(head)
+            emit(data)
+        write(pack_sha.digest())
+        return reused_count, len(reused)
+
+# process pool side of _run_delta_trees - top level functions so they can be pickled
+# the initializer keeps one Git (for thin pack bases in the store) and the children maps per worker process
+_delta_worker = None
+
+def _init_delta_worker(git_dir, ofs_children, ref_children):
+    global _delta_worker
+    _delta_worker = (Git(git_dir), ofs_children, ref_children)
+
+def _resolve_delta_tree_worker(work):
+    git, ofs_children, ref_children = _delta_worker
+    pack_path, root_offset, root_sha, cache_limit = work
+    return git._resolve_delta_tree(pack_path, root_offset, root_sha, ofs_children, ref_children, cache_limit)
+
+
+# -------- UPLOAD-PACK SERVER --------
+
+# The server side of what SmartHttpTransport talks to - GET info/refs and POST git-upload-pack, protocol v0
+# (stateless, multi_ack_detailed) and v2 (ls-refs, fetch), over plain HTTP. Repositories are the directories under
+# base_path (a work tree's .git or a bare one) at http://host:port/<dir>, base_path itself at http://host:port/.
+# One Git instance per repository answers every client, so parsed trees, commits and the mapped packs stay warm;
+# requests run on a thread pool. A pack of the repository whose objects are all being sent goes out byte for byte
+# (Git._stream_pack) - cloning a gc'd repository costs no inflating, delta search or deflating at all.
+class UploadPackServer:
+    AGENT = SmartHttpTransport.USER_AGENT
+    V0_CAPABILITIES = ('multi_ack_detailed side-band-64k side-band thin-pack ofs-delta shallow no-progress filter'
+                       ' allow-reachable-sha1-in-want') # any object by sha - what a partial clone's lazy fetch asks for
+    V2_CAPABILITIES = ('ls-refs', 'fetch=shallow filter', 'object-format=sha1')
+    SIDE_BAND_64K_PAYLOAD = 65515 # most pack bytes per side-band pkt-line (65520 minus the length and the band)
+    SIDE_BAND_PAYLOAD = 995       # same, for plain side-band's 1000 byte packets
+    RAW_CHUNK = 64 * 1024         # pack bytes written at a time without side-band
+    MAX_REQUEST = 64 * 1024 * 1024
+    TIMEOUT = 30                  # seconds an idle keep-alive connection holds on to its thread
+    DEFAULT_THREADS = 16
+
+    def __init__(self, base_path: str):
+        self.base_path = os.path.realpath(base_path)
+        self.repos = {}               # git dir -> Git
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def pkt_line(content) -> bytes:
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        return SmartHttpTransport.pkt_line(content)
+
+    # the Git answering for a url path prefix - None when there is no repository there (or it is outside base_path)
+    def repo(self, prefix: str):
+        path = os.path.realpath(os.path.join(self.base_path, prefix.strip('/')))
+        if path != self.base_path and not path.startswith(self.base_path + os.sep):
+            return None
+        if os.path.isdir(os.path.join(path, '.git')):
+            path = os.path.join(path, '.git')
+        elif not (os.path.isdir(os.path.join(path, Git.OBJECTS_DIR)) and os.path.isfile(os.path.join(path, Git.HEAD_FILE))):
+            return None
+        with self.lock:
+            git = self.repos.get(path)
+            if git is None:
+                git = self.repos[path] = Git(path)
+        git._reload_changed_stores() # a commit, fetch or gc since the last request
+        return git
+
+    # GET info/refs - v2: the capabilities only. v0: every ref, peeled tags after their tag, capabilities on the first
+    def advertise(self, git, version: int) -> bytes:
+        if version == 2:
+            lines = ['version 2', f"agent={self.AGENT}", *self.V2_CAPABILITIES]
+            return b''.join(self.pkt_line(line + '\n') for line in lines) + b'0000'
+
+        refs, head_target = git._advertised_refs()
+        capabilities = self.V0_CAPABILITIES + (f" symref=HEAD:{head_target}" if head_target else '') + f" agent={self.AGENT}"
+        lines = []
+        for name, sha in refs:
+            lines.append(f"{sha} {name}")
+            peeled = git._peel(sha) if name.startswith('refs/tags/') else None
+            if peeled:
+                lines.append(f"{peeled} {name}^{{}}")
+        if not lines: # an empty repository still has its capabilities to tell
+            lines.append(f"{'0' * 40} capabilities^{{}}")
+        lines[0] += '\x00' + capabilities
+        out = self.pkt_line('# service=git-upload-pack\n') + b'0000'
+        return out + b''.join(self.pkt_line(line + '\n') for line in lines) + b'0000'
+
+    # v2 ls-refs - symrefs / peel / ref-prefix arguments
+    def ls_refs(self, git, arguments) -> bytes:
+        prefixes = [argument[len('ref-prefix '):] for argument in arguments if argument.startswith('ref-prefix ')]
+        refs, head_target = git._advertised_refs()
+        out = []
+        for name, sha in refs:
+            if prefixes and not name.startswith(tuple(prefixes)):
+                continue
+            line = f"{sha} {name}"
+            if name == 'HEAD' and head_target and 'symrefs' in arguments:
+                line += f" symref-target:{head_target}"
+            if 'peel' in arguments and name.startswith('refs/tags/') and (peeled := git._peel(sha)):
+                line += f" peeled:{peeled}"
+            out.append(self.pkt_line(line + '\n'))
+        return b''.join(out) + b'0000'
+
+    # a request body as (command, capabilities, arguments). v0 has no command (it is always a fetch) and its
+    # capabilities ride on the first want; v2 lists them before the delim
+    def parse_request(self, body: bytes, version: int):
+        stream = PktLineStream(io.BytesIO(body))
+        command = 'fetch'
+        capabilities, arguments = [], []
+        in_capabilities = version == 2
+        while (pkt := stream.read_pkt()) is not None:
+            if pkt == PktLineStream.DELIM:
+                in_capabilities = False
+            if not isinstance(pkt, bytes):
+                continue
+            line = pkt.decode('utf-8', 'replace').rstrip('\n')
+            if in_capabilities:
+                if line.startswith('command='):
+                    command = line[len('command='):]
+                else:
+                    capabilities.append(line)
+                continue
+            if version == 0 and line.startswith('want '):
+                sha, *first_capabilities = line[len('want '):].split(' ')
+                line = 'want ' + sha
+                capabilities += first_capabilities
+            arguments.append(line)
+        return command, capabilities, arguments
+
+    # a filter spec as Git._fetch_objects' blob_limit (-1 for blob:none) - ValueError for the ones we can't do
+    @staticmethod
+    def blob_limit(spec: str) -> int:
+        if spec == 'blob:none':
+            return -1
+        if spec.startswith('blob:limit='):
+            value = spec[len('blob:limit='):].lower()
+            scale = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30}.get(value[-1:], 1)
+            return int(value[:-1] if scale > 1 else value) * scale
+        raise ValueError(f"unsupported filter '{spec}'")
+
+    # one fetch request: the negotiation answer, then the pack once the client is done (v2: or we are ready).
+    # send(bytes) writes to the client. A bad request gets an ERR pkt-line, as upload-pack answers it
+    def fetch(self, git, capabilities, arguments, version: int, send):
+        wants, haves, client_shallow = [], [], []
+        deepen = blob_limit = None
+        done = relative = False
+        features = set(capabilities)
+        try:
+            for argument in arguments:
+                name, _, value = argument.partition(' ')
+                if name == 'want':
+                    if git._object_info(value) is None:
+                        raise ValueError(f"upload-pack: not our ref {value}")
+                    wants.append(value)
+                elif name == 'have':
+                    haves.append(value)
+                elif name == 'shallow':
+                    client_shallow.append(value)
+                elif name == 'deepen':
+                    deepen = int(value)
+                    if deepen <= 0:
+                        raise ValueError(f"invalid depth {value}")
+                elif name == 'deepen-relative' and version == 2:
+                    relative = True
+                elif name == 'filter':
+                    blob_limit = self.blob_limit(value)
+                elif name == 'done':
+                    done = True
+                elif name in ('deepen-since', 'deepen-not', 'want-ref'):
+                    raise ValueError(f"upload-pack: {name} is not supported")
+                else:
+                    features.add(argument) # v2 sends its side-band-64k, ofs-delta, no-progress... as arguments
+            if not wants:
+                raise ValueError("upload-pack: no wants")
+        except ValueError as e:
+            send(self.pkt_line(f"ERR {e}\n"))
+            return
+
+        # the commits to walk from, and the rest of what was named (tags, and trees or blobs asked for by sha)
+        commit_wants, roots = [], []
+        for sha in wants:
+            obj_type = git._object_info(sha)[0]
+            if obj_type == 'commit':
+                commit_wants.append(sha)
+                continue
+            roots.append(sha)
+            peeled = git._peel(sha) if obj_type == 'tag' else None
+            if peeled and git._object_info(peeled)[0] == 'commit':
+                commit_wants.append(peeled)
+        common = [sha for sha in dict.fromkeys(haves) if (info := git._object_info(sha)) and info[0] == 'commit']
+        # ready: every wanted commit is known to sit on top of something the client has
+        ready = done or bool(common) and all(any(git._is_ancestor(base, sha) for base in common) for sha in commit_wants)
+
+        shallow_info = b''
+        commits = None # walked here only when shallow lines need it, otherwise once a pack goes out
+        if deepen is not None or client_shallow:
+            commits, boundary, shallow, unshallow = git._fetch_commits(commit_wants, common, client_shallow, deepen, relative)
+            shallow_info = b''.join([self.pkt_line(f"shallow {sha}\n") for sha in shallow] +
+                                    [self.pkt_line(f"unshallow {sha}\n") for sha in unshallow])
+
+        if version == 2:
+            if not done:
+                acks = [self.pkt_line(f"ACK {sha}\n") for sha in common] or [self.pkt_line('NAK\n')]
+                send(self.pkt_line('acknowledgments\n') + b''.join(acks))
+                if not ready:
+                    send(b'0000')
+                    return
+                send(self.pkt_line('ready\n') + b'0001')
+            if deepen is not None:
+                send(self.pkt_line('shallow-info\n') + shallow_info + b'0001')
+            send(self.pkt_line('packfile\n'))
+            features |= SmartHttpTransport.V2_FETCH_FEATURES - {'no-progress'} # given in v2, no-progress is asked for
+            band_size = self.SIDE_BAND_64K_PAYLOAD
+        else:
+            if deepen is not None:
+                send(shallow_info + b'0000')
+            if not done and not haves: # wants and deepen alone - the shallow list is all the client waits for
+                return
+            if not done: # stateless - the client comes back with more haves, or with done
+                acks = [self.pkt_line(f"ACK {sha} common\n") for sha in common]
+                if ready:
+                    acks.append(self.pkt_line(f"ACK {common[-1]} ready\n"))
+                send(b''.join(acks) + self.pkt_line('NAK\n'))
+                return
+            send(self.pkt_line(f"ACK {common[-1]}\n" if common else 'NAK\n'))
+            band_size = (self.SIDE_BAND_64K_PAYLOAD if 'side-band-64k' in features else
+                         self.SIDE_BAND_PAYLOAD if 'side-band' in features else None)
+
+        if commits is None:
+            commits, boundary, _, _ = git._fetch_commits(commit_wants, common)
+        self.send_pack(git, git._fetch_objects(commits, boundary, roots, blob_limit), features, band_size, send)
+
+    # the pack, in band 1 pkt-lines (or raw without side-band) - progress in band 2 unless the client said no-progress.
+    # Pack reuse and deltas both need ofs-delta (always on in v2): without it every object goes out whole
+    def send_pack(self, git, objects, features, band_size, send):
+        progress = band_size is not None and 'no-progress' not in features
+        if progress:
+            send(self.pkt_line(b'\x02Enumerating objects: %d, done.\n' % len(objects)))
+
+        size = band_size or self.RAW_CHUNK
+        buffer = bytearray()
+        def write(data):
+            buffer.extend(data)
+            while len(buffer) >= size:
+                send(self.pkt_line(b'\x01' + buffer[:size]) if band_size else bytes(buffer[:size]))
+                del buffer[:size]
+
+        ofs_delta = 'ofs-delta' in features
+        reused, packs = git._stream_pack(objects, write, reuse=ofs_delta, depth=50 if ofs_delta else 0)
+        if buffer:
+            send(self.pkt_line(b'\x01' + buffer) if band_size else bytes(buffer))
+        if progress:
+            send(self.pkt_line(b'\x02Total %d (reused %d from %d packs)\n' % (len(objects), reused, packs)))
+        if band_size is not None:
+            send(b'0000')
+
+    # The HTTP side: GET <repo>/info/refs?service=git-upload-pack and POST <repo>/git-upload-pack, HTTP/1.1 keep-alive.
+    # Every connection is handled on the thread pool, so `threads` clients are served at once and the rest queue up.
+    # Responses to POST are chunked - the pack is written while it is being produced, never held in memory
+    def serve(self, host: str, port: int, threads: int = DEFAULT_THREADS):
+        import gzip, http.server, signal, socket
+        upload_pack = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            timeout = UploadPackServer.TIMEOUT
+
+            def protocol(self) -> int:
+                return 2 if 'version=2' in self.headers.get('Git-Protocol', '') else 0
+
+            def reply(self, status: int, content_type: str, body: bytes):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('Cache-Control', 'no-cache')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                path, _, query = self.path.partition('?')
+                git = upload_pack.repo(path[:-len('/info/refs')]) if path.endswith('/info/refs') else None
+                if git is None:
+                    self.reply(404, 'text/plain', b'Repository not found\n')
+                elif query != 'service=git-upload-pack': # dumb http, and pushes
+                    self.reply(403, 'text/plain', b'Only git-upload-pack is served\n')
+                else:
+                    self.reply(200, 'application/x-git-upload-pack-advertisement', upload_pack.advertise(git, self.protocol()))
+
+            # the request body - Content-Length or chunked, gunzipped when git compressed it (big negotiations)
+            def read_body(self) -> bytes:
+                if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                    parts = []
+                    total = 0
+                    while (size := int(self.rfile.readline().split(b';')[0], 16)):
+                        total += size
+                        if total > UploadPackServer.MAX_REQUEST:
+                            raise ValueError("request too large")
+                        parts.append(self.rfile.read(size))
+                        self.rfile.readline()
+                    while self.rfile.readline() not in (b'\r\n', b'\n', b''): # trailers
+                        pass
+                    body = b''.join(parts)
+                else:
+                    length = int(self.headers.get('Content-Length', 0))
+                    if length > UploadPackServer.MAX_REQUEST:
+                        raise ValueError("request too large")
+                    body = self.rfile.read(length)
+                if self.headers.get('Content-Encoding', '').lower() in ('gzip', 'x-gzip'):
+                    body = gzip.decompress(body)
+                return body
+
+            def do_POST(self):
+                path = self.path.partition('?')[0]
+                git = upload_pack.repo(path[:-len('/git-upload-pack')]) if path.endswith('/git-upload-pack') else None
+                if git is None:
+                    self.reply(403 if path.endswith('/git-receive-pack') else 404, 'text/plain', b'Only git-upload-pack is served\n')
+                    return
+                version = self.protocol()
+                try:
+                    command, capabilities, arguments = upload_pack.parse_request(self.read_body(), version)
+                except (ValueError, EOFError, OSError) as e:
+                    self.close_connection = True
+                    self.reply(400, 'text/plain', f"Bad request: {e}\n".encode('utf-8'))
+                    return
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-git-upload-pack-result')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.send_header('Cache-Control', 'no-cache')
+                self.end_headers()
+                def send(data):
+                    self.wfile.write(b'%x\r\n' % len(data) + data + b'\r\n')
+                try:
+                    if version == 2 and command == 'ls-refs':
+                        send(upload_pack.ls_refs(git, arguments))
+                    elif command == 'fetch':
+                        upload_pack.fetch(git, capabilities, arguments, version, send)
+                    else:
+                        send(upload_pack.pkt_line(f"ERR unknown command '{command}'\n"))
+                    self.wfile.write(b'0\r\n\r\n')
+                except (BrokenPipeError, ConnectionResetError): # the client hung up
+                    self.close_connection = True
+                except (Exception, SystemExit): # halfway through a response - all that is left is to cut it off
+                    import traceback
+                    traceback.print_exc()
+                    self.close_connection = True
+
+        pool = ThreadPoolExecutor(threads)
+        connections = set() # open ones - idle keep-alive connections are hung up on at exit, not waited for
+        class Server(http.server.HTTPServer):
+            def process_request(self, request, client_address):
+                connections.add(request)
+                pool.submit(self.process_request_thread, request, client_address)
+
+            def process_request_thread(self, request, client_address):
+                try:
+                    self.finish_request(request, client_address)
+                except Exception:
+                    self.handle_error(request, client_address)
+                finally:
+                    connections.discard(request)
+                    self.shutdown_request(request)
+
+            def handle_error(self, request, client_address):
+                if not isinstance(sys.exc_info()[1], ConnectionError): # a client hanging up is nothing to report
+                    super().handle_error(request, client_address)
+
+        httpd = Server((host, port), Handler)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        print(f"Serving {self.base_path} on http://{host}:{httpd.server_port}/", file=sys.stderr)
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            httpd.server_close()
+            for request in list(connections):
+                try:
+                    request.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            pool.shutdown(cancel_futures=True)
+
+
+# -------- DAEMON --------
+
+# One long-running process answering commands over a Unix domain socket, so a script issuing thousands of them pays
+# the interpreter start, the imports and the parser build once. The same Git instance serves every command: parsed
+# objects and trees, the open (mapped) pack indexes, the commit-graph and remote connections stay warm between them.
+# The client (app/client.py) sends its own stdin/stdout/stderr along with the request (SCM_RIGHTS), so a command
+# reads and prints exactly as it would in a process of its own. Commands run one at a time, in the client's cwd.
+# request: 4 byte length, then cwd NUL arg NUL arg ...     reply: 4 byte exit status
+class CommandDaemon:
+    SOCKET_FILE = 'daemon.sock' # under .git
+    HEADER = struct.Struct('>i')
+    MAX_REQUEST = 1 << 20
+    # settings a command may change on the Git instance for its own run (clone --jobs, fetch --protocol, ...)
+    OPTIONS = ('delta_base_cache_limit', 'jobs', 'checkout_workers', 'hash_workers', 'protocol_version', 'stats')
+
+    def __init__(self, git, parser):
+        self.git = git
+        self.parser = parser
+        self.options = {}
+
+    def serve(self, socket_path: str):
+        import socket, signal
+        if os.path.exists(socket_path): # left behind by a daemon that died - a live one still accepts
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                    probe.connect(socket_path)
+                print(f"fatal: a daemon is already listening on {socket_path}", file=sys.stderr)
+                sys.exit(1)
+            except ConnectionRefusedError:
+                os.remove(socket_path)
+
+        git = self.git
+        socket_file = os.path.abspath(socket_path) # bound as given (the length limit), removed from wherever we are
+        git.git_dir = os.path.abspath(git.git_dir) # commands run in the client's cwd, the repo stays this one
+        self.options = {name: getattr(git, name) for name in self.OPTIONS}
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(socket_path)
+        server.listen()
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0)) # kill -> socket removed below
+        print(f"Listening on {socket_path}", file=sys.stderr)
+        try:
+            while True:
+                connection, _ = server.accept()
+                with connection:
+                    try:
+                        self.handle(connection)
+                    except Exception: # one broken request does not take the daemon down
+                        import traceback
+                        traceback.print_exc()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            os.remove(socket_file)
+
+    def handle(self, connection):
+        import socket
+        data, fds, _, _ = socket.recv_fds(connection, 64 * 1024, 3)
+        try:
+            if len(fds) != 3 or len(data) < self.HEADER.size:
+                return
+            length = self.HEADER.unpack_from(data)[0]
+            if length > self.MAX_REQUEST:
+                return
+            while len(data) < self.HEADER.size + length:
+                more = connection.recv(64 * 1024)
+                if not more:
+                    return
+                data += more
+            cwd, *argv = data[self.HEADER.size:].decode('utf-8', 'surrogateescape').split('\0')
+            fds, owned = (), fds # closed by execute from here on
+            status = self.execute(cwd, argv, owned)
+            connection.sendall(self.HEADER.pack(status))
+        except OSError: # the client went away - nobody is left to tell
+            pass
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    # one command with the client's stdin/stdout/stderr as ours - the fds are closed once it is done (a client piping
+    # into head sees the end of the output then), the exit status is what sys.exit was called with
+    def execute(self, cwd, argv, fds) -> int:
+        saved = sys.stdin, sys.stdout, sys.stderr
+        streams = [open(fds[0], 'r'), open(fds[1], 'w'), open(fds[2], 'w', buffering=1, errors='backslashreplace')]
+        sys.stdin, sys.stdout, sys.stderr = streams
+        status = 0
+        try:
+            os.chdir(cwd)
+            self.refresh()
+            if argv[:1] in (['daemon'], ['serve']): # would hold the daemon for good
+                print(f"fatal: {argv[0]} can't run inside the daemon", file=sys.stderr)
+                status = 1
+            elif argv[:1] == ['clone']: # a new repository - nothing warm to reuse, and it must not become ours
+                fresh = Git()
+                run(fresh, build_parser(fresh), argv)
+            else:
+                run(self.git, self.parser, argv)
+        except SystemExit as e:
+            if isinstance(e.code, int) or e.code is None:
+                status = e.code or 0
+            else:
+                print(e.code, file=sys.stderr)
+                status = 1
+        except BrokenPipeError: # the client's reader stopped early (| head) - a process of its own would get SIGPIPE
+            status = 128 + 13
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            status = 1
+        finally:
+            sys.stdin, sys.stdout, sys.stderr = saved
+            for stream in streams:
+                try:
+                    stream.close() # flushes first
+                except OSError:
+                    pass
+        return status
+
+    # before each command - what it may have changed on the Git instance goes back to the daemon's settings, and what
+    # another process may have rewritten since (packs, the commit-graph, .git/shallow) is reloaded when it changed.
+    # Object, tree and commit caches are keyed by sha, so they can never be stale.
+    def refresh(self):
+        git = self.git
+        for name, value in self.options.items():
+            setattr(git, name, value)
+        git._shallow_commits = None
+        git._reload_changed_stores()
 
-    git = Git()
+
+# -------- MAIN ---------
+
+# the whole command line, every subcommand bound to the methods of git - built once per process (once per daemon)
+def build_parser(git):
 
     # --------- ADDING A PARSER ---------
   
     parser = argparse.ArgumentParser(description="Basic Git Implementation.")
+    parser.add_argument('--trace-perf', dest='trace_perf', action='store_true', help=f"Print per-phase timings and counters on stderr (or set {PerfTrace.ENV_VAR}=1)")
+    parser.add_argument('--trace-perf-file', dest='trace_perf_file', metavar='FILE', help=f"Append them as JSON lines to FILE instead (or set {PerfTrace.ENV_VAR}=/abs/path)")
 
     # ----- Setting up Subcommands ------
 
@@ -638,9 +4746,11 @@ def main():
     group.add_argument('-p', action='store_true', help='Pretty print the contents of the object')
     group.add_argument('-t', action='store_true', help='print the type of object')
     group.add_argument('-s', action='store_true', help="print byte size of the object")
+    group.add_argument('--batch', action='store_true', help="read shas from stdin, print '<sha> <type> <size>' and the content of each")
+    group.add_argument('--batch-check', dest='batch_check', action='store_true', help="read shas from stdin, print '<sha> <type> <size>' for each")
     
     # parsing the hash of object
-    cat_file_parser.add_argument('object_hash', type=str, help="sha1-hash of the Git object to read")
+    cat_file_parser.add_argument('object_hash', type=str, nargs='?', help="sha1-hash of the Git object to read")
     cat_file_parser.set_defaults(func=git.cat_file)
 
 
@@ -649,17 +4759,21 @@ def main():
 
     # adding the optional flag
     hash_object_parser.add_argument('-w', action='store_true', help="Storing the object to Git database")
+    hash_object_parser.add_argument('--stdin-paths', action='store_true', help="read file paths from stdin, one per line (with -w all new blobs go into one pack)")
 
     # filename
-    hash_object_parser.add_argument('file_path', help="file path to caculate the sha1-hash of")
+    hash_object_parser.add_argument('file_path', nargs='?', help="file path to caculate the sha1-hash of")
     hash_object_parser.set_defaults(func=git.hash_object)
 
 
-    # -- 4. Subcommand - Git ls-tree <flag> <tree-sha1-hash> --
+    # -- 4. Subcommand - Git ls-tree <flag> <tree-ish> [<path>...] --
     ls_tree_parser = subparsers.add_parser('ls-tree', help='list the content of a tree object')
 
     # required tree hash
-    ls_tree_parser.add_argument("tree_hash", type=str, help='SHA-1 hash of the tree object to read')
+    ls_tree_parser.add_argument("tree_hash", type=str, help='Tree (or commit, ref, <rev>:<path>) to list')
+    ls_tree_parser.add_argument("paths", nargs='*', help='Only list these paths')
+    ls_tree_parser.add_argument('-r', action='store_true', help='Recurse into subtrees')
+    ls_tree_parser.add_argument('-t', action='store_true', help='Show the trees themselves too while recursing')
 
     # optional flag - --name-only
     ls_tree_parser.add_argument('--name-only', dest='name_only', action='store_true', help='Only print the names of the item')
@@ -669,6 +4783,7 @@ def main():
 
     # -- 5. SubCommand - git write-tree  --
     write_tree_parser = subparsers.add_parser('write-tree', help='creates a tree object from the current state of the staging area.')
+    write_tree_parser.add_argument('--threads', type=int, help='Number of threads hashing and compressing files (default: one per core)')
     write_tree_parser.set_defaults(func = git.write_tree)
 
 
@@ -687,13 +4802,138 @@ def main():
 
     clone_parser.add_argument("repo_address", type=str, help="The URL or path to the repo to clone")
     clone_parser.add_argument("directory_name", type=str, help="The path to the directory to clone into")
+    clone_parser.add_argument("--depth", type=int, help="Create a shallow clone with history truncated to this many commits")
+    clone_parser.add_argument("--filter", type=str, help="Partial clone filter, e.g. blob:none - missing blobs are fetched when first needed")
+    clone_parser.add_argument("-j", "--jobs", type=int, help="Number of processes resolving deltas (default: one per core)")
+    clone_parser.add_argument("--checkout-workers", dest="checkout_workers", type=int, help="Number of threads writing files during checkout")
+    clone_parser.add_argument("--protocol", type=int, choices=(0, 2), help="Wire protocol version to ask for (default: 2, falling back to 0)")
+    clone_parser.add_argument("--stats", action="store_true", help="Report the busy time and throughput of each pipeline stage on stderr")
+    clone_parser.add_argument("--delta-base-cache-limit", dest="delta_base_cache_limit", type=int, help="Byte budget for cached delta bases while indexing the pack")
 
     clone_parser.set_defaults(func=git.clone)
 
 
-    # ---- PARSE and DISPATCH -----
-    args = parser.parse_args()
-    args.func(args)
+    # -- 8. Subcommand - git add <path>... --
+    add_parser = subparsers.add_parser('add', help="Adding file contents to the index")
+    add_parser.add_argument('paths', nargs='+', help="Files or directories to add")
+    add_parser.set_defaults(func=git.add)
+
+
+    # -- 9. Subcommand - git fetch [<url>] --
+    fetch_parser = subparsers.add_parser('fetch', help="Downloading new objects from the remote, negotiating what we already have")
+    fetch_parser.add_argument('repo_address', type=str, nargs='?', help="Remote url (default: the url this repo was cloned from)")
+    fetch_parser.add_argument("--protocol", type=int, choices=(0, 2), help="Wire protocol version to ask for (default: 2, falling back to 0)")
+    fetch_parser.set_defaults(func=git.fetch)
+
+    # -- 10. Subcommand - git gc --
+    gc_parser = subparsers.add_parser('gc', help="Packing all reachable objects into one delta compressed pack, pruning loose copies")
+    gc_parser.add_argument("--window", type=int, default=10, help="Number of earlier objects tried as delta base (default 10)")
+    gc_parser.add_argument("--depth", type=int, default=50, help="Longest delta chain allowed (default 50)")
+    gc_parser.set_defaults(func=git.gc)
+
+    # -- 11. Subcommand - git pack-objects <base-name> --
+    pack_objects_parser = subparsers.add_parser('pack-objects', help="Writing the objects named on stdin into a new pack + .idx")
+    pack_objects_parser.add_argument("base_name", type=str, help="Pack files are written as <base-name>-<sha>.pack/.idx")
+    pack_objects_parser.add_argument("--window", type=int, default=10, help="Number of earlier objects tried as delta base (default 10)")
+    pack_objects_parser.add_argument("--depth", type=int, default=50, help="Longest delta chain allowed (default 50)")
+    pack_objects_parser.set_defaults(func=git.pack_objects)
+
+    # -- 12. Subcommand - git commit-graph write --
+    commit_graph_parser = subparsers.add_parser('commit-graph', help="Writing the commit-graph file that history walks read instead of commits")
+    commit_graph_parser.add_argument("action", choices=('write',), help="write: rebuild it from the refs")
+    commit_graph_parser.set_defaults(func=git.commit_graph)
+
+    # -- 13. Subcommand - git log --
+    log_parser = subparsers.add_parser('log', help="Showing the commit history")
+    log_parser.add_argument("revs", nargs='*', help="Commits to start from (default HEAD), ^<rev> or <a>..<b> to leave some out")
+    log_parser.add_argument("-n", "--max-count", dest="max_count", type=int, help="Show at most this many commits")
+    log_parser.add_argument("--oneline", action="store_true", help="One line per commit: short sha and subject")
+    log_parser.set_defaults(func=git.log)
+
+    # -- 14. Subcommand - git rev-list --
+    rev_list_parser = subparsers.add_parser('rev-list', help="Listing commits reachable from some commits and not others")
+    rev_list_parser.add_argument("revs", nargs='+', help="Commits to start from, ^<rev> or <a>..<b> to leave some out")
+    rev_list_parser.add_argument("-n", "--max-count", dest="max_count", type=int, help="List at most this many commits")
+    rev_list_parser.add_argument("--count", action="store_true", help="Print the number of commits instead")
+    rev_list_parser.set_defaults(func=git.rev_list)
+
+    # -- 15. Subcommand - git merge-base --
+    merge_base_parser = subparsers.add_parser('merge-base', help="Finding the best common ancestor of two commits")
+    merge_base_parser.add_argument("commits", nargs=2, help="The two commits")
+    merge_base_parser.add_argument("--all", action="store_true", help="Print every best common ancestor, not just one")
+    merge_base_parser.add_argument("--is-ancestor", dest="is_ancestor", action="store_true", help="Exit 0 if the first commit is an ancestor of the second, 1 if not")
+    merge_base_parser.set_defaults(func=git.merge_base)
+
+    # -- 16. Subcommand - git diff-tree --
+    diff_tree_parser = subparsers.add_parser('diff-tree', help="Comparing two trees (or a commit with its parent)")
+    diff_tree_parser.add_argument("old", help="Tree or commit - alone, the commit is compared with its parent")
+    diff_tree_parser.add_argument("new", nargs='?', help="Tree or commit to compare with")
+    diff_tree_parser.add_argument("-r", action="store_true", help="Recurse into subtrees")
+    diff_tree_parser.add_argument("-t", action="store_true", help="Show the subtrees too while recursing (implies -r)")
+    diff_tree_parser.add_argument("--name-only", dest="name_only", action="store_true", help="Only print the changed paths")
+    diff_tree_parser.add_argument("--name-status", dest="name_status", action="store_true", help="Print the paths with their A/D/M/T status")
+    diff_tree_parser.set_defaults(func=git.diff_tree)
+
+    # -- 17. Subcommand - git checkout <rev> --
+    checkout_parser = subparsers.add_parser('checkout', help="Switching the work tree to another commit, writing only what changed")
+    checkout_parser.add_argument("rev", help="Branch name (checked out as that branch) or any other commit (detached HEAD)")
+    checkout_parser.set_defaults(func=git.checkout)
+
+    # -- 18. Subcommand - git daemon --
+    daemon_parser = subparsers.add_parser('daemon', help="Serving commands over a Unix socket from one warm process (client: python3 -m app.client)")
+    daemon_parser.add_argument("--socket", type=str, help=f"Socket path (default: .git/{CommandDaemon.SOCKET_FILE})")
+    daemon_parser.set_defaults(func=lambda args: CommandDaemon(git, parser).serve(args.socket or os.path.join(git.git_dir, CommandDaemon.SOCKET_FILE)))
+
+    # -- 19. Subcommand - git serve --
+    serve_parser = subparsers.add_parser('serve', help="Serving repositories to clone and fetch over smart HTTP (git-upload-pack)")
+    serve_parser.add_argument("path", nargs='?', default='.', help="The repository, or a directory of them (default: .)")
+    serve_parser.add_argument("--host", default='127.0.0.1', help="Address to listen on (default 127.0.0.1)")
+    serve_parser.add_argument("--port", type=int, default=8080, help="Port to listen on, 0 for any free one (default 8080)")
+    serve_parser.add_argument("--threads", type=int, default=UploadPackServer.DEFAULT_THREADS, help=f"Clients served at once (default {UploadPackServer.DEFAULT_THREADS})")
+    serve_parser.set_defaults(func=lambda args: UploadPackServer(args.path).serve(args.host, args.port, args.threads))
+
+    # -- 20. Subcommand - git index-pack <pack-file> --
+    index_pack_parser = subparsers.add_parser('index-pack', help="Checking a pack file and writing its .idx")
+    index_pack_parser.add_argument("pack_file", help="The <name>.pack to index")
+    index_pack_parser.add_argument("-o", dest="index_file", help="Where to write the index (default: <name>.idx next to the pack)")
+    index_pack_parser.add_argument("-v", "--verbose", action="store_true", help="Print the object and delta chain stats on stderr")
+    index_pack_parser.set_defaults(func=git.index_pack)
+
+    # -- 21. Subcommand - git verify-pack <pack>.idx... --
+    verify_pack_parser = subparsers.add_parser('verify-pack', help="Checking packs against their .idx")
+    verify_pack_parser.add_argument("packs", nargs='+', help="The .idx (or .pack) files to check")
+    verify_pack_parser.add_argument("-v", "--verbose", action="store_true", help="List every object, then the stats")
+    verify_pack_parser.add_argument("-s", "--stat-only", dest="stat_only", action="store_true", help="Only print the stats")
+    verify_pack_parser.set_defaults(func=git.verify_pack)
+
+    return parser
+
+
+# ---- PARSE and DISPATCH -----
+def run(git, parser, argv):
+    args = parser.parse_args(argv)
+    if args.trace_perf_file or args.trace_perf:
+        git.trace = PerfTrace(os.path.abspath(args.trace_perf_file) if args.trace_perf_file else None)
+    else:
+        git.trace = PerfTrace.from_env()
+    if git.trace is None:
+        args.func(args)
+        return
+
+    # the hot helpers get timed per call on this instance only - the class (and the delta workers) stay as they are
+    git.trace.instrument(git)
+    try:
+        with git.trace.phase(args.command):
+            args.func(args)
+    finally:
+        git.trace.report(args.command)
+        git.trace.restore(git)
+        git.trace = None
+
+
+def main():
+    git = Git()
+    run(git, build_parser(git), sys.argv[1:])
 
 
 if __name__ == "__main__":